@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for j.
+
+A deterministic generator makes synthetic journals (1k, 10k, 100k entries,
+...) with a realistic spread of tags, attributes and body sizes, and the main
+code paths are timed against them: scanning, parsing, each kind of filter,
+rendering and JSON output. Throughput and peak memory are reported for each.
+
+Results can be saved, and compared with a saved baseline, failing (exit
+status 1) if anything got slower or bigger by more than a threshold:
+
+    bench/j_bench.py --sizes 1000,10000 --save base.json
+    ... change things ...
+    bench/j_bench.py --sizes 1000,10000 --baseline base.json --threshold 0.2
+
+Generated journals are kept in a cache directory and reused by later runs.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(BENCH_DIR, "..")))
+
+import j  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000]
+DEFAULT_SEED = 1
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "j-bench")
+
+# Generated entries fall in the ten years up to this time
+GEN_END = datetime(2024, 1, 1)
+GEN_SPAN = timedelta(days=3650)
+
+# Marks a fully generated journal in the cache. j skips dotfiles.
+COMPLETE_MARKER = ".j-bench-complete"
+
+
+class Vocabulary:
+    """
+    Made up words, picked with a Zipf-like distribution so that a few words
+    are very common and most are rare, as in real text.
+    """
+
+    SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pa",
+                 "do", "fi", "gu", "he", "jo", "ba", "ce", "wy", "xo", "qu"]
+
+    def __init__(self, rng, size, min_syl=1, max_syl=4):
+        words = set()
+        while len(words) < size:
+            n = rng.randint(min_syl, max_syl)
+            words.add("".join(rng.choice(Vocabulary.SYLLABLES)
+                              for _ in range(n)))
+        self.words = sorted(words)
+        rng.shuffle(self.words)
+        self.weights = [1 / (rank + 1) for rank in range(size)]
+
+    def pick(self, rng, k):
+        return rng.choices(self.words, weights=self.weights, k=k)
+
+
+def generate_body(rng, words):
+    """Make the body of an entry, or None for a title-only entry."""
+
+    if rng.random() < 0.1:
+        return None
+
+    # Body sizes are roughly log-normal, with a median of ~600 characters
+    target = min(int(rng.lognormvariate(6.4, 1.0)), 64 * 1024)
+    parts = []
+    size = 0
+    while size < target:
+        kind = rng.random()
+        if kind < 0.05:
+            part = "# " + " ".join(words.pick(rng, rng.randint(1, 4)))
+        elif kind < 0.12:
+            part = "\n".join("* " + " ".join(words.pick(rng,
+                                                        rng.randint(2, 10)))
+                             for _ in range(rng.randint(2, 6)))
+        elif kind < 0.15:
+            part = "```\n%s\n```" % "\n".join(
+                "    " + " ".join(words.pick(rng, rng.randint(1, 6)))
+                for _ in range(rng.randint(1, 8)))
+        elif kind < 0.18:
+            part = "https://example.com/" + "/".join(words.pick(rng, 3))
+        else:
+            # A paragraph, as typed: lines of varying length
+            lines = []
+            for _ in range(rng.randint(1, 8)):
+                lines.append(" ".join(words.pick(rng, rng.randint(4, 16))))
+            part = "\n".join(lines)
+        parts.append(part)
+        size += len(part) + 2
+    return "\n\n".join(parts) + "\n"
+
+
+def generate(directory, count, seed=DEFAULT_SEED, sharded=False):
+    """
+    Fill `directory` with `count` synthetic entries. The same `count` and
+    `seed` always make the same journal. If `sharded` is true, the journal
+    has the year/month sharded layout. Returns the entry file names.
+    """
+
+    rng = random.Random(seed)
+    words = Vocabulary(rng, 5000)
+    tags = Vocabulary(rng, 200, 2, 3)
+    start = GEN_END - GEN_SPAN
+    span = int(GEN_SPAN.total_seconds())
+    suffix_chars = "abcdefghijklmnopqrstuvwxyz0123456789_"
+
+    os.makedirs(directory, exist_ok=True)
+    if sharded:
+        open(os.path.join(directory, j.SHARDED_MARKER), "w").close()
+    names = []
+    for _ in range(count):
+        when = start + timedelta(seconds=rng.randrange(span))
+        suffix = "".join(rng.choice(suffix_chars) for _ in range(8))
+        name = "%s-%s" % (when.strftime(j.TIME_FORMAT), suffix)
+
+        title = " ".join(words.pick(rng, rng.randint(2, 8))).capitalize()
+        attrs = ["@" + t for t in
+                 sorted(set(tags.pick(rng, rng.choice([0, 0, 0, 1, 1, 1, 1,
+                                                       2, 2, 3]))))]
+        if rng.random() < 0.01:
+            attrs.append("immortal")
+        if rng.random() < 0.03:
+            attrs.append("nowrap")
+        body = generate_body(rng, words)
+
+        lines = [title + "\n"]
+        if attrs:
+            lines.append(" ".join(attrs) + "\n")
+        if body:
+            lines.append("\n" + body)
+        subdir = j.shard_of(name) if sharded else ""
+        os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+        with open(os.path.join(directory, subdir, name), "w") as fh:
+            fh.writelines(lines)
+        names.append(name)
+    return names
+
+
+def cached_journal(cache_dir, count, seed, sharded=False):
+    """Returns the directory of a generated journal, generating it if need
+    be."""
+
+    directory = os.path.join(cache_dir, "%d-%d%s" % (
+        count, seed, "-sharded" if sharded else ""))
+    if not os.path.exists(os.path.join(directory, COMPLETE_MARKER)):
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        print("generating %d entries in '%s'" % (count, directory),
+              file=sys.stderr)
+        generate(directory, count, seed, sharded)
+        open(os.path.join(directory, COMPLETE_MARKER), "w").close()
+    return directory
+
+
+def common_tag(jrnl):
+    """A tag had by a good number, but not most, of the entries."""
+
+    tally = {}
+    for entry in jrnl._collect_entries(bodies=False):
+        for tag in entry.tags:
+            tally[tag] = tally.get(tag, 0) + 1
+    counts = sorted(tally.items(), key=lambda tc: (-tc[1], tc[0]))
+    if not counts:
+        return "untagged"
+    return counts[min(5, len(counts) - 1)][0]
+
+
+def common_word(jrnl):
+    """A word that is in a good number, but not most, of the entries."""
+
+    itr = jrnl._iter_entries()
+    try:
+        for entry in itr:
+            words = (entry.body or "").split()
+            if len(words) > 20:
+                return words[10]
+        return entry.title.split()[0]
+    finally:
+        itr.close()
+
+
+# The benchmarks. Each is called with the journal and returns a function to
+# time, which returns the number of entries it went through.
+
+def bench_scan(jrnl):
+    def run():
+        return len(jrnl._collect_entries(bodies=False))
+    return run
+
+
+def bench_scan_no_index(jrnl):
+    def run():
+        jrnl.use_index = False
+        try:
+            return len(jrnl._collect_entries(bodies=False))
+        finally:
+            jrnl.use_index = True
+    return run
+
+
+def bench_parse(jrnl):
+    paths = [jrnl._entry_path(n, subdir) for _, n, subdir in jrnl._scan()]
+
+    def run():
+        for path in paths:
+            j.Entry(path)
+        return len(paths)
+    return run
+
+
+def bench_filter_time(jrnl):
+    total = len(list(jrnl._scan()))
+    # The most recent tenth of the journal
+    filters = j.FilterSettings(
+        time_filter=j.TimeFilter(GEN_END - GEN_SPAN / 10, GEN_END))
+
+    def run():
+        jrnl._collect_entries(filters)
+        return total
+    return run
+
+
+def bench_filter_tag(jrnl):
+    total = len(list(jrnl._scan()))
+    filters = j.FilterSettings(tag_filters=[common_tag(jrnl)])
+
+    def run():
+        jrnl._collect_entries(filters)
+        return total
+    return run
+
+
+def bench_filter_term(jrnl):
+    total = len(list(jrnl._scan()))
+    filters = j.FilterSettings(textual_filters=[common_word(jrnl)])
+
+    def run():
+        jrnl._collect_entries(filters)
+        return total
+    return run
+
+
+def bench_filter_query(jrnl):
+    total = len(list(jrnl._scan()))
+    # Written expensive step first, to be reordered by the plan
+    query = j.Query.parse("(%s or @%s) and not @untagged" % (
+        common_word(jrnl), common_tag(jrnl)))
+    filters = j.FilterSettings(query=query, time_filter=j.TimeFilter(
+        GEN_END - GEN_SPAN / 2, GEN_END))
+
+    def run():
+        jrnl._collect_entries(filters)
+        return total
+    return run
+
+
+def bench_filter_id(jrnl):
+    names = sorted(n for _, n, _ in jrnl._scan())
+    filters = j.FilterSettings(id_filters=names[::max(1, len(names) // 10)])
+
+    def run():
+        jrnl._collect_entries(filters)
+        return len(names)
+    return run
+
+
+def _show(jrnl, **kwargs):
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            jrnl.show_entries(**kwargs)
+
+
+def bench_render(jrnl):
+    total = len(list(jrnl._scan()))
+
+    def run():
+        # Without the render cache, so that the wrapping is measured
+        size, jrnl.render_cache_size = jrnl.render_cache_size, 0
+        try:
+            _show(jrnl)
+        finally:
+            jrnl.render_cache_size = size
+        return total
+    return run
+
+
+def bench_render_cached(jrnl):
+    total = len(list(jrnl._scan()))
+
+    def run():
+        _show(jrnl)
+        return total
+    return run
+
+
+def bench_json(jrnl):
+    total = len(list(jrnl._scan()))
+
+    def run():
+        _show(jrnl, output_json=True)
+        return total
+    return run
+
+
+def bench_export(jrnl, fmt):
+    def run():
+        with open(os.devnull, "wb") as devnull:
+            return jrnl.export(devnull, fmt)
+    return run
+
+
+def bench_export_tar(jrnl):
+    return bench_export(jrnl, "tar.gz")
+
+
+def bench_export_jsonl(jrnl):
+    return bench_export(jrnl, "jsonl.gz")
+
+
+BENCHMARKS = [
+    ("scan", bench_scan),
+    ("scan_no_index", bench_scan_no_index),
+    ("parse", bench_parse),
+    ("filter_time", bench_filter_time),
+    ("filter_tag", bench_filter_tag),
+    ("filter_term", bench_filter_term),
+    ("filter_query", bench_filter_query),
+    ("filter_id", bench_filter_id),
+    ("render", bench_render),
+    ("render_cached", bench_render_cached),
+    ("json", bench_json),
+    ("export_tar", bench_export_tar),
+    ("export_jsonl", bench_export_jsonl),
+]
+
+
+def measure(fn, repeat, memory=True):
+    """
+    Time `fn`, taking the best of `repeat` runs. Returns a dict of the
+    seconds taken, the entries gone through per second and, if `memory` is
+    true, the peak memory allocated by a further (slower, traced) run.
+    """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = fn()
+        took = time.perf_counter() - start
+        if best is None or took < best:
+            best = took
+    result = {"seconds": best, "per_second": count / best if best else 0}
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(sizes, names=None, seed=DEFAULT_SEED, repeat=3,
+                   memory=True, cache_dir=DEFAULT_CACHE_DIR, report=None,
+                   sharded=False):
+    """
+    Run the benchmarks called `names` (all of them if None) against journals
+    of each size in `sizes`, with the sharded layout if `sharded` is true.
+    Returns a dict mapping `"<size>:<name>"` to the results of `measure()`.
+    Each result is passed to `report` as it comes.
+    """
+
+    results = {}
+    for size in sizes:
+        directory = cached_journal(cache_dir, size, seed, sharded)
+        jrnl = j.Journal(directory)
+        jrnl._collect_entries(bodies=False)  # warm the index
+        _show(jrnl)  # and the render cache
+        for name, make in BENCHMARKS:
+            if names and name not in names:
+                continue
+            key = "%d:%s" % (size, name)
+            results[key] = measure(make(jrnl), repeat, memory)
+            if report:
+                report(key, results[key])
+    return results
+
+
+def regressions(results, baseline, threshold=DEFAULT_THRESHOLD,
+                thresholds=None):
+    """
+    Compare `results` with `baseline` (as returned by `run_benchmarks()`).
+    Returns a list of messages about results whose time or peak memory
+    exceeds the baseline by more than `threshold`, a fraction. `thresholds`
+    maps benchmark names to their own thresholds.
+    """
+
+    problems = []
+    for key, res in sorted(results.items()):
+        base = baseline.get(key)
+        if not base:
+            continue
+        name = key.split(":", 1)[1]
+        limit = 1 + (thresholds or {}).get(name, threshold)
+        for field in "seconds", "peak_bytes":
+            if field in res and base.get(field) and \
+                    res[field] > base[field] * limit:
+                problems.append("%s: %s %.4g > %.4g (baseline) * %.2f" % (
+                    key, field, res[field], base[field], limit))
+    return problems
+
+
+def print_result(key, res):
+    peak = res.get("peak_bytes")
+    print("%-24s %10.4f s %12.0f entries/s %10s" % (
+        key, res["seconds"], res["per_second"],
+        "%.1f MiB" % (peak / 2 ** 20) if peak is not None else "-"))
+    sys.stdout.flush()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        epilog="Benchmarks: " + ", ".join(n for n, _ in BENCHMARKS))
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated journal sizes (default: "
+                        "%(default)s)")
+    parser.add_argument("--only", action="append", default=None,
+                        metavar="NAME", help="only run this benchmark")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help="seed for the journal generator")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="take the best of this many runs")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="don't measure peak memory (which is slow)")
+    parser.add_argument("--sharded", action="store_true",
+                        help="use journals with the year/month sharded "
+                        "layout")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="where generated journals are kept "
+                        "(default: %(default)s)")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="fail if results regress from those saved here")
+    parser.add_argument("--threshold", action="append", default=[],
+                        metavar="[NAME=]FRACTION",
+                        help="allowed regression, as a fraction (default: "
+                        "%s). May be given per benchmark." % DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    threshold = DEFAULT_THRESHOLD
+    thresholds = {}
+    for arg in args.threshold:
+        name, _, frac = arg.rpartition("=")
+        if name:
+            thresholds[name] = float(frac)
+        else:
+            threshold = float(frac)
+
+    results = run_benchmarks(sizes, args.only, args.seed, args.repeat,
+                             not args.no_memory, args.cache_dir,
+                             report=print_result, sharded=args.sharded)
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        problems = regressions(results, baseline, threshold, thresholds)
+        for problem in problems:
+            print("REGRESSION %s" % problem)
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
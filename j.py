@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 
+import collections
+import functools
 import logging
+import re
 import sys
 import os
-import tempfile
-import argparse
-import io
-import json
-import textwrap
+import itertools
 from datetime import datetime, timedelta
-import subprocess
-import shutil
+import time
+
+# Modules only needed by some commands (argparse, json, sqlite3, subprocess,
+# etc.) are imported where they are used, to keep `j` quick to start.
+sqlite3 = None  # imported by `SQLiteStore.open()`
 
 
 TIME_FORMAT = "%Y%m%d_%H%M%S"
@@ -19,7 +21,48 @@ DEFAULT_EDITOR = "vi"
 DEFAULT_PAGER = "less -R"
 DEFAULT_WRAP_COL = 78
 
-TMP = tempfile.gettempdir()
+INDEX_FILENAME = ".j-index.sqlite3"
+RENDER_CACHE_FILENAME = ".j-render-cache.sqlite3"
+DEFAULT_RENDER_CACHE_SIZE = 16 * 1024 * 1024
+
+# The presence of this file in the journal directory means that new entries
+# go in year/month shard directories
+SHARDED_MARKER = ".j-sharded"
+
+# Old entries moved out of their files by `j pack`, and the pack's index. As
+# dotfiles, neither is taken for an entry.
+PACK_FILENAME = ".j-pack"
+PACK_INDEX_FILENAME = ".j-pack.idx"
+
+# The directory holding the journal's `Timeline`. Being a directory, the
+# timeline can be replaced without changing the journal directory.
+TIMELINE_DIRNAME = ".j-timeline"
+
+# Time filters leave out the entries outside of their range, by taking a
+# slice of the `Timeline` or skipping shards, going by directory stamps and
+# the index's immortal records. An entry edited in place changes neither, so
+# the records are checked against every entry by a pass over the whole
+# journal at least this often, in seconds.
+FULL_PASS_INTERVAL = 10 * 60
+
+# The socket on which `j daemon` serves the journal
+DAEMON_SOCKET = ".j-daemon.sock"
+
+# The prefix of the directories in which entries added by `j import` and
+# `j new --stdin` are written before they are moved into place. Being in the
+# journal directory, the move can't cross file systems.
+STAGING_PREFIX = ".j-staging-"
+
+# The archive formats of `j export`, each also the file name suffix that
+# selects it
+EXPORT_FORMATS = ("tar", "tar.gz", "tgz", "zip", "jsonl", "jsonl.gz")
+
+# The gzip compression level of exports. Journals are text, so the lowest
+# levels compress almost as well, and are several times quicker.
+EXPORT_COMPRESS_LEVEL = 1
+
+# The words of an entry, as held in the index
+TOKEN_RE = re.compile(r"\w+")
 
 HELP_EPILOG = """ENTRY FORMAT
 ------------
@@ -48,6 +91,43 @@ The body is then interpreted as a markdown-like language:
  * Triple backtick lines toggle wrapping on and off (for code samples).
  * Markdown-style hash headers are supported, but underline ones are not.
 
+JOURNAL LAYOUT
+--------------
+
+Entries are stored as files named after the time they were made, e.g.
+`20170101_120000-xxxxxxxx`, and that name is the entry's id.
+
+By default, all entries are in the journal directory itself. With the sharded
+layout, they are kept in a directory for each month, e.g. `2017/01/`, which
+keeps directories small and lets time filters skip the months outside of
+their range. `j migrate` converts a journal to the sharded layout in place,
+and `j migrate --flat` converts it back. Both layouts, or a mixture of the
+two, can always be read.
+
+`j pack` moves old entries out of their files and into a single append-only
+pack file, '%s', which saves on inodes and makes backups quicker. Packed
+entries are shown, filtered and edited as usual. Editing one moves it back
+out into a file of its own, and a file always wins over a packed copy of the
+same entry.
+
+`j new --stdin` adds an entry, in the format above, read from stdin rather
+than written in the editor. `j import` adds many at once from newline
+delimited JSON, one object per line, as output by `j show --jsonl`: "title"
+is required, and "body", "tags", "time" (e.g. "2017-01-01 12:00:00"),
+"immortal" and "wrap" are optional. The time defaults to now. Either all
+of the entries are added, or, if any is invalid, none are.
+
+`j export -o FILE` writes the entries matching the same filters as `j show`
+to an archive: a tar file, a zip file or newline-delimited JSON, as chosen
+by the file's suffix (%s) or --format. `j import --archive FILE` restores
+the entries in such an archive, keeping their ids.
+
+`j daemon` keeps the journal loaded, listening on the socket '%s' in
+the journal directory, and `j show` and `j tags` are then answered by it
+rather than starting from scratch. Changes made with j are seen at once;
+entries edited by other means are noticed within a few seconds. If the daemon
+isn't running, j works as usual.
+
 TIME FORMATS
 ------------
 
@@ -67,6 +147,31 @@ drawn from `{M,h,d,w,m,y}` for minutes, hours, days, weeks, months or years
 before now. If `start` is omitted, then the start time is the distant past. If
 `end` is omitted, then the end time is the distant future.
 
+QUERIES
+-------
+
+`j show --query` and `j export --query` take an expression combining any of:
+
+    @tag            entries with the tag (or `tag:"a tag"`)
+    word            entries containing the text (or `"some words"`, or
+                    `term:word`), case insensitively unless --case-sensitive
+    when:TIME       entries in the time range, in the time format above,
+                    e.g. `when:2017:2018` or `when:"2017-01-01 12"`
+    id:ID           the entry with the id
+
+with `and`, `or`, `not` and parentheses, e.g.
+
+    j show -q '(@work or @home) and not "to do" and when:1m'
+
+`and` binds tighter than `or`, and may be left out, so `@a @b` is the same as
+`@a and @b`. As with --when, immortal entries are in every time range. The
+query must match as well as the other filters.
+
+Whatever order the query is written in, times and ids are checked first, as
+they are in the file names, then tags, and only then is the text of the
+entries searched, and the index is used to rule out entries that can't match.
+`j show --explain` shows the plan for a query and how each step fared.
+
 CONFIGURATION
 -------------
 
@@ -97,6 +202,39 @@ are available:
     J_JOURNAL_DIR
         The directory in which to store journal entries. This is required.
 
+    J_JOURNAL_JOBS
+        The number of threads used to load and filter entries, which can help
+        on network file systems and cold caches. Set to 0 to use one thread
+        per CPU. The default is 1, which loads entries one at a time.
+
+    J_JOURNAL_NO_DAEMON
+        Set to answer every command in-process, even when `j daemon` is
+        running.
+
+    J_JOURNAL_NO_INDEX
+        Set to disable the on-disk meta-data index. By default j caches the
+        title, time and attributes of each entry in '%s' in the
+        journal directory so that unchanged entries needn't be re-parsed. The
+        index is checked against each file's modification time and size, and
+        is rebuilt if missing or corrupt. The index and the render cache are
+        each kept with an empty '-journal' file, SQLite's rollback journal, so
+        that writing them doesn't change the journal directory. Like all of
+        j's files, their names start with '.j-', so file synchronisers can be
+        told to skip them.
+
+    J_JOURNAL_PROFILE
+        Set to 1 to print a table of the time spent in each stage of the run
+        (scanning, parsing, filtering, formatting, writing, ...) to stderr
+        when j exits. Set to a file name to write the stages to that file as
+        a Chrome trace-event JSON document instead, for chrome://tracing or
+        Perfetto.
+
+    J_JOURNAL_RENDER_CACHE_SIZE
+        The maximum size, in bytes, of the cache of wrapped entry bodies kept
+        in '%s' in the journal directory. The least
+        recently used bodies are evicted when the cache is full. Set to 0 to
+        disable the cache. The default is %d.
+
     J_JOURNAL_TIME
         The default time filter. See TIME FORMATS for syntax.
 
@@ -113,7 +251,10 @@ are available:
     PAGER
         The pager command used to scroll entries. If unset, defaults to
         '%s'.
-""" % (DEFAULT_WRAP_COL, DEFAULT_EDITOR, DEFAULT_PAGER)
+""" % (PACK_FILENAME, ", ".join("." + f for f in EXPORT_FORMATS),
+       DAEMON_SOCKET, INDEX_FILENAME, RENDER_CACHE_FILENAME,
+       DEFAULT_RENDER_CACHE_SIZE, DEFAULT_WRAP_COL, DEFAULT_EDITOR,
+       DEFAULT_PAGER)
 
 
 def print_err(msg, newline=True):
@@ -123,6 +264,103 @@ def print_err(msg, newline=True):
     sys.stderr.flush()
 
 
+class Profile:
+    """
+    Records the wall clock time spent in each stage of a run (scanning the
+    directory, parsing entries, filtering, formatting, ...), and the number of
+    times each stage was entered, for J_JOURNAL_PROFILE.
+
+    Stages are timed with `with PROFILE.stage(name): ...`. They may be
+    entered from several threads at once, and may nest, in which case the
+    time of the inner stage is counted in both.
+    """
+
+    def __init__(self, trace=False):
+        import threading
+        self.start = time.perf_counter_ns()
+        self.stats = {}  # stage name -> [count, total ns]
+        self.events = [] if trace else None  # (name, start, end, thread id)
+        self.lock = threading.Lock()
+        self._thread_id = threading.get_ident
+
+    def stage(self, name):
+        return _ProfileStage(self, name)
+
+    def add(self, name, start, end):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0]
+            stat[0] += 1
+            stat[1] += end - start
+            if self.events is not None:
+                self.events.append((name, start, end, self._thread_id()))
+
+    def table(self):
+        """Returns a summary of the stages as a printable table."""
+
+        wall = time.perf_counter_ns() - self.start
+        lines = ["%-16s %10s %12s %12s %7s" % ("stage", "count", "total ms",
+                                               "mean us", "% wall")]
+        for name, (count, total) in sorted(self.stats.items(),
+                                           key=lambda kv: -kv[1][1]):
+            lines.append("%-16s %10d %12.3f %12.3f %7.1f" % (
+                name, count, total / 1e6, total / count / 1e3,
+                100.0 * total / wall if wall else 0))
+        lines.append("%-16s %10s %12.3f" % ("(wall)", "", wall / 1e6))
+        return "\n".join(lines)
+
+    def trace(self):
+        """
+        Returns the recorded stages as a Chrome trace-event document (as
+        loaded by chrome://tracing and Perfetto), with times in microseconds
+        from the start of the run.
+        """
+
+        pid = os.getpid()
+        events = [{"name": name, "cat": "j", "ph": "X", "pid": pid,
+                   "tid": tid, "ts": (start - self.start) / 1e3,
+                   "dur": (end - start) / 1e3}
+                  for name, start, end, tid in self.events or []]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+class _ProfileStage:
+    __slots__ = ("profile", "name", "start")
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc):
+        self.profile.add(self.name, self.start, time.perf_counter_ns())
+
+
+class NullProfile:
+    """A `Profile` that records nothing, used unless profiling is on."""
+
+    class _Stage:
+        __slots__ = ()
+
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *exc):
+            pass
+
+    _STAGE = _Stage()
+
+    def stage(self, name):
+        return NullProfile._STAGE
+
+
+# Where the stages of a run are timed. Replaced by a `Profile` when profiling.
+PROFILE = NullProfile()
+
+
 class Colours(dict):
     # ANSI colour sequences for:
     KEYS = [
@@ -192,14 +430,256 @@ class Colours(dict):
         return self.reset_seq
 
 
+def ident_time(ident):
+    """
+    Decode the time of an entry from its identifier (file name).
+
+    Entry file names start `YYYYmmdd_HHMMSS-`. This is decoded by hand as
+    `datetime.strptime()` is comparatively slow and scans call this for every
+    file in the journal.
+    """
+
+    if _is_std_ident(ident):
+        return datetime(int(ident[0:4]), int(ident[4:6]), int(ident[6:8]),
+                        int(ident[9:11]), int(ident[11:13]),
+                        int(ident[13:15]))
+    return datetime.strptime(ident.split("-")[0], TIME_FORMAT)
+
+
+def ident_time_key(ident):
+    """
+    Returns a string that sorts entry identifiers (file names) by time. The
+    key has the same `YYYYmmdd_HHMMSS` shape as produced by `time_key()`.
+    """
+
+    if _is_std_ident(ident):
+        return ident[:15]
+    return time_key(ident_time(ident))
+
+
+def time_key(dt):
+    """Format a datetime as a key comparable with `ident_time_key()`."""
+
+    return "%04d%02d%02d_%02d%02d%02d" % (dt.year, dt.month, dt.day, dt.hour,
+                                          dt.minute, dt.second)
+
+
+def _is_std_ident(ident):
+    return len(ident) > 15 and ident[8] == "_" and ident[15] == "-" and \
+        ident[:15].isascii() and ident[:8].isdigit() and \
+        ident[9:15].isdigit()
+
+
+def shard_of(ident):
+    """Returns the shard directory of an entry, e.g. "2017/01", relative to
+    the journal directory."""
+
+    key = ident_time_key(ident)
+    return os.path.join(key[:4], key[4:6])
+
+
+def _is_shard_name(name, width):
+    return len(name) == width and name.isascii() and name.isdigit()
+
+
+def _file_stamp(path):
+    """Returns something that changes when the file at `path` does, or None
+    if there is no such file."""
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def entry_text(title, body=None, tags=(), immortal=False, wrap=True):
+    """
+    Returns the contents of an entry's file for the given fields, as `Entry`
+    would parse them. Raises `ParseError` if they can't be represented.
+    """
+
+    if not isinstance(title, str) or "\n" in title or not title.strip():
+        raise ParseError("the title must be a single line of text")
+    if body is not None and not isinstance(body, str):
+        raise ParseError("the body must be text")
+    if not isinstance(tags, (list, tuple)) or \
+            not all(isinstance(tag, str) for tag in tags):
+        raise ParseError("the tags must be a list of text")
+    attrs = []
+    for tag in tags:
+        tag = tag[1:] if tag.startswith("@") else tag
+        if not tag or any(c.isspace() for c in tag):
+            raise ParseError("invalid tag: '%s'" % tag)
+        attrs.append("@" + tag)
+    if immortal:
+        attrs.append("immortal")
+    if not wrap:
+        attrs.append("nowrap")
+
+    text = title + "\n"
+    if attrs:
+        text += " ".join(attrs) + "\n"
+    if body:
+        text += "\n" + body
+    return text
+
+
+def read_ndjson_entries(fh, name, ids=False):
+    """
+    Yields a `(text, time)` pair, as for `Journal.add_entries()`, for each
+    line of newline delimited JSON read from the file `fh`, called `name`.
+    Blank lines are skipped. Raises `ParseError` for a line that isn't a
+    valid entry. If `ids` is true, yields `(id, text)` pairs instead, with
+    the id from the "id" field that `j export` writes.
+    """
+
+    import json
+    for num, line in enumerate(fh, 1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+            if not isinstance(obj, dict):
+                raise ParseError("expected an object")
+            when = obj.get("time")
+            if when is not None:
+                try:
+                    when = datetime.fromisoformat(when)
+                except (TypeError, ValueError):
+                    raise ParseError("invalid time: %s" % when)
+            text = entry_text(obj.get("title"), obj.get("body"),
+                              obj.get("tags") or (),
+                              bool(obj.get("immortal")),
+                              bool(obj.get("wrap", True)))
+            if ids and not isinstance(obj.get("id"), str):
+                raise ParseError("no entry id")
+        except (ValueError, ParseError) as e:
+            raise ParseError("%s, line %d: %s" % (name, num, e))
+        yield (obj["id"], text) if ids else (text, when)
+
+
+def read_archive(fh, name):
+    """
+    Yields a `(name, data)` pair, as for `Journal.restore_entries()`, for
+    each entry in the archive made by `Journal.export()` that is open as the
+    seekable binary file `fh`, called `name`. The kind of archive is worked
+    out from its contents. Dotfiles and directories in tar and zip archives
+    are skipped, and entries are taken by file name wherever they are.
+    """
+
+    import tarfile
+    import zipfile
+    if zipfile.is_zipfile(fh):
+        fh.seek(0)
+        with zipfile.ZipFile(fh) as zf:
+            for info in zf.infolist():
+                base = os.path.basename(info.filename)
+                if not info.is_dir() and not base.startswith("."):
+                    yield base, zf.read(info)
+        return
+    fh.seek(0)
+    if tarfile.is_tarfile(fh):
+        fh.seek(0)
+        with tarfile.open(fileobj=fh, mode="r:*") as tf:
+            for info in tf:
+                base = os.path.basename(info.name)
+                if info.isfile() and not base.startswith("."):
+                    yield base, tf.extractfile(info).read()
+        return
+
+    import gzip
+    import io
+    fh.seek(0)
+    if fh.read(2) == b"\x1f\x8b":
+        fh.seek(0)
+        fh = gzip.GzipFile(fileobj=fh)
+    else:
+        fh.seek(0)
+    encoding = sys.getdefaultencoding()
+    text_fh = io.TextIOWrapper(fh, encoding="utf-8")
+    try:
+        for ident, text in read_ndjson_entries(text_fh, name, ids=True):
+            yield ident, text.encode(encoding)
+    finally:
+        text_fh.detach()  # rather than close `fh`
+
+
+def _tar_header(name, size, mtime):
+    """
+    Returns the tar header of a file `name` of `size` bytes, modified at
+    `mtime`, as `TarFile` would write it, which takes several times as long.
+    """
+
+    bname = name.encode("utf-8", "surrogateescape")
+    if len(bname) > 100:
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o600
+        return info.tobuf(tarfile.GNU_FORMAT)
+    header = b"".join([
+        bname.ljust(100, b"\0"),
+        b"0000600\0",  # mode
+        b"0000000\0" * 2,  # uid, gid
+        b"%011o\0" % size,
+        b"%011o\0" % mtime,
+        b" " * 8,  # the checksum, as it is summed
+        b"0",  # a regular file
+        bytes(100),  # link name
+        b"ustar\x0000",
+        bytes(247),  # owner, group, devices, prefix and padding
+    ])
+    chksum = b"%06o\0 " % sum(header)
+    return header[:148] + chksum + header[156:]
+
+
+def _file_digest(path):
+    """Returns a digest of the contents of the file at `path`."""
+
+    import hashlib
+    with open(path, "rb") as fh:
+        return hashlib.sha1(fh.read()).digest()
+
+
 class FilterSettings:
     def __init__(self, tag_filters=None, textual_filters=None,
-                 time_filter=None, id_filters=None, case_sensitive=False):
+                 time_filter=None, id_filters=None, case_sensitive=False,
+                 limit=None, before=None, after=None, query=None):
         self.tag_filters = tag_filters
         self.textual_filters = textual_filters
         self.case_sensitive = case_sensitive
         self.time_filter = time_filter
         self.id_filters = id_filters
+        # A `Query`, which must match as well as the filters above
+        self.query = query
+        # Pagination. `before` and `after` are entry ids (which needn't exist)
+        # and `limit` is the maximum number of entries to select.
+        self.limit = limit
+        self.before = before
+        self.after = after
+
+    def pages_forwards(self):
+        """
+        Returns True if pages of at most `limit` entries are taken from the
+        `after` cursor forwards in time, rather than backwards from the
+        `before` cursor (or the newest entry).
+        """
+
+        return bool(self.limit and self.after and not self.before)
+
+    def next_cursor(self, idents):
+        """
+        Given the ids of a page of selected entries, newest first, returns
+        the cursor for the next page, or None if there are no more pages.
+        """
+
+        if not self.limit or len(idents) < self.limit:
+            return None
+        if self.pages_forwards():
+            return idents[0]
+        return idents[-1]
 
 
 class TimeFilterException(Exception):
@@ -286,6 +766,21 @@ class TimeFilter:
             else:
                 raise TimeFilterException("bogus time spec element")
 
+    def key_range(self):
+        """
+        Returns the filter's bounds as an inclusive `(start, stop)` pair of
+        `time_key()` strings, for comparison with `ident_time_key()`.
+        """
+
+        start = self.start
+        if start.microsecond:
+            # Entry times have whole seconds, so round the start up.
+            try:
+                start += timedelta(microseconds=1000000 - start.microsecond)
+            except OverflowError:
+                start = datetime.max
+        return time_key(start), time_key(self.stop)
+
     def matches(self, entry):
         if not self.start:
             assert not self.stop
@@ -303,75 +798,520 @@ class TimeFilter:
             return False
 
 
+class QueryException(Exception):
+    pass
+
+
+# A token of a query expression: a parenthesis, a (possibly `prefix:`ed)
+# double quoted string, or a bare word
+QUERY_TOKEN_RE = re.compile(
+    r'\s*(?:([()])|((?:[^\s()"]+:)?"(?:[^"\\]|\\.)*")|([^\s()"]+))')
+
+
+class Query:
+    """
+    A node of a query expression (see QUERIES in the help). `op` is "and",
+    "or" or "not", with the nodes they combine as `args`, or a predicate on
+    a single entry: "id", "tag" or "term", whose one arg is a string, or
+    "time", whose args are a `TimeFilter` and the time format it came from.
+    """
+
+    # The relative cost of checking each predicate: on the file name, then
+    # the meta-data, then the body
+    COSTS = {"id": 0, "time": 1, "tag": 2, "term": 3}
+
+    # Predicates that may be written as `prefix:arg`
+    PREFIXES = {"id": "id", "when": "time", "tag": "tag", "term": "term"}
+
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+
+    @staticmethod
+    def parse(text):
+        """Parse the query expression `text`. Raises `QueryException` if it
+        is malformed."""
+
+        tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = QUERY_TOKEN_RE.match(text, pos)
+            if not m or m.end() == pos:
+                raise QueryException("unbalanced quotes")
+            pos = m.end()
+            paren, quoted, word = m.groups()
+            if quoted is not None:
+                # Quoted words are terms, unless they have a prefix
+                prefix, _, quoted = quoted.partition('"')
+                quoted = re.sub(r"\\(.)", r"\1", quoted[:-1])
+                tokens.append(("word", prefix + quoted, not prefix))
+            else:
+                tokens.append(("paren", paren, False) if paren else
+                              ("word", word, False))
+        tokens.reverse()  # so they can be popped in order
+
+        def peek_op():
+            if tokens and tokens[-1][0] == "word" and not tokens[-1][2]:
+                return tokens[-1][1].lower()
+            return None
+
+        def parse_or():
+            args = [parse_and()]
+            while peek_op() == "or":
+                tokens.pop()
+                args.append(parse_and())
+            return args[0] if len(args) == 1 else Query("or", *args)
+
+        def parse_and():
+            args = [parse_not()]
+            while tokens and tokens[-1] != ("paren", ")", False) and \
+                    peek_op() != "or":
+                if peek_op() == "and":
+                    tokens.pop()
+                args.append(parse_not())
+            return args[0] if len(args) == 1 else Query("and", *args)
+
+        def parse_not():
+            if not tokens:
+                raise QueryException("unexpected end of query")
+            if peek_op() == "not":
+                tokens.pop()
+                return Query("not", parse_not())
+            kind, value, quoted = tokens.pop()
+            if kind == "paren":
+                if value == ")":
+                    raise QueryException("unexpected ')'")
+                node = parse_or()
+                if not tokens or tokens.pop() != ("paren", ")", False):
+                    raise QueryException("missing ')'")
+                return node
+            if not quoted and value.lower() in ("and", "or"):
+                raise QueryException("unexpected '%s'" % value)
+            return Query._predicate(value, quoted)
+
+        if not tokens:
+            raise QueryException("empty query")
+        query = parse_or()
+        if tokens:
+            raise QueryException("unexpected '%s'" % tokens[-1][1])
+        return query
+
+    @staticmethod
+    def _predicate(word, quoted):
+        prefix, colon, arg = word.partition(":")
+        op = Query.PREFIXES.get(prefix) if colon and not quoted else None
+        if op is None:
+            if word.startswith("@") and not quoted:
+                op, arg = "tag", word[1:]
+            else:
+                op, arg = "term", word
+        if not arg:
+            raise QueryException("nothing to match in '%s'" % word)
+        if op == "time":
+            try:
+                return Query(op, TimeFilter.from_arg(arg), arg)
+            except TimeFilterException as e:
+                raise QueryException("invalid time '%s': %s" % (arg, e))
+        return Query(op, arg)
+
+    def cost(self):
+        """The cost of the most expensive predicate in the node."""
+
+        if self.op in Query.COSTS:
+            return Query.COSTS[self.op]
+        return max((a.cost() for a in self.args), default=0)
+
+    def __str__(self):
+        if self.op in ("and", "or"):
+            parts = [("(%s)" if a.op in ("and", "or") else "%s") % a
+                     for a in self.args]
+            return (" %s " % self.op).join(parts)
+        if self.op == "not":
+            arg = self.args[0]
+            return ("not (%s)" if arg.op in ("and", "or") else "not %s") % arg
+        if self.op == "time":
+            return "when:" + _quote_query_word(self.args[1])
+        if self.op == "id":
+            return "id:" + _quote_query_word(self.args[0])
+        if self.op == "tag":
+            word = _quote_query_word(self.args[0])
+            return "@" + word if word == self.args[0] else "tag:" + word
+        word = self.args[0]
+        if word.lower() in ("and", "or", "not") or word.startswith("@") or \
+                ":" in word:
+            return _quote_query_word(word, True)
+        return _quote_query_word(word)
+
+
+def _quote_query_word(word, always=False):
+    if not always and re.fullmatch(r'[^\s()"\\]+', word):
+        return word
+    return '"%s"' % re.sub(r'(["\\])', r"\\\1", word)
+
+
+class _QueryStep:
+    """A node of a `QueryPlan`, with what it found out about the entries."""
+
+    __slots__ = ("op", "arg", "label", "children", "start", "stop",
+                 "candidates", "estimate", "tried", "passed", "ns")
+
+    def __init__(self, query):
+        self.op = query.op
+        self.arg = query.args[0] if query.args else None
+        self.label = str(query) if query.op in Query.COSTS else query.op
+        # Cheap steps first, but otherwise in the order they were written
+        self.children = [_QueryStep(a) for a in sorted(
+            query.args, key=Query.cost)] if query.op in ("and", "or", "not") \
+            else []
+        if query.op == "time":
+            self.start, self.stop = self.arg.key_range()
+        # The names of the indexed entries that may pass, or None if the
+        # index can't tell
+        self.candidates = None
+        self.estimate = None
+        self.tried = self.passed = self.ns = 0
+
+
+class QueryPlan:
+    """
+    How the entries are checked against a `Query`. The steps of each "and"
+    and "or" are reordered so that those on the file name (ids, times) are
+    tried before those on the meta-data (tags), and those on the meta-data
+    before those that read the body (terms), and the index is used to rule
+    out entries that can't match before any step is tried.
+
+    If `timed`, the number of entries tried and passed by each step, and
+    the time spent in it, are recorded, for `explain()`. This must only be
+    done when entries are checked by one thread at a time.
+    """
+
+    def __init__(self, query, case_sensitive=False, timed=False):
+        self.query = query
+        self.case_sensitive = case_sensitive
+        self.timed = timed
+        self.root = _QueryStep(query)
+        self.scanned = 0
+        self.pruned = 0  # by the index
+
+    @staticmethod
+    def from_filters(filters, timed=False):
+        """Make the plan for all of `filters`: its query, and its ids, time,
+        tags and terms, which must all match too."""
+
+        args = []
+        if filters.id_filters:
+            ids = [Query("id", i) for i in filters.id_filters]
+            args.append(ids[0] if len(ids) == 1 else Query("or", *ids))
+        tf = filters.time_filter
+        if tf and not (tf.start == datetime.min and tf.stop == datetime.max):
+            args.append(Query("time", tf, "%s:%s" % tf.key_range()))
+        args += [Query("tag", t) for t in filters.tag_filters or []]
+        args += [Query("term", t) for t in filters.textual_filters or []]
+        if filters.query:
+            args.append(filters.query)
+        # Nothing to check is an "and" of nothing, which everything passes
+        query = args[0] if len(args) == 1 else Query("and", *args)
+        return QueryPlan(query, filters.case_sensitive, timed)
+
+    def key_range(self):
+        """Returns an inclusive `(start, stop)` pair of keys outside of which
+        only immortal entries can match, or None if there isn't one."""
+
+        def key_range(step):
+            if step.op == "time":
+                return step.start, step.stop
+            ranges = [key_range(c) for c in step.children]
+            if step.op == "and" and any(ranges):
+                ranges = [r for r in ranges if r]
+                return (max(r[0] for r in ranges), min(r[1] for r in ranges))
+            if step.op == "or" and ranges and all(ranges):
+                return (min(r[0] for r in ranges), max(r[1] for r in ranges))
+            return None
+        return key_range(self.root)
+
+    def ids(self):
+        """Returns the set of entry ids outside of which nothing can match,
+        or None if there isn't one."""
+
+        def ids(step):
+            if step.op == "id":
+                return {step.arg}
+            sets = [ids(c) for c in step.children]
+            if step.op == "and" and any(s is not None for s in sets):
+                return set.intersection(*[s for s in sets if s is not None])
+            if step.op == "or" and sets and all(s is not None for s in sets):
+                return set.union(*sets)
+            return None
+        return ids(self.root)
+
+    def prepare(self, index, scanned):
+        """
+        Ask `index` (which may be None) which entries may pass each step, and
+        estimate how many of the `_scan()` triples `scanned` will pass each.
+
+        Terms under a "not" aren't looked up, as the index can only say which
+        entries may have a term, so it can't rule entries out for them, and
+        looking a term up can take longer than searching the few entries that
+        get as far as it.
+        """
+
+        self.scanned = total = len(scanned)
+        names = None
+
+        def prepare(step, negated=False):
+            nonlocal names
+            for c in step.children:
+                prepare(c, negated or step.op == "not")
+            sets = [c.candidates for c in step.children]
+            estimates = [c.estimate for c in step.children]
+            if step.op == "id":
+                if names is None:
+                    names = set(fname for _, fname, _ in scanned)
+                step.estimate = int(step.arg in names)
+            elif step.op == "time":
+                step.estimate = sum(1 for s in scanned
+                                    if step.start <= s[0] <= step.stop)
+            elif step.op == "tag" and index:
+                step.candidates = index.tagged([step.arg])
+            elif step.op == "term" and index and not negated:
+                step.candidates = index.text_candidates([step.arg],
+                                                        self.case_sensitive)
+            elif step.op == "and":
+                known = [s for s in sets if s is not None]
+                if known:
+                    step.candidates = set.intersection(*known)
+                known = [e for e in estimates if e is not None]
+                step.estimate = min(known, default=None if step.children
+                                    else total)
+            elif step.op == "or":
+                if sets and all(s is not None for s in sets):
+                    step.candidates = set.union(*sets)
+                if all(e is not None for e in estimates):
+                    step.estimate = min(total, sum(estimates))
+            elif step.op == "not" and estimates[0] is not None:
+                step.estimate = total - estimates[0]
+            if step.candidates is not None:
+                step.estimate = len(step.candidates) if step.estimate is None \
+                    else min(step.estimate, len(step.candidates))
+        prepare(self.root)
+
+    def matches(self, key, fname, meta, indexed, load):
+        """
+        Does the entry with key `key` and file name `fname` match? `meta` is
+        its `Entry` or index record, which is `indexed` if it is covered by
+        the index's answers to `prepare()`, and `load()` returns its `Entry`,
+        for the body.
+        """
+
+        if indexed and self.root.candidates is not None and \
+                fname not in self.root.candidates:
+            if self.timed:
+                self.pruned += 1
+            return False
+        return self._try(self.root, key, fname, meta, indexed, load)
+
+    def _try(self, step, *entry):
+        if not self.timed:
+            return self._check(step, *entry)
+        step.tried += 1
+        start = time.perf_counter_ns()
+        passed = self._check(step, *entry)
+        step.ns += time.perf_counter_ns() - start
+        step.passed += passed
+        return passed
+
+    def _check(self, step, key, fname, meta, indexed, load):
+        op = step.op
+        if op == "and":
+            return all(self._try(c, key, fname, meta, indexed, load)
+                       for c in step.children)
+        if op == "or":
+            return any(self._try(c, key, fname, meta, indexed, load)
+                       for c in step.children)
+        if op == "not":
+            return not self._try(step.children[0], key, fname, meta, indexed,
+                                 load)
+        if op == "id":
+            return fname == step.arg
+        if op == "time":
+            # Immortal entries pass any time, as with --when
+            return step.start <= key <= step.stop or meta.immortal
+        if op == "tag":
+            return step.arg in meta.tags
+        if indexed and step.candidates is not None and \
+                fname not in step.candidates:
+            return False
+        return load().matches_all_text([step.arg], self.case_sensitive)
+
+    def explain(self):
+        """Returns the plan, and how each step fared, as printable lines."""
+
+        lines = ["%-40s %9s %9s %9s %10s" % ("step", "estimate", "tried",
+                                            "passed", "ms")]
+
+        def explain(step, depth):
+            label = "  " * depth + step.label
+            if len(label) > 40:
+                label = label[:37] + "..."
+            lines.append("%-40s %9s %9d %9d %10.3f" % (
+                label, "?" if step.estimate is None else step.estimate,
+                step.tried, step.passed, step.ns / 1e6))
+            for c in step.children:
+                explain(c, depth + 1)
+        explain(self.root, 0)
+        return lines
+
+
 class ParseError(Exception):
     pass
 
 
 class Entry:
-    def __init__(self, path, meta_only=False):
+    # Scans can hold tens of thousands of entries, so keep them small
+    __slots__ = ("path", "title", "_time", "_body", "_body_loaded", "tags",
+                 "immortal", "wrap", "pack")
+
+    # Files at least this big are memory mapped for textual searches
+    MMAP_SIZE = 64 * 1024
+
+    def __init__(self, path, meta_only=False, parse=True, pack=None):
+        """
+        Load the entry at `path`. If `meta_only` is true, only the header is
+        read and the body is read on first access to `body`. If `pack` is
+        given, the entry is read from that `Pack` rather than from `path`.
+        """
+
         self.path = path
+        self.pack = pack
         self.title = None
-        self.time = None
-        self.body = None
+        self._time = None
+        self._body = None
+        self._body_loaded = False
         self.tags = set()
         self.immortal = False
         self.wrap = True
-        self.parse(meta_only)
+        if parse:
+            self.parse(meta_only)
 
-    def ident(self):
-        return os.path.basename(self.path)
+    @classmethod
+    def from_meta(cls, path, title, tags, immortal, wrap, pack=None):
+        """Make an entry from previously parsed meta-data, without reading the
+        file. The body is read on first access to `body`."""
 
-    def parse(self, meta_only=False):
-        logging.debug("parsing '%s'" % self.path)
-        # Get the time from the file path first
-        tstr = os.path.basename(self.path).split("-")[0]
-        self.time = datetime.strptime(tstr, TIME_FORMAT)
+        entry = cls(path, parse=False, pack=pack)
+        entry.title = title
+        entry.tags = set(tags)
+        entry.immortal = immortal
+        entry.wrap = wrap
+        return entry
 
-        with open(self.path) as fh:
-            lines = iter(fh.readlines())
+    @property
+    def time(self):
+        """The time of the entry, decoded from its file name when needed."""
 
-            # Required title line
-            try:
-                self.title = lines.__next__().strip()
-                if self.title.strip() == "":
-                    raise ParseError("whitespace title")
-            except StopIteration:
-                raise ParseError("unexpected end of file")
+        if self._time is None:
+            self._time = ident_time(os.path.basename(self.path))
+        return self._time
 
-            # Attribute line or EOF
-            try:
-                attr_line = lines.__next__().strip()
-            except StopIteration:
-                return
+    @time.setter
+    def time(self, time):
+        self._time = time
 
-            if attr_line != "":
-                attrs = attr_line.split(" ")
-                for attr in attrs:
-                    if attr.startswith("@"):
-                        self.tags.add(attr[1:])
-                    elif attr == "immortal":
-                        self.immortal = True
-                    elif attr == "nowrap":
-                        self.wrap = False
-                    else:
-                        raise ParseError("unknown attribute %s" % attr)
+    @property
+    def body(self):
+        """The body text, or None if the entry has no body."""
 
-                # Now expect a blank line or EOF
-                try:
-                    blank_line = lines.__next__().strip()
-                    if blank_line != "":
-                        raise ParseError("expected blank line after header")
-                except StopIteration:
-                    return
-            else:
-                pass  # blank attr line serves as the body separator
+        self.load_body()
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+        self._body_loaded = True
+
+    def load_body(self):
+        """Read the body, if it hasn't been read already."""
+
+        if not self._body_loaded:
+            self.parse()
+
+    def ident(self):
+        return os.path.basename(self.path)
 
+    def open(self, binary=False):
+        """Open the entry's file, or its contents in the pack, for reading."""
+
+        if self.pack is not None:
+            return self.pack.open_entry(self.ident(), binary)
+        return open(self.path, "rb" if binary else "r")
+
+    def parse(self, meta_only=False):
+        logging.debug("parsing '%s'" % self.path)
+        self._time = None  # decoded from the file path when needed
+        self.tags = set()
+        self.immortal = False
+        self.wrap = True
+        self.body = None
+
+        # The header is read line by line so that, if `meta_only` is set,
+        # reading stops at the end of the header.
+        with PROFILE.stage("open"):
+            fh = self.open()
+        with fh:
+            with PROFILE.stage("parse"):
+                more = self._parse_header(fh)
+            if not more:
+                return
             if meta_only:
+                self._body_loaded = False
                 return
+            with PROFILE.stage("read"):
+                self.body = fh.read()
+
+    def _parse_header(self, fh):
+        """
+        Parse the header from the start of the file `fh`, leaving `fh` at the
+        start of the body. Returns False if the file ends with the header.
+        """
+
+        # Required title line
+        line = fh.readline()
+        if not line:
+            raise ParseError("unexpected end of file")
+        self.title = line.strip()
+        if self.title == "":
+            raise ParseError("whitespace title")
+
+        # Attribute line or EOF
+        line = fh.readline()
+        if not line:
+            return False
+        attr_line = line.strip()
+
+        if attr_line != "":
+            attrs = attr_line.split(" ")
+            for attr in attrs:
+                if attr.startswith("@"):
+                    self.tags.add(sys.intern(attr[1:]))
+                elif attr == "immortal":
+                    self.immortal = True
+                elif attr == "nowrap":
+                    self.wrap = False
+                else:
+                    raise ParseError("unknown attribute %s" % attr)
 
-            self.body = "".join(lines)
+            # Now expect a blank line or EOF
+            line = fh.readline()
+            if not line:
+                return False
+            if line.strip() != "":
+                raise ParseError("expected blank line after header")
+        else:
+            pass  # blank attr line serves as the body separator
+        return True
 
-    def format(self, wrap_col, colours=None):
+    def format(self, wrap_col, colours=None, with_body=True, cache=None):
         if not colours:
             colours = Colours()  # default colours (i.e. none)
 
@@ -392,24 +1332,28 @@ class Entry:
             headers.append("%s%s%s" % (colours["attrs"], attr_line,
                                        colours.reset()))
         rec = "\n".join(headers)
-        if self.body:
+        if with_body and self.body:
             # ANSI colours reset at EOL, so we have to mark up each line
             rec += "\n\n"
             if not self.wrap:
                 wrap_col = -1
 
-            for line in format_body(self.body, wrap_col):
+            if cache:
+                lines = cache.format_body(self.body, wrap_col)
+            else:
+                lines = format_body(self.body, wrap_col)
+            for line in lines:
                 rec += ("%s%s%s\n" % (colours["body"], line, colours.reset()))
         return rec
 
-    def as_dict(self):
+    def as_dict(self, with_body=True):
         """Return the entries attributes as a dict (used for JSON encoding)"""
 
         return {
             "path": self.path,
             "title": self.title,
             "time": str(self.time),
-            "body": self.body,
+            "body": self.body if with_body else None,
             "tags": list(self.tags),
         }
 
@@ -417,180 +1361,2720 @@ class Entry:
         return tag in self.tags
 
     def matches_text(self, text, case_sensitive=False):
-        with open(self.path) as fh:
-            contents = fh.read()
-            if not case_sensitive:
-                contents = contents.lower()
-                text = text.lower()
-            return text in contents
+        return self.matches_all_text([text], case_sensitive)
 
-    def matches_ids(self, ids):
-        return os.path.basename(self.path) in ids
+    def matches_all_text(self, terms, case_sensitive=False):
+        """
+        Does the entry's file contain all of the textual search `terms`?
 
+        The file is searched as bytes, memory mapped if it is large, for all
+        of the terms at once, stopping as soon as each has been seen. Case is
+        ignored without making a lowercased copy of the file. Terms that
+        can't be searched for as bytes are searched for in the decoded text.
+        """
 
-class Journal:
-    def __init__(self, directory, colours=None, editor=DEFAULT_EDITOR,
-                 pager=DEFAULT_PAGER, wrap_col=DEFAULT_WRAP_COL):
-        """Makes a journal instance.
+        if not case_sensitive:
+            terms = [t.lower() for t in terms]
+        terms = set(terms)
+        if not _can_search_bytes(terms, case_sensitive):
+            return self._matches_all_text_str(terms, case_sensitive)
 
-        Args:
-          directory (str): path to journal storage directory
-          colours (Colours): A Colours instance or None.
-          pager (str): Pager command and args or None.
-        """
+        if self.pack is not None:
+            found = _search_bytes(self.pack.read(self.ident()), terms,
+                                  case_sensitive)
+        else:
+            found = self._search_file(terms, case_sensitive)
+        if found is None:
+            # The file has characters that lowercase to ASCII letters
+            return self._matches_all_text_str(terms, case_sensitive)
+        return found
+
+    def _search_file(self, terms, case_sensitive):
+        with open(self.path, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size < Entry.MMAP_SIZE:
+                found = _search_bytes(fh.read(), terms, case_sensitive)
+            else:
+                import mmap
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    found = _search_bytes(buf, terms, case_sensitive)
+        return found
 
-        self.directory = directory
-        self.colours = colours
-        self.editor = editor
-        self.pager = pager
-        if not colours:
-            colours = Colours()
-        self.colours = colours
-        self.wrap_col = wrap_col
+    def _matches_all_text_str(self, terms, case_sensitive):
+        with self.open() as fh:
+            contents = fh.read()
+        if not case_sensitive:
+            contents = contents.lower()
+        return all(t in contents for t in terms)
 
-        if not os.path.exists(self.directory):
-            logging.debug("creating '%s'" % self.directory)
-            os.makedirs(self.directory)
-        logging.debug("journal directory is '%s'" % self.directory)
+    def matches_ids(self, ids):
+        return os.path.basename(self.path) in ids
 
-    def _new_entry_create(self, **contents):
-        """Create a new file for a new entry."""
 
-        now = TimeFilter.now()
-        prefix = now.strftime("%s-" % TIME_FORMAT)
-        fd, path = tempfile.mkstemp(prefix=prefix)
-        os.close(fd)
-        return path
+# Files are searched for text this many bytes at a time
+_SEARCH_CHUNK = 64 * 1024
 
-    def _move_entry_in(self, path, existing):
-        basename = os.path.basename(path)
-        new_path = os.path.join(self.directory, basename)
-        if not existing:
-            assert not os.path.exists(new_path)
-        shutil.move(path, new_path)
-        return new_path
+# UTF-8 encodings of the only non-ASCII characters whose lowercase forms have
+# ASCII letters in them: the dotted capital I and the Kelvin sign
+_LOWERS_TO_ASCII = (b"\xc4\xb0", b"\xe2\x84\xaa")
 
-    def new_entry(self):
-        path = self._new_entry_create()
-        self._invoke_editor([path], existing=False)
 
-    def _collect_entries(self, filters=None, bodies=True):
-        if filters is None:
-            filters = FilterSettings()
+@functools.lru_cache(maxsize=None)
+def _text_is_utf8():
+    """Are entry files read as UTF-8?"""
 
-        itr = os.scandir(self.directory)
-        files = filter(lambda x: x.is_file(), itr)
+    import codecs
+    import locale
+    encoding = locale.getpreferredencoding(False)
+    return codecs.lookup(encoding).name == "utf-8"
 
-        entries = []
-        for fl in files:
-                fname = fl.name
 
-                # Skip dotfiles (that may be to do with file synchronisers)
-                if fname.startswith("."):
-                    continue
+def _can_search_bytes(terms, case_sensitive):
+    """
+    Can the textual search `terms` be searched for in an entry's undecoded
+    bytes, with the same result as searching its text?
+    """
 
-                entry = Entry(os.path.join(self.directory, fname),
-                              meta_only=not bodies)
+    if not _text_is_utf8():
+        return False
+    for term in terms:
+        # Newlines are translated when files are read as text
+        if "\n" in term or "\r" in term:
+            return False
+        # Bytes patterns only ignore the case of ASCII letters
+        if not case_sensitive and not term.isascii():
+            return False
+    return True
 
-                # Only add if the time filter matches
-                # XXX invert the relationship between the filter an the entry
-                # like the other filters XXX.
-                if not entry.immortal and filters.time_filter:
-                    if not filters.time_filter.matches(entry):
-                        continue
 
-                # Only add if *all* tag filters match
-                if filters.tag_filters:
-                    matches = [entry.matches_tag(t) for t in
-                               filters.tag_filters]
-                    if not all(matches):
-                        continue
+def _search_bytes(buf, terms, case_sensitive):
+    """
+    Does `buf` (bytes or an mmap of UTF-8 text) contain all of `terms`? If
+    not case sensitive, the `terms` must be lowercase ASCII.
 
-                # Only add if *all* textual filters match
-                if filters.textual_filters:
-                    matches = [
-                        entry.matches_text(
-                            t, case_sensitive=filters.case_sensitive)
-                        for t in filters.textual_filters]
-                    if not all(matches):
-                        continue
-
-                # Only add if the id matches one of the id filters
-                if filters.id_filters:
-                    if not entry.matches_ids(filters.id_filters):
-                        continue
-
-                # Passed all filters
-                entries.append(entry)
-        return sorted(entries, key=lambda e: e.time, reverse=True)
-
-    def show_entries(self, filters=None, bodies=True, output_json=False):
-        if not filters:
-            filters = FilterSettings()
+    `buf` is gone through once, a chunk at a time. Each chunk is checked for
+    the terms not yet seen while it is in the CPU cache, and is lowercased on
+    its own if need be, so the whole file is never copied. The search stops as
+    soon as all of the terms have been seen.
 
-        entries = self._collect_entries(bodies=bodies, filters=filters)
+    Returns None if the answer depends on the non-ASCII characters that
+    lowercase to ASCII, which the caller must check some other way.
+    """
 
-        of = io.StringIO()
-        if not output_json:
-            for e in entries:
-                of.write(e.format(self.wrap_col, self.colours) + "\n")
-        else:
-            dcts = [e.as_dict() for e in entries]
-            of.write(json.dumps({"entries": dcts}, indent=2))
-
-        if entries and self.pager and sys.stdout.isatty():
-            p = subprocess.Popen(self.pager, shell=True, stdin=subprocess.PIPE)
-            sout, serr = p.communicate(
-                of.getvalue().encode(sys.getdefaultencoding()))
-            if p.returncode != 0:
-                print("failed to run '%s'" % self.pager)
-                sys.exit(1)
+    unseen = [t.encode("utf-8") for t in terms]
+    # Chunks overlap, so that terms (and the characters that lowercase to
+    # ASCII) that straddle chunk boundaries are still seen
+    overlap = max([2] + [len(t) - 1 for t in unseen])
+    size = len(buf)
+    pos = 0
+    lowers_to_ascii = False
+    while unseen:
+        if pos == 0 and size <= _SEARCH_CHUNK:
+            chunk = buf
         else:
-            print(of.getvalue())
+            chunk = buf[pos:pos + _SEARCH_CHUNK + overlap]
+        if not case_sensitive:
+            chunk = chunk.lower()
+            if not lowers_to_ascii and not chunk.isascii():
+                lowers_to_ascii = any(c in chunk for c in _LOWERS_TO_ASCII)
+        unseen = [t for t in unseen if t not in chunk]
+        pos += _SEARCH_CHUNK
+        if pos >= size:
+            break
+    if not unseen:
+        return True
+    return None if lowers_to_ascii else False
+
+
+class SQLiteStore:
+    """
+    Base class for the caches that j keeps in SQLite databases.
 
-    def _edit_existing_entries(self, entries):
+    Subclasses provide `SCHEMA` and `SCHEMA_VERSION`. A database that is
+    corrupt or was made with a different schema version is thrown away and
+    recreated. Any database error disables the store for the rest of the run;
+    as the stores are only caches, callers carry on without them.
+    """
+
+    SCHEMA = None
+    SCHEMA_VERSION = None
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def open(self):
         """
-        Edit a list of existing entries using an intermediate location in
-        the temporary directory.
+        Open the database, creating or rebuilding it if it is missing, stale
+        or corrupt.
 
-        Args:
-          entries (list of str): list of existing entries to edit
+        Returns True if the database is usable.
         """
 
-        if len(entries) == 0:
+        global sqlite3
+        if sqlite3 is None:
+            try:
+                import sqlite3
+            except ImportError:  # Python built without sqlite support
+                return False
+        try:
+            self._open()
+        except sqlite3.DatabaseError as e:
+            logging.debug("'%s' unusable (%s), rebuilding" % (self.path, e))
+            self.close()
+            try:
+                os.unlink(self.path)
+                self._open()
+            except (OSError, sqlite3.DatabaseError) as e:
+                logging.debug("can't rebuild '%s': %s" % (self.path, e))
+                self.close()
+                return False
+        return True
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path)
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            if version != 0:
+                # Made by a different version of j. Start afresh.
+                self.conn.close()
+                os.unlink(self.path)
+                self.conn = sqlite3.connect(self.path)
+            logging.debug("creating '%s'" % self.path)
+            self.conn.executescript(self.SCHEMA)
+            self.conn.execute("PRAGMA user_version = %d" %
+                              self.SCHEMA_VERSION)
+        self._load()
+
+    def _load(self):
+        """Read any in-memory state once the database is open."""
+
+        pass
+
+    def _reset(self):
+        """Drop any in-memory state when the database is closed."""
+
+        pass
+
+    def keep_journal_file(self):
+        """
+        Have SQLite truncate its rollback journal at the end of each
+        transaction, rather than delete it, so that writes don't change the
+        directory the database is in.
+        """
+
+        if self.conn:
+            try:
+                self.conn.execute("PRAGMA journal_mode = TRUNCATE")
+            except sqlite3.DatabaseError as e:
+                self._failed(e)
+
+    def commit(self):
+        if self.conn:
+            try:
+                self.conn.commit()
+            except sqlite3.DatabaseError as e:
+                self._failed(e)
+
+    def close(self):
+        if self.conn:
+            try:
+                self.conn.commit()
+                self.conn.close()
+            except sqlite3.DatabaseError as e:
+                logging.debug("failed to close '%s': %s" % (self.path, e))
+        self.conn = None
+        self._reset()
+
+    def _failed(self, e):
+        logging.debug("error in '%s', disabling it: %s" % (self.path, e))
+        try:
+            self.conn.close()
+        except sqlite3.DatabaseError:
+            pass
+        self.conn = None
+        self._reset()
+
+
+class IndexRecord:
+    """
+    The index's record of an entry: its id in the database, the mtime and
+    size of its file when it was parsed, and its meta-data. Tags are interned,
+    so the records of a large journal share a single copy of each tag.
+    """
+
+    __slots__ = ("id", "mtime_ns", "size", "title", "tags", "flags")
+
+    # Bits in `flags`
+    IMMORTAL = 1
+    NOWRAP = 2
+
+    def __init__(self, entry_id, mtime_ns, size, title, tags, immortal, wrap):
+        self.id = entry_id
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.title = title
+        self.tags = tuple(sys.intern(t) for t in tags.split())
+        self.flags = ((IndexRecord.IMMORTAL if immortal else 0) |
+                      (0 if wrap else IndexRecord.NOWRAP))
+
+    @property
+    def immortal(self):
+        return bool(self.flags & IndexRecord.IMMORTAL)
+
+    @property
+    def wrap(self):
+        return not self.flags & IndexRecord.NOWRAP
+
+    def is_current(self, st):
+        """Is the record up to date with a file with `os.stat_result` `st`?"""
+
+        return self.mtime_ns == st.st_mtime_ns and self.size == st.st_size
+
+    def entry(self, path):
+        """Make a body-less `Entry` for the entry at `path` from the record."""
+
+        return Entry.from_meta(path, self.title, self.tags, self.immortal,
+                               self.wrap)
+
+
+class Index(SQLiteStore):
+    """
+    A persistent cache of entry meta-data, kept in an SQLite database in the
+    journal directory.
+
+    Records are keyed by entry file name and remember the modification time
+    and size the file had when it was parsed. A record is only trusted while
+    the file still has that mtime and size, so entries added, edited or
+    deleted behind j's back (e.g. by a file synchroniser) are picked up by the
+    next scan.
+
+    The index also holds an inverted index of the words in each entry, used to
+    narrow down the entries that textual filters need to search. Each posting
+    records whether the word appears in the entry as-is, or in the lowercased
+    entry, or both, so that both case sensitive and insensitive searches can
+    be answered.
+
+    Tags are indexed too. The entries with a given tag are loaded as a bitmap
+    of entry ids, so that requiring several tags is a bitwise AND.
+
+    If the index is unusable, the worst case is a full scan, as if there were
+    no index at all.
+    """
+
+    SCHEMA_VERSION = 5
+
+    SCHEMA = """
+        CREATE TABLE entries (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            tags TEXT NOT NULL,
+            immortal INTEGER NOT NULL,
+            wrap INTEGER NOT NULL
+        );
+        CREATE TABLE tokens (
+            id INTEGER PRIMARY KEY,
+            token TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE postings (
+            token INTEGER NOT NULL,
+            entry INTEGER NOT NULL,
+            variants INTEGER NOT NULL,
+            PRIMARY KEY (token, entry)
+        ) WITHOUT ROWID;
+        CREATE INDEX postings_entry ON postings (entry);
+        CREATE TABLE entry_tags (
+            tag TEXT NOT NULL,
+            entry INTEGER NOT NULL,
+            PRIMARY KEY (tag, entry)
+        ) WITHOUT ROWID;
+        CREATE INDEX entry_tags_entry ON entry_tags (entry);
+        CREATE TABLE meta (
+            key TEXT PRIMARY KEY,
+            value
+        ) WITHOUT ROWID;
+        CREATE TABLE dirs (
+            path TEXT PRIMARY KEY,
+            ino INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    # Bits in `postings.variants`
+    AS_IS = 1
+    LOWERED = 2
+
+    # The number of records written out at once by `store()`
+    BATCH_SIZE = 256
+
+    def __init__(self, path):
+        SQLiteStore.__init__(self, path)
+        self.records = {}
+        self._tokens = None  # token -> id, loaded on demand
+        self._pending = []  # records waiting to be written out
+        # Has a scan of the whole journal been recorded? If not, there may be
+        # entries the index knows nothing about.
+        self.complete = False
+        # When the last pass that brought every record up to date started,
+        # and the `_file_stamp()`s it found of the directories it scanned,
+        # by their paths relative to the journal directory
+        self.full_pass = None
+        self.dir_stamps = {}
+
+    def _load(self):
+        cur = self.conn.execute("SELECT name, id, mtime_ns, size, title, "
+                                "tags, immortal, wrap FROM entries")
+        self.records = {row[0]: IndexRecord(*row[1:]) for row in cur}
+        self.complete = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'complete'").fetchone() \
+            is not None
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'full_pass'").fetchone()
+        self.full_pass = row[0] if row else None
+        cur = self.conn.execute("SELECT path, ino, mtime_ns, size FROM dirs")
+        self.dir_stamps = {row[0]: tuple(row[1:]) for row in cur}
+
+    def _reset(self):
+        self.records = {}
+        self._tokens = None
+        self._pending = []
+        self.complete = False
+        self.full_pass = None
+        self.dir_stamps = {}
+
+    def lookup(self, path, st=None):
+        """
+        Returns a body-less `Entry` for `path` if the index has an up to date
+        record for it, otherwise None. `st` is the `os.stat_result` of the
+        file. If `st` is None, the record is assumed to be up to date.
+        """
+
+        rec = self.record(os.path.basename(path), st)
+        if rec is None:
+            return None
+        return rec.entry(path)
+
+    def record(self, name, st=None):
+        """
+        Returns the `IndexRecord` for the entry with file name `name` if it is
+        up to date, otherwise None. `st` is as for `lookup()`.
+        """
+
+        rec = self.records.get(name)
+        if rec is None or (st and not rec.is_current(st)):
+            return None
+        return rec
+
+    def store(self, entry, st):
+        """
+        Record the meta-data and words of a freshly parsed entry. `st` is the
+        `os.stat_result` of the file, taken before it was parsed.
+
+        Records are written out in batches, so that the database isn't kept
+        locked in between (e.g. while the pager is waiting for the user).
+        """
+
+        if not self.conn:
+            return
+        rec = (st.st_mtime_ns, st.st_size, entry.title,
+               " ".join(sorted(entry.tags)), int(entry.immortal),
+               int(entry.wrap))
+        self._pending.append((entry.path, set(entry.tags), rec))
+        if len(self._pending) >= Index.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write out and commit any pending records."""
+
+        if not self.conn or not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            with PROFILE.stage("index:write"):
+                for path, tags, rec in pending:
+                    self._write(path, tags, rec)
+                self.conn.commit()
+        except sqlite3.DatabaseError as e:
+            self._failed(e)
+
+    def close(self):
+        self.flush()
+        SQLiteStore.close(self)
+
+    def _write(self, path, tags, rec):
+        try:
+            with open(path) as fh:
+                contents = fh.read()
+        except OSError as e:
+            logging.debug("can't index '%s': %s" % (path, e))
+            return
+
+        name = os.path.basename(path)
+        row = self.conn.execute("SELECT id FROM entries WHERE name = ?",
+                                (name,)).fetchone()
+        if row:
+            entry_id = row[0]
+            self.conn.execute(
+                "UPDATE entries SET mtime_ns = ?, size = ?, title = ?, "
+                "tags = ?, immortal = ?, wrap = ? WHERE id = ?",
+                rec + (entry_id,))
+            self.conn.execute("DELETE FROM postings WHERE entry = ?",
+                              (entry_id,))
+            self.conn.execute("DELETE FROM entry_tags WHERE entry = ?",
+                              (entry_id,))
+        else:
+            entry_id = self.conn.execute(
+                "INSERT INTO entries (name, mtime_ns, size, title, tags, "
+                "immortal, wrap) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name,) + rec).lastrowid
+        self._store_postings(entry_id, contents)
+        self.conn.executemany("INSERT INTO entry_tags VALUES (?, ?)",
+                              [(t, entry_id) for t in tags])
+        self.records[name] = IndexRecord(entry_id, *rec)
+
+    def _store_postings(self, entry_id, contents):
+        variants = {}
+        for tok in TOKEN_RE.findall(contents):
+            variants[tok] = Index.AS_IS
+        for tok in TOKEN_RE.findall(contents.lower()):
+            variants[tok] = variants.get(tok, 0) | Index.LOWERED
+
+        if self._tokens is None:
+            self._tokens = dict(self.conn.execute(
+                "SELECT token, id FROM tokens"))
+        rows = []
+        for tok, bits in variants.items():
+            tok_id = self._tokens.get(tok)
+            if tok_id is None:
+                tok_id = self.conn.execute(
+                    "INSERT INTO tokens (token) VALUES (?)", (tok,)).lastrowid
+                self._tokens[tok] = tok_id
+            rows.append((tok_id, entry_id, bits))
+        self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", rows)
+
+    def text_candidates(self, terms, case_sensitive=False):
+        """
+        Returns the names of the indexed entries that may contain all of the
+        textual search `terms`, or None if the index can't narrow the search
+        down. Only entries with up to date records are covered, and candidates
+        must still be checked against the actual entry text.
+        """
+
+        self.flush()
+        if not self.conn:
+            return None
+        variant = Index.AS_IS if case_sensitive else Index.LOWERED
+
+        candidates = None
+        for term in terms:
+            if not case_sensitive:
+                term = term.lower()
+            for m in TOKEN_RE.finditer(term):
+                word = m.group()
+                # A word at the edge of a term may be part of a longer word in
+                # the entry. Interior words must match a whole word.
+                if m.start() == 0 and m.end() == len(term):
+                    cond, arg = "instr(t.token, ?) > 0", word
+                elif m.start() == 0:
+                    cond, arg = "substr(t.token, -%d) = ?" % len(word), word
+                elif m.end() == len(term):
+                    cond, arg = "substr(t.token, 1, %d) = ?" % len(word), word
+                else:
+                    cond, arg = "t.token = ?", word
+                try:
+                    cur = self.conn.execute(
+                        "SELECT DISTINCT e.name FROM tokens t "
+                        "JOIN postings p ON p.token = t.id "
+                        "JOIN entries e ON e.id = p.entry "
+                        "WHERE %s AND p.variants & ?" % cond, (arg, variant))
+                    names = set(row[0] for row in cur)
+                except sqlite3.DatabaseError as e:
+                    self._failed(e)
+                    return None
+                if candidates is None:
+                    candidates = names
+                else:
+                    candidates &= names
+                if not candidates:
+                    return candidates
+        return candidates
+
+    def tagged(self, tags):
+        """
+        Returns the names of the indexed entries that have all of `tags`, or
+        None if the index is unusable. Only entries with up to date records
+        are covered.
+        """
+
+        self.flush()
+        if not self.conn:
+            return None
+        bitmap = None
+        for tag in tags:
+            try:
+                cur = self.conn.execute(
+                    "SELECT entry FROM entry_tags WHERE tag = ?", (tag,))
+                tag_bitmap = Index._bitmap(row[0] for row in cur)
+            except sqlite3.DatabaseError as e:
+                self._failed(e)
+                return None
+            if bitmap is None:
+                bitmap = tag_bitmap
+            else:
+                bitmap &= tag_bitmap
+            if not bitmap:
+                return set()
+        if bitmap is None:
+            return set(self.records)
+
+        # Entries recorded by another process since the records were loaded
+        # aren't covered
+        names = {rec.id: name for name, rec in self.records.items()}
+        return set(names[i] for i in Index._bitmap_members(bitmap)
+                   if i in names)
+
+    def immortal_names(self):
+        """Returns the names of the entries recorded as immortal."""
+
+        self.flush()
+        return [name for name, rec in self.records.items() if rec.immortal]
+
+    def tag_counts(self):
+        """
+        Returns a list of `(tag, count)` pairs, sorted by tag, or None if the
+        index is unusable.
+        """
+
+        self.flush()
+        if not self.conn:
+            return None
+        try:
+            return self.conn.execute(
+                "SELECT tag, count(*) FROM entry_tags GROUP BY tag "
+                "ORDER BY tag").fetchall()
+        except sqlite3.DatabaseError as e:
+            self._failed(e)
+            return None
+
+    @staticmethod
+    def _bitmap(ids):
+        """Make a bitmap (as an int) from an iterable of entry ids."""
+
+        bits = bytearray()
+        for i in ids:
+            byte = i >> 3
+            if byte >= len(bits):
+                bits.extend(bytes(byte - len(bits) + 1))
+            bits[byte] |= 1 << (i & 7)
+        return int.from_bytes(bits, "little")
+
+    @staticmethod
+    def _bitmap_members(bitmap):
+        """Yields the entry ids in a bitmap made by `_bitmap()`."""
+
+        bits = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+        for byte_idx, byte in enumerate(bits):
+            while byte:
+                low = byte & -byte
+                yield (byte_idx << 3) + low.bit_length() - 1
+                byte ^= low
+
+    def prune(self, names, complete=True):
+        """
+        Forget all records except those named in `names`, the names of all of
+        the entries in the journal. If `complete` is true, all of the entries
+        have been stored, so the index knows of every entry in the journal.
+        """
+
+        self.flush()
+        if not self.conn:
+            return
+        if complete and not self.complete:
+            try:
+                self.conn.execute("INSERT INTO meta VALUES ('complete', 1)")
+            except sqlite3.DatabaseError as e:
+                self._failed(e)
+                return
+            self.complete = True
+        gone = [(n,) for n in self.records if n not in names]
+        if not gone:
+            return
+        logging.debug("removing %d stale index records" % len(gone))
+        try:
+            for (n,) in gone:
+                entry_id = self.records[n].id
+                self.conn.execute("DELETE FROM postings WHERE entry = ?",
+                                  (entry_id,))
+                self.conn.execute("DELETE FROM entry_tags WHERE entry = ?",
+                                  (entry_id,))
+            self.conn.executemany("DELETE FROM entries WHERE name = ?", gone)
+            self.conn.execute("DELETE FROM tokens WHERE id NOT IN "
+                              "(SELECT token FROM postings)")
+        except sqlite3.DatabaseError as e:
+            self._failed(e)
+            return
+        self._tokens = None
+        for (n,) in gone:
+            del self.records[n]
+
+    def record_pass(self, since=None, dir_stamps=None):
+        """
+        Record a pass over the journal. If it brought the records of every
+        entry up to date, `since` is the time it started. If it scanned the
+        journal's directories, `dir_stamps` replaces the `dir_stamps`
+        recorded before.
+        """
+
+        self.flush()
+        if not self.conn:
+            return
+        try:
+            if since is not None:
+                self.conn.execute("INSERT OR REPLACE INTO meta "
+                                  "VALUES ('full_pass', ?)", (since,))
+            if dir_stamps is not None:
+                self.conn.execute("DELETE FROM dirs")
+                self.conn.executemany(
+                    "INSERT INTO dirs VALUES (?, ?, ?, ?)",
+                    [(path,) + stamp for path, stamp in dir_stamps.items()])
+            self.conn.commit()
+        except sqlite3.DatabaseError as e:
+            self._failed(e)
+            return
+        if since is not None:
+            self.full_pass = since
+        if dir_stamps is not None:
+            self.dir_stamps = dict(dir_stamps)
+
+
+class RenderCache(SQLiteStore):
+    """
+    A size-bounded on-disk cache of wrapped entry bodies, kept in an SQLite
+    database in the journal directory.
+
+    Wrapped bodies are keyed by a hash of the body text and the column they
+    were wrapped to. Colours are applied after wrapping, so changing the
+    colour scheme doesn't invalidate the cache. When the cache grows beyond
+    `max_size` bytes, the least recently used bodies are evicted.
+    """
+
+    # Bump this whenever `format_body()` changes its output
+    SCHEMA_VERSION = 1
+
+    SCHEMA = """
+        CREATE TABLE bodies (
+            key TEXT PRIMARY KEY,
+            lines TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            used INTEGER NOT NULL
+        );
+        CREATE INDEX bodies_used ON bodies (used);
+    """
+
+    # The number of new bodies written out at once
+    BATCH_SIZE = 256
+
+    def __init__(self, path, max_size):
+        SQLiteStore.__init__(self, path)
+        self.max_size = max_size
+        self._pending = []  # new bodies waiting to be written out
+        self._hits = {}  # key -> last use, for bodies already in the cache
+
+    def _reset(self):
+        self._pending = []
+        self._hits = {}
+
+    def format_body(self, body, wrap_col):
+        """The same as `format_body()`, but cached."""
+
+        if not self.conn or wrap_col < 0:
+            return format_body(body, wrap_col)  # not worth caching
+
+        import hashlib
+        import json
+        digest = hashlib.sha1(body.encode("utf-8", "surrogatepass"))
+        key = "%s:%d" % (digest.hexdigest(), wrap_col)
+        try:
+            row = self.conn.execute("SELECT lines FROM bodies WHERE key = ?",
+                                    (key,)).fetchone()
+        except sqlite3.DatabaseError as e:
+            self._failed(e)
+            row = None
+        if row:
+            self._hits[key] = time.time_ns()
+            return json.loads(row[0])
+
+        lines = format_body(body, wrap_col)
+        if self.conn:
+            self._pending.append((key, json.dumps(lines)))
+            if len(self._pending) >= RenderCache.BATCH_SIZE:
+                self.flush()
+        return lines
+
+    def flush(self):
+        """Write out and commit any new bodies."""
+
+        if not self.conn or not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        now = time.time_ns()
+        try:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO bodies VALUES (?, ?, ?, ?)",
+                [(k, v, len(k) + len(v), now) for k, v in pending])
+            self.conn.commit()
+        except sqlite3.DatabaseError as e:
+            self._failed(e)
+
+    def close(self):
+        self.flush()
+        if self.conn:
+            try:
+                self.conn.executemany(
+                    "UPDATE bodies SET used = ? WHERE key = ?",
+                    [(v, k) for k, v in self._hits.items()])
+                self._evict()
+            except sqlite3.DatabaseError as e:
+                self._failed(e)
+        SQLiteStore.close(self)
+
+    def _evict(self):
+        total = self.conn.execute("SELECT total(size) FROM bodies").fetchone()
+        if total[0] <= self.max_size:
+            return
+
+        # Evict down to below the limit, so that we don't evict on every run
+        keep = self.max_size * 3 // 4
+        doomed = []
+        cur = self.conn.execute("SELECT key, size FROM bodies "
+                                "ORDER BY used DESC")
+        for key, size in cur:
+            keep -= size
+            if keep < 0:
+                doomed.append((key,))
+        logging.debug("evicting %d bodies from '%s'" %
+                      (len(doomed), self.path))
+        self.conn.executemany("DELETE FROM bodies WHERE key = ?", doomed)
+
+
+class PackRecord:
+    """
+    The pack's record of a packed entry: where its contents are in the pack,
+    and its meta-data, with `flags` as for `IndexRecord`.
+    """
+
+    __slots__ = ("offset", "length", "title", "tags", "flags")
+
+    def __init__(self, offset, length, title, tags, flags):
+        self.offset = offset
+        self.length = length
+        self.title = title
+        self.tags = tuple(sys.intern(t) for t in tags)
+        self.flags = flags
+
+    @property
+    def immortal(self):
+        return bool(self.flags & IndexRecord.IMMORTAL)
+
+    @property
+    def wrap(self):
+        return not self.flags & IndexRecord.NOWRAP
+
+
+class Pack:
+    """
+    An append-only file holding the contents of old entries, so that they
+    needn't each have a file of their own. Made by `j pack`.
+
+    The pack starts with a line naming the format and a random token, and
+    then has two kinds of record:
+
+        + <name> <length>\n<the <length> bytes of the entry's file>\n
+        - <name>\n
+
+    The first adds a packed entry, replacing any earlier one of the same name,
+    and the second (a tombstone) removes one. A record that was only partly
+    written, e.g. if j was killed, is ignored and overwritten by the next
+    append.
+
+    The pack is read through a memory map. The offset and meta-data of each
+    packed entry are kept in a separate index file, so that opening the pack
+    doesn't mean reading all of it. The index holds the pack's token and the
+    length of the pack it covers. If it is for another pack, it is rebuilt
+    from scratch, and records appended since it was written are read from
+    the pack itself.
+    """
+
+    MAGIC = b"j-pack 1 "
+    INDEX_MAGIC = "j-pack-index 1"
+
+    def __init__(self, path, index_path):
+        self.path = path
+        self.index_path = index_path
+        self.records = {}  # name -> PackRecord, for the live entries
+        self.token = None
+        self.size = 0  # the length of the well-formed part of the pack
+        self.dead = 0  # bytes taken by replaced entries and tombstones
+        self.ident = None  # device, inode and size of the mapped pack
+        self._buf = None
+
+    def open(self):
+        """
+        Map the pack and load its index, rebuilding it if need be. Returns
+        False if there is no pack, or it isn't one.
+        """
+
+        import mmap
+        try:
+            with open(self.path, "rb") as fh:
+                st = os.fstat(fh.fileno())
+                if st.st_size == 0:
+                    return False
+                self._buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return False
+        self.ident = (st.st_dev, st.st_ino, st.st_size)
+
+        end = self._buf.find(b"\n")
+        if self._buf[:len(Pack.MAGIC)] != Pack.MAGIC or end < 0:
+            logging.debug("'%s' isn't a pack" % self.path)
+            return False
+        self.token = self._buf[len(Pack.MAGIC):end].decode("ascii")
+
+        with PROFILE.stage("pack:open"):
+            if not self._load_index():
+                logging.debug("rebuilding '%s'" % self.index_path)
+                self.records = {}
+                self.size = end + 1
+                self.dead = 0
+            covered = self.size
+            self._read_from(covered)
+            if self.size != covered or not os.path.exists(self.index_path):
+                self._write_index()
+        return True
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+        self._buf = None
+        self.records = {}
+
+    def is_current(self, st):
+        """Is the mapped pack the file with `os.stat_result` `st`?"""
+
+        return self.ident == (st.st_dev, st.st_ino, st.st_size)
+
+    def read(self, name):
+        """Returns the contents of the packed entry `name`, as bytes."""
+
+        rec = self.records[name]
+        return self._buf[rec.offset:rec.offset + rec.length]
+
+    def open_entry(self, name, binary=False):
+        """Returns a file object for the contents of the packed entry `name`,
+        as for `open()`."""
+
+        import io
+        fh = io.BytesIO(self.read(name))
+        if binary:
+            return fh
+        return io.TextIOWrapper(fh)
+
+    def entry(self, name):
+        """Make a body-less `Entry` for the packed entry `name`. Its path is
+        as if the pack were a directory."""
+
+        rec = self.records[name]
+        return Entry.from_meta(os.path.join(self.path, name), rec.title,
+                               rec.tags, rec.immortal, rec.wrap, self)
+
+    def append(self, items):
+        """
+        Append records to the pack, creating it if need be. `items` yields
+        `(name, data)` pairs, where `data` is the contents of an entry's file
+        to pack, or None to remove the packed entry `name`.
+
+        The pack is synced to disk before the index is updated, so once this
+        returns the packed entries are safe.
+        """
+
+        if self._buf is None:
+            # Never overwrite a file that isn't a pack
+            fh = open(self.path, "xb")
+            self.token = os.urandom(8).hex()
+            header = Pack.MAGIC + self.token.encode("ascii") + b"\n"
+            fh.write(header)
+            self.size = len(header)
+        else:
+            fh = open(self.path, "r+b")
+            fh.truncate(self.size)  # drop any partly written record
+            fh.seek(self.size)
+        with fh:
+            for name, data in items:
+                fname = os.fsencode(name)
+                if data is None:
+                    fh.write(b"- %s\n" % fname)
+                else:
+                    fh.write(b"+ %s %d\n" % (fname, len(data)))
+                    fh.write(data)
+                    fh.write(b"\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._remap()
+
+    def compact(self):
+        """Rewrite the pack without the space taken by replaced entries and
+        tombstones."""
+
+        tmp_path = self.path + ".tmp"
+        token = os.urandom(8).hex()
+        with open(tmp_path, "wb") as fh:
+            fh.write(Pack.MAGIC + token.encode("ascii") + b"\n")
+            for name in sorted(self.records):
+                data = self.read(name)
+                fh.write(b"+ %s %d\n" % (os.fsencode(name), len(data)))
+                fh.write(data)
+                fh.write(b"\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self.path)
+        self._remap()
+
+    def _remap(self):
+        """Map the pack again after appending to it, reading the new records
+        into the index."""
+
+        self.close()
+        if not self.open():
+            raise OSError("can't reopen '%s'" % self.path)
+
+    def _read_from(self, pos):
+        """Read the records from offset `pos` to the end of the pack."""
+
+        import io
+        buf = self._buf
+        end = len(buf)
+        while pos < end:
+            nl = buf.find(b"\n", pos)
+            if nl < 0:
+                break
+            header = buf[pos:nl]
+            if header.startswith(b"- "):
+                self._drop(os.fsdecode(header[2:]))
+                self.dead += nl + 1 - pos
+                pos = nl + 1
+                continue
+            if not header.startswith(b"+ "):
+                break
+            fname, _, length = header[2:].rpartition(b" ")
+            if not length.isdigit():
+                break
+            start = nl + 1
+            stop = start + int(length)
+            if buf[stop:stop + 1] != b"\n":
+                break  # partly written
+            name = os.fsdecode(fname)
+            self._drop(name)
+
+            entry = Entry(os.path.join(self.path, name), parse=False)
+            try:
+                with io.TextIOWrapper(io.BytesIO(buf[start:stop])) as fh:
+                    entry._parse_header(fh)
+            except (ParseError, UnicodeDecodeError) as e:
+                logging.debug("bad packed entry '%s': %s" % (name, e))
+                self.dead += stop + 1 - pos
+            else:
+                flags = ((IndexRecord.IMMORTAL if entry.immortal else 0) |
+                         (0 if entry.wrap else IndexRecord.NOWRAP))
+                self.records[name] = PackRecord(start, stop - start,
+                                                entry.title,
+                                                sorted(entry.tags), flags)
+            pos = stop + 1
+        self.size = pos
+
+    def _drop(self, name):
+        rec = self.records.pop(name, None)
+        if rec is not None:
+            header = b"+ %s %d\n" % (os.fsencode(name), rec.length)
+            self.dead += len(header) + rec.length + 1
+
+    def _load_index(self):
+        """Load the index, returning False if it is missing or isn't for this
+        pack."""
+
+        records = {}
+        try:
+            with open(self.index_path, encoding="utf-8",
+                      errors="surrogateescape") as fh:
+                magic, token, size, dead = \
+                    fh.readline().rstrip("\n").rsplit(" ", 3)
+                size, dead = int(size), int(dead)
+                if magic != Pack.INDEX_MAGIC or token != self.token or \
+                        size > len(self._buf):
+                    return False
+                for line in fh:
+                    name, offset, length, flags, tags, title = \
+                        line.rstrip("\n").split("\t")
+                    records[name] = PackRecord(
+                        int(offset), int(length), _unescape_tabs(title),
+                        _unescape_tabs(tags).split(" ") if tags else (),
+                        int(flags))
+        except (OSError, ValueError) as e:
+            logging.debug("can't load '%s': %s" % (self.index_path, e))
+            return False
+        self.records = records
+        self.size = size
+        self.dead = dead
+        return True
+
+    def _write_index(self):
+        """Write out the index, for the next run. Failure is not fatal."""
+
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8",
+                      errors="surrogateescape") as fh:
+                fh.write("%s %s %d %d\n" % (Pack.INDEX_MAGIC, self.token,
+                                            self.size, self.dead))
+                for name, rec in self.records.items():
+                    fh.write("%s\t%d\t%d\t%d\t%s\t%s\n" % (
+                        name, rec.offset, rec.length, rec.flags,
+                        _escape_tabs(" ".join(rec.tags)),
+                        _escape_tabs(rec.title)))
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logging.debug("can't write '%s': %s" % (self.index_path, e))
+
+
+def _escape_tabs(s):
+    return s.replace("\\", "\\\\").replace("\t", "\\t")
+
+
+def _unescape_tabs(s):
+    if "\\" not in s:
+        return s
+    return re.sub(r"\\(.)",
+                  lambda m: "\t" if m.group(1) == "t" else m.group(1), s)
+
+
+class _TimelineKeys:
+    """The keys of a `Timeline`'s records, as a sequence for `bisect`."""
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+
+    def __len__(self):
+        return self.timeline.count
+
+    def __getitem__(self, i):
+        tl = self.timeline
+        off = tl.start + i * tl.width
+        return tl._buf[off:off + Timeline.KEY_LEN].decode("ascii")
+
+
+class Timeline:
+    """
+    The entries in the journal's directories, sorted by time, so that a time
+    filter can be answered with two binary searches, rather than by scanning
+    the journal and examining every entry. Immortal entries, which pass any
+    time filter, are listed separately. Packed entries aren't included.
+
+    The timeline is a file that starts with a header:
+
+        j-timeline 3 <header length> <record width> <record count> <token>
+        D <inode> <mtime_ns> <size> <directory>
+        I <key> <name> <subdir>
+
+    with a "D" line for each directory that was scanned, and an "I" line for
+    each entry that was immortal. Then come the records, one for each entry,
+    sorted by key and then name. Each is `<key> <name> <subdir>`, padded with
+    spaces to the same width, ending with a newline. The file ends
+    `end <token>`. Directories and subdirs are relative to the journal
+    directory, with "." for the journal directory itself.
+
+    The timeline is only used while none of the directories have changed,
+    which they do when entries are added, removed or renamed. Entries can be
+    edited in place without changing a directory, so the immortal ones are
+    checked against the index, which is kept up to date as set out for
+    FULL_PASS_INTERVAL. The file is read through a memory map, and is only
+    ever replaced, never rewritten in place.
+    """
+
+    MAGIC = b"j-timeline 3 "
+    KEY_LEN = 15
+
+    # A timeline isn't written while a directory has changed within this
+    # many seconds, as another change in the same tick of the file system's
+    # clock wouldn't change its mtime
+    RACY_SECONDS = 2
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, TIMELINE_DIRNAME, "timeline")
+        self.dirs = []  # `(path, stamp)` pairs
+        self.immortals = []  # `_scan()` triples
+        self.count = 0
+        self.width = 0
+        self.start = 0  # the offset of the first record
+        self._buf = None
+
+    def open(self):
+        """
+        Map the timeline. Returns False if there isn't one, it is malformed,
+        or any of the directories have changed since it was written.
+        """
+
+        import mmap
+        try:
+            with open(self.path, "rb") as fh:
+                if os.fstat(fh.fileno()).st_size == 0:
+                    return False
+                self._buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        buf = self._buf
+        try:
+            end = buf.find(b"\n")
+            if buf[:len(Timeline.MAGIC)] != Timeline.MAGIC:
+                raise ValueError("not a timeline")
+            fields = buf[len(Timeline.MAGIC):end].split()
+            self.start, self.width, self.count = (int(f) for f in fields[:3])
+            trailer = b"end " + fields[3] + b"\n"
+            if len(buf) != self.start + self.count * self.width + \
+                    len(trailer) or buf[-len(trailer):] != trailer:
+                raise ValueError("torn")
+            header = buf[end + 1:self.start].decode("utf-8", "surrogateescape")
+            for line in header.splitlines():
+                kind, rest = line.split(" ", 1)
+                if kind == "D":
+                    ino, mtime_ns, size, rel = rest.split(" ", 3)
+                    stamp = (int(ino), int(mtime_ns), int(size))
+                    path = os.path.normpath(os.path.join(self.directory, rel))
+                    if _file_stamp(path) != stamp:
+                        logging.debug("'%s' changed: timeline is stale" % rel)
+                        self.close()
+                        return False
+                    self.dirs.append((path, stamp))
+                elif kind == "I":
+                    self.immortals.append(self._triple(rest))
+        except (ValueError, IndexError) as e:
+            logging.debug("ignoring timeline '%s': %s" % (self.path, e))
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+        self._buf = None
+
+    @staticmethod
+    def _triple(line):
+        key, name, subdir = line.split(" ")
+        return key, name, "" if subdir == "." else subdir
+
+    def between(self, start, stop):
+        """Returns the `_scan()` triples of the entries with keys from
+        `start` to `stop`, inclusive, oldest first."""
+
+        import bisect
+        keys = _TimelineKeys(self)
+        lo = bisect.bisect_left(keys, start)
+        hi = bisect.bisect_right(keys, stop, lo)
+        off = self.start + lo * self.width
+        data = self._buf[off:off + (hi - lo) * self.width]
+        return [self._triple(line.rstrip(" "))
+                for line in data.decode("utf-8", "surrogateescape").split("\n")
+                if line]
+
+    def entries(self):
+        """Returns the `_scan()` triples of all the entries, oldest first."""
+
+        return self.between("", "~")
+
+    def find(self, name):
+        """Returns the `_scan()` triple of the entry `name`, or None if there
+        isn't one."""
+
+        key = ident_time_key(name)
+        return next((item for item in self.between(key, key)
+                     if item[1] == name), None)
+
+    def write(self, dirs, scanned, immortals, since):
+        """
+        Replace the timeline with one of the `_scan()` triples `scanned` and
+        `immortals`, found by a scan started at time `since` of the
+        directories `dirs`, which are `(path, stamp)` pairs with
+        `_file_stamp()`s taken after the scan. Returns False if it wasn't
+        written, as a directory may have changed during the scan, or there is
+        an entry name that can't be written.
+        """
+
+        for _, stamp in dirs:
+            if stamp is None or \
+                    stamp[1] / 1e9 > since - Timeline.RACY_SECONDS:
+                return False
+
+        def line(item):
+            key, name, subdir = item
+            text = "%s %s %s" % (key, name, subdir or ".")
+            if len(key) != Timeline.KEY_LEN or not name.isprintable() or \
+                    " " in name:
+                raise ValueError(name)
+            return text.encode("utf-8", "surrogateescape")
+
+        try:
+            records = [line(item) for item in sorted(scanned)]
+            head = [b"D %d %d %d %s" % (stamp + (os.fsencode(
+                os.path.relpath(path, self.directory)),))
+                for path, stamp in dirs]
+            head += [b"I " + line(item) for item in sorted(immortals)]
+        except ValueError as e:
+            logging.debug("not writing a timeline: can't record '%s'" % e)
+            return False
+        width = max((len(r) for r in records), default=0) + 1
+        token = os.urandom(4).hex().encode("ascii")
+        head = b"".join(h + b"\n" for h in head)
+        # The length of the first line depends on the header length it holds
+        first = b""
+        while True:
+            start = len(first) + len(head)
+            first = Timeline.MAGIC + b"%d %d %d %s\n" % (
+                start, width, len(records), token)
+            if len(first) + len(head) == start:
+                break
+
+        try:
+            os.mkdir(os.path.dirname(self.path))
+            # ...which changed the journal directory
+            return False
+        except FileExistsError:
+            pass
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(first)
+            fh.write(head)
+            for r in records:
+                fh.write(r.ljust(width - 1, b" ") + b"\n")
+            fh.write(b"end " + token + b"\n")
+        os.replace(tmp_path, self.path)
+        return True
+
+
+class Bundle:
+    """
+    A single file holding the contents of many entries, so that they can be
+    edited together with `j e --bundle`, in one buffer.
+
+    Each entry is preceded by a delimiter line naming it:
+
+        === j-<token> <name> ===
+
+    The random token is new for each bundle, so an entry is very unlikely to
+    contain a line that looks like a delimiter. Anything before the first
+    delimiter is a comment, and is ignored.
+    """
+
+    HEADER = (b"# Edit the entries below. Each one starts after a line\n"
+              b"# naming it, like the one that follows. Leave those lines\n"
+              b"# as they are.\n")
+
+    def __init__(self, path):
+        self.path = path
+        self.token = os.urandom(4).hex().encode("ascii")
+
+    def _delimiter(self, name):
+        return b"=== j-%s %s ===\n" % (
+            self.token, name.encode("utf-8", "surrogateescape"))
+
+    def write(self, items):
+        """
+        Write the bundle from `(name, data)` pairs, where `data` is the
+        contents of an entry's file. Returns a dict mapping each name to its
+        contents as written, which always end with a newline.
+        """
+
+        written = {}
+        with open(self.path, "wb") as fh:
+            fh.write(Bundle.HEADER)
+            for name, data in items:
+                if not data.endswith(b"\n"):
+                    data += b"\n"
+                fh.write(self._delimiter(name))
+                fh.write(data)
+                written[name] = data
+        return written
+
+    def read(self):
+        """
+        Split the bundle. Returns a dict mapping each name to the contents
+        found for it, which end with a newline unless empty, and a dict
+        mapping the names that appear more than once to the reason that is a
+        problem. Their contents are run together.
+        """
+
+        delim_re = re.compile(rb"=== j-%s (\S+) ===\r?\n?\Z" % self.token)
+        contents = {}
+        problems = {}
+        lines = None
+        with open(self.path, "rb") as fh:
+            for line in fh:
+                match = delim_re.match(line)
+                if match is None:
+                    if lines is not None:
+                        lines.append(line)
+                    continue
+                name = match.group(1).decode("utf-8", "surrogateescape")
+                if name in contents:
+                    problems[name] = "appears more than once"
+                    lines = contents[name]
+                else:
+                    lines = contents[name] = []
+        for lines in contents.values():
+            if lines and not lines[-1].endswith(b"\n"):
+                lines.append(b"\n")
+        return {n: b"".join(ls) for n, ls in contents.items()}, problems
+
+
+class Journal:
+    def __init__(self, directory, colours=None, editor=DEFAULT_EDITOR,
+                 pager=DEFAULT_PAGER, wrap_col=DEFAULT_WRAP_COL,
+                 use_index=True, jobs=1,
+                 render_cache_size=DEFAULT_RENDER_CACHE_SIZE):
+        """Makes a journal instance.
+
+        Args:
+          directory (str): path to journal storage directory
+          colours (Colours): A Colours instance or None.
+          pager (str): Pager command and args or None.
+          use_index (bool): Cache entry meta-data in an on-disk index.
+          jobs (int): Number of threads used to load and filter entries.
+          render_cache_size (int): Size limit in bytes of the on-disk cache of
+            wrapped entry bodies, or 0 to disable the cache.
+        """
+
+        self.directory = directory
+        self.colours = colours
+        self.editor = editor
+        self.pager = pager
+        if not colours:
+            colours = Colours()
+        self.colours = colours
+        self.wrap_col = wrap_col
+        self.use_index = use_index
+        self.jobs = jobs
+        self.render_cache_size = render_cache_size
+
+        if not os.path.exists(self.directory):
+            logging.debug("creating '%s'" % self.directory)
+            os.makedirs(self.directory)
+        logging.debug("journal directory is '%s'" % self.directory)
+        self.sharded = os.path.exists(
+            os.path.join(self.directory, SHARDED_MARKER))
+        self._pack = None
+
+        # The daemon keeps the index open, and a `Snapshot` of the journal
+        # directory, between queries
+        self.keep_warm = False
+        self._index = None
+        self._index_stamp = None
+        self._snapshot = None
+
+    def _new_entry_create(self, **contents):
+        """Create a new file for a new entry."""
+
+        import tempfile
+        now = TimeFilter.now()
+        prefix = now.strftime("%s-" % TIME_FORMAT)
+        fd, path = tempfile.mkstemp(prefix=prefix)
+        os.close(fd)
+        return path
+
+    def _move_entry_in(self, path, existing):
+        import shutil
+        basename = os.path.basename(path)
+        new_path = None
+        if existing:
+            # Put it back where it was
+            new_path = self._find_entry(basename)
+        if new_path is None:
+            new_path = self._entry_path(basename, self._new_entry_subdir(
+                basename))
+        if not existing:
+            assert not os.path.exists(new_path)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        shutil.move(path, new_path)
+        return new_path
+
+    def _entry_path(self, ident, subdir):
+        """The path of the entry `ident` in the shard directory `subdir`, or
+        in the journal directory itself if `subdir` is empty."""
+
+        return os.path.join(self.directory, subdir, ident)
+
+    def _new_entry_subdir(self, ident):
+        """Where a new entry `ident` goes, as for `_entry_path()`."""
+
+        return shard_of(ident) if self.sharded else ""
+
+    def _find_entry(self, ident):
+        """Returns the path of the entry `ident`, or None if there isn't
+        one."""
+
+        for subdir in "", shard_of(ident):
+            path = self._entry_path(ident, subdir)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def new_entry(self):
+        path = self._new_entry_create()
+        self._invoke_editor([path], existing=False)
+
+    def add_entries(self, items):
+        """
+        Add new entries without running the editor. `items` yields a
+        `(text, time)` pair for each: the contents of its file, and the
+        `datetime` it is named after, or None for now. Returns the paths of
+        the new entries.
+
+        If any entry doesn't parse, `ParseError` is raised, naming it by its
+        number (from 1), and nothing is added. See `_add_staged()`.
+        """
+
+        import tempfile
+
+        def stage(staging):
+            for num, (text, when) in enumerate(items, 1):
+                when = when or TimeFilter.now()
+                prefix = when.strftime("%s-" % TIME_FORMAT)
+                # The random suffix keeps ids made in the same second apart
+                fd, path = tempfile.mkstemp(prefix=prefix, dir=staging)
+                with os.fdopen(fd, "w") as fh:
+                    fh.write(text)
+                yield path, "entry %d" % num
+
+        return self._add_staged(stage)[0]
+
+    def restore_entries(self, items):
+        """
+        Add entries with the ids they had in another journal (e.g. from an
+        archive made by `export()`). `items` yields a `(name, data)` pair for
+        each: its id, and the contents of its file. Entries whose id is
+        already taken are left out. Returns the paths of the entries added
+        and the names of those left out.
+
+        If any entry doesn't parse, or has a bad id, `ParseError` is raised,
+        naming it, and nothing is added. See `_add_staged()`.
+        """
+
+        def stage(staging):
+            for name, data in items:
+                try:
+                    if os.path.basename(name) != name or \
+                            name.startswith("."):
+                        raise ValueError()
+                    ident_time(name)
+                except ValueError:
+                    raise ParseError("invalid entry id: '%s'" % name)
+                path = os.path.join(staging, name)
+                try:
+                    with open(path, "xb") as fh:
+                        fh.write(data)
+                except FileExistsError:
+                    raise ParseError("%s: appears more than once" % name)
+                yield path, name
+
+        return self._add_staged(stage, keep_ids=True)
+
+    def _add_staged(self, stage, keep_ids=False):
+        """
+        Add new entries through a staging directory in the journal, so that
+        moving them into place can't cross file systems. `stage(staging)`
+        writes the entries' files in the directory `staging`, yielding a
+        `(path, what)` pair for each, where `what` names it in errors.
+
+        Each entry is checked by the parser as it is staged. If any doesn't
+        parse, `ParseError` is raised and nothing is added. Otherwise the
+        entries are synced to disk together and then linked into place, which
+        never replaces an existing entry, with the directories they went in
+        synced once each at the end. An entry whose id is taken gets another
+        suffix, or if `keep_ids` is true, is left out.
+
+        Returns the paths of the new entries and the names of those left out.
+        """
+
+        import shutil
+        import tempfile
+        staging = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=self.directory)
+        staged = []
+        paths = []
+        skipped = []
+        try:
+            for path, what in stage(staging):
+                staged.append(path)
+                try:
+                    Entry(path)  # just check it parses
+                except ParseError as e:
+                    raise ParseError("%s: %s" % (what, e))
+
+            with PROFILE.stage("sync"):
+                for path in staged:
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+
+            pack = self._open_pack()
+            dirs = set()
+            for path in staged:
+                new_path = self._link_new_entry(path, pack, keep_ids)
+                if new_path is None:
+                    skipped.append(os.path.basename(path))
+                    continue
+                dirs.add(os.path.dirname(new_path))
+                paths.append(new_path)
+
+            with PROFILE.stage("sync"):
+                for d in dirs:
+                    fd = os.open(d, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+        finally:
+            shutil.rmtree(staging)
+        self._update_index(paths)
+        return paths, skipped
+
+    def _link_new_entry(self, path, pack, keep_id=False):
+        """
+        Put the new entry at `path` in the journal, under its name, or if an
+        entry (in any layout, or in the `Pack` `pack`) already has that name,
+        under the same time with another suffix. Returns its new path, or
+        None if the name was taken and `keep_id` is true.
+        """
+
+        import tempfile
+        while True:
+            name = os.path.basename(path)
+            new_path = self._entry_path(name, self._new_entry_subdir(name))
+            if self._find_entry(name) is None and \
+                    not (pack and name in pack.records):
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                try:
+                    os.link(path, new_path)  # unlike rename, never replaces
+                    return new_path
+                except FileExistsError:
+                    pass  # made by someone else in the meantime
+                except OSError:
+                    os.rename(path, new_path)  # no hard links here
+                    return new_path
+            if keep_id:
+                return None
+            fd, new = tempfile.mkstemp(prefix=name[:16],
+                                       dir=os.path.dirname(path))
+            os.close(fd)
+            os.replace(path, new)
+            path = new
+
+    def _open_pack(self):
+        """Returns the journal's `Pack`, or None if it hasn't got one. The
+        pack is kept open, and reopened if it has changed."""
+
+        path = os.path.join(self.directory, PACK_FILENAME)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._pack = None
+            return None
+        if self._pack is None or not self._pack.is_current(st):
+            pack = Pack(path, os.path.join(self.directory,
+                                           PACK_INDEX_FILENAME))
+            self._pack = pack if pack.open() else None
+        return self._pack
+
+    def _scan_packed(self, pack, names):
+        """Yields `_scan()` triples for the packed entries, except those in
+        `names`, which have files of their own. Their subdir is the pack's
+        file name."""
+
+        for name in pack.records:
+            if name not in names:
+                yield ident_time_key(name), name, PACK_FILENAME
+
+    def _open_timeline(self):
+        """Returns the journal's open `Timeline`, or None if it hasn't got
+        one that is up to date."""
+
+        timeline = Timeline(self.directory)
+        if not os.path.exists(timeline.path) or not timeline.open():
+            return None
+        return timeline
+
+    def _open_index(self):
+        """Returns an open `Index`, or None if the index is disabled or
+        unusable."""
+
+        if not self.use_index:
+            return None
+        path = os.path.join(self.directory, INDEX_FILENAME)
+        if self._index is not None:
+            # Kept warm, but only usable if nothing else has written to it
+            if self._index.conn and self._index_stamp == _file_stamp(path):
+                return self._index
+            self._index.close()
+            self._index = None
+        index = Index(path)
+        with PROFILE.stage("index:open"):
+            if not index.open():
+                return None
+        # Don't upset the daemon's snapshot, or the timeline, which is only
+        # used while the journal directory is unchanged. This leaves an
+        # empty rollback journal beside the index.
+        index.keep_journal_file()
+        if self.keep_warm:
+            self._index = index
+        return index
+
+    def _close_index(self, index):
+        """Close an index from `_open_index()`, or if it is being kept warm,
+        just write it out."""
+
+        if index is not self._index:
+            index.close()
+            return
+        index.flush()
+        index.commit()
+        self._index_stamp = _file_stamp(index.path)
+
+    def close(self):
+        """Close anything kept warm."""
+
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _scan(self, key_range=None, skipped=None, dirs=None, stamps=None):
+        """
+        Yields a `(key, name, subdir)` triple for each entry in the journal,
+        where `key` is the entry's `ident_time_key()` and `subdir` is the
+        shard directory the entry is in (as for `_entry_path()`). No entry
+        files are opened.
+
+        Entries may be in the journal directory itself, or in year/month
+        shard directories (e.g. "2017/01"), or both. If `key_range` is a
+        `(start, stop)` pair of keys, shards that can only hold entries
+        outside the range are skipped, as long as their `_file_stamp()` is
+        the one in the dict `stamps`, which is keyed by subdir. Their subdirs
+        are added to the set `skipped`. If `dirs` is a list, the paths of the
+        directories scanned are appended to it.
+        """
+
+        if dirs is not None:
+            dirs.append(self.directory)
+        with os.scandir(self.directory) as itr:
+            for fl in itr:
+                # Skip dotfiles (that may be to do with file synchronisers)
+                if fl.name.startswith("."):
+                    continue
+                if fl.is_file():
+                    yield ident_time_key(fl.name), fl.name, ""
+                elif _is_shard_name(fl.name, 4) and fl.is_dir():
+                    yield from self._scan_year(fl.name, key_range, skipped,
+                                               dirs, stamps)
+
+    def _scan_year(self, year, key_range, skipped, dirs, stamps):
+        """Does `_scan()` for a year shard directory."""
+
+        year_path = os.path.join(self.directory, year)
+        if dirs is not None:
+            dirs.append(year_path)
+        with os.scandir(year_path) as itr:
+            for fl in itr:
+                if not (_is_shard_name(fl.name, 2) and fl.is_dir()):
+                    continue
+                subdir = os.path.join(year, fl.name)
+                if key_range and not key_range[0][:6] <= year + fl.name <= \
+                        key_range[1][:6] and subdir in stamps and \
+                        stamps[subdir] == _file_stamp(fl.path):
+                    skipped.add(subdir)
+                    continue
+                if dirs is not None:
+                    dirs.append(fl.path)
+                with os.scandir(fl.path) as month_itr:
+                    for ent in month_itr:
+                        if ent.name.startswith(".") or not ent.is_file():
+                            continue
+                        yield ident_time_key(ent.name), ent.name, subdir
+
+    def _scan_entries(self, key_range=None, skipped=None, dirs=None,
+                      stamps=None):
+        """Returns a list of what `_scan()` yields, taken from the daemon's
+        snapshot if there is one."""
+
+        if self._snapshot:
+            return list(self._snapshot.refresh())
+        return list(self._scan(key_range, skipped, dirs, stamps))
+
+    def _record_pass(self, index, files, dirs, since, full):
+        """
+        Record a pass, started at time `since`, over every entry in `index`,
+        which brought all of their records up to date if `full` is true. If
+        the pass scanned the directories `dirs`, finding the `_scan()`
+        triples `files`, their stamps go in the index, and a `Timeline` of
+        them is written.
+        """
+
+        if dirs is None:
+            if full:
+                index.record_pass(since)
+            return
+        dirs = [(d, _file_stamp(d)) for d in dirs]
+        # Stamps taken in the same tick of the file system's clock as a
+        # change may not show it
+        index.record_pass(since if full else None, dict(
+            (os.path.relpath(d, self.directory), stamp) for d, stamp in dirs
+            if stamp and stamp[1] / 1e9 <= since - Timeline.RACY_SECONDS))
+        self._save_timeline(index, files, dirs, since)
+
+    def _save_timeline(self, index, files, dirs, since):
+        """Write a `Timeline` of the `_scan()` triples `files`, which came
+        from a scan started at time `since` of the directories `dirs`, given
+        as `(path, stamp)` pairs, and are up to date in `index`."""
+
+        immortal = set(index.immortal_names())
+        immortals = [item for item in files if item[1] in immortal]
+        with PROFILE.stage("timeline:write"):
+            try:
+                Timeline(self.directory).write(dirs, files, immortals, since)
+            except OSError as e:
+                logging.debug("couldn't write timeline: %s" % e)
+
+    def _stat(self, fname, subdir):
+        """`os.stat()` the entry `fname` in the shard directory `subdir`, or
+        take its stat from the snapshot, if there is one."""
+
+        if self._snapshot:
+            st = self._snapshot.stats.get(fname)
+            if st is not None:
+                return st
+        return os.stat(self._entry_path(fname, subdir))
+
+    def _may_be_immortal(self, index, pack, item, check=True):
+        """Is the entry with `_scan()` triple `item` immortal, as far as its
+        up to date index or pack record can tell? If `check` is false, the
+        index record is trusted without stat()ing the entry."""
+
+        _, fname, subdir = item
+        if subdir == PACK_FILENAME:
+            return pack.records[fname].immortal
+        if not check:
+            rec = index.records.get(fname)
+            return rec is None or rec.immortal
+        try:
+            st = self._stat(fname, subdir)
+        except FileNotFoundError:
+            return False
+        rec = index.record(fname, st)
+        return rec is None or rec.immortal
+
+    def _load_entry(self, index, fname, subdir, meta_only):
+        """
+        Load the entry with file name `fname` in the shard directory `subdir`,
+        from `index` if it has an up to date record.
+
+        Returns `(entry, st)`. If the entry came from the index (in which case
+        it has no body) `st` is None. Otherwise, if there is an index, `st` is
+        the `os.stat_result` with which the caller should store the entry in
+        the index. This doesn't touch the index itself, so it is safe to call
+        from worker threads.
+        """
+
+        path = self._entry_path(fname, subdir)
+        if not index:
+            return Entry(path, meta_only=meta_only), None
+
+        st = self._stat(fname, subdir)
+        entry = index.lookup(path, st)
+        if entry is not None:
+            return entry, None
+        return Entry(path, meta_only=meta_only), st
+
+    def _skipped_immortals(self, index, skipped, names, timeline=None):
+        """
+        Yields `_scan()` triples for the immortal entries that `index` knows
+        of in the `skipped` shard directories, except those in `names`. If
+        the entries were taken from a slice of `timeline`, those that the
+        index or the timeline has as immortal are yielded instead.
+        """
+
+        if timeline:
+            found = list(timeline.immortals)
+            found.extend(timeline.find(n) for n in index.immortal_names())
+        else:
+            found = [(ident_time_key(n), n, shard_of(n))
+                     for n in index.immortal_names()
+                     if shard_of(n) in skipped]
+        for item in found:
+            if item and item[1] not in names:
+                names.add(item[1])
+                yield item
+
+    def _refresh_index(self, index):
+        """
+        Bring `index` up to date with the journal directory, parsing only the
+        entries that are new or have changed. Returns a dict of the paths of
+        the entries, by name.
+        """
+
+        with PROFILE.stage("scan"):
+            scanned = self._scan_entries()
+        paths = {}
+        for _, fname, subdir in scanned:
+            entry, st = self._load_entry(index, fname, subdir, True)
+            paths[fname] = entry.path
+            if st:
+                index.store(entry, st)
+        index.prune(paths)
+        return paths
+
+    def _unpack(self, paths):
+        """Remove the packed copies of the entries now at `paths`, which
+        replace them."""
+
+        pack = self._open_pack()
+        if not pack:
+            return
+        names = [os.path.basename(p) for p in paths]
+        names = [n for n in names if n in pack.records]
+        if names:
+            pack.append((n, None) for n in names)
+
+    def _update_index(self, paths):
+        """Bring the index up to date with the entries at `paths`."""
+
+        index = self._open_index()
+        if not index:
+            return
+        for path in paths:
+            st = os.stat(path)
+            index.store(Entry(path, meta_only=True), st)
+        self._close_index(index)
+
+    def _iter_entries(self, filters=None, bodies=True, plan=None):
+        """
+        Yields the entries matching `filters`, newest first.
+
+        Entries are loaded and filtered by a pool of `self.jobs` threads, but
+        are yielded in the same order as if they were processed one by one.
+
+        If `filters` has a query, or `plan` is given, the entries are checked
+        against a `QueryPlan` (`plan`, or one made from `filters`) rather than
+        the tag, text and time filters one after the other.
+        """
+
+        if filters is None:
+            filters = FilterSettings()
+        if plan is None and filters.query:
+            plan = QueryPlan.from_filters(filters)
+
+        index = self._open_index()
+
+        # The id and time filters, the pagination cursors, and the ordering
+        # are decided from the file names before any entry is opened.
+        key_range = None
+        ranges = []
+        if filters.time_filter:
+            start, stop = filters.time_filter.key_range()
+            ranges.append((start, stop))
+        if plan and plan.key_range():
+            ranges.append(plan.key_range())
+        if ranges:
+            key_range = (max(r[0] for r in ranges), min(r[1] for r in ranges))
+        # Entries outside of the range, in the timeline or in shards, can be
+        # left out, as long as the index knows which of them are immortal: it
+        # must know of every entry, and have checked them lately (see
+        # FULL_PASS_INTERVAL)
+        skip_range = None
+        if key_range and index and index.complete and not self._snapshot and \
+                index.full_pass is not None and \
+                time.time() - index.full_pass < FULL_PASS_INTERVAL:
+            skip_range = key_range
+        skipped = set()
+        pack = self._open_pack()
+        # The timeline stands in for a scan of the directories while they
+        # haven't changed, and can go straight to the entries in time. If
+        # there isn't one, the scan is used to write one.
+        timeline = dirs = files = None
+        if index and not self._snapshot:
+            if index.complete:
+                timeline = self._open_timeline()
+            if not timeline:
+                dirs = []
+        since = time.time()
+        with PROFILE.stage("scan"):
+            if timeline and skip_range:
+                scanned = timeline.between(*skip_range)
+                # The index can't be pruned on only some of the entries
+                skipped.add(TIMELINE_DIRNAME)
+            elif timeline:
+                scanned = timeline.entries()
+            else:
+                scanned = self._scan_entries(skip_range, skipped, dirs,
+                                             index and index.dir_stamps)
+            names = set(fname for _, fname, _ in scanned)
+            if skipped:
+                scanned.extend(self._skipped_immortals(index, skipped, names,
+                                                       timeline))
+            elif dirs is not None:
+                files = list(scanned)
+            if pack:
+                # Entries with files of their own win over packed copies
+                scanned.extend(self._scan_packed(pack, names))
+            scanned.sort(reverse=True)  # newest first
+        if timeline:
+            timeline.close()
+        if filters.before:
+            cursor = (ident_time_key(filters.before), filters.before)
+            scanned = [s for s in scanned if s[:2] < cursor]
+        if filters.after:
+            cursor = (ident_time_key(filters.after), filters.after)
+            scanned = [s for s in scanned if s[:2] > cursor]
+        if index and key_range:
+            # Entries out of time are dropped on their records without being
+            # examined. Unless a full pass is due, the records are trusted as
+            # they are for the entries left out.
+            scanned = [s for s in scanned
+                       if key_range[0] <= s[0] <= key_range[1] or
+                       self._may_be_immortal(index, pack, s,
+                                             check=not skip_range)]
+        plan_ids = plan.ids() if plan else None
+        if plan_ids is not None:
+            scanned = [s for s in scanned if s[1] in plan_ids]
+        if filters.pages_forwards():
+            scanned.reverse()
+
+        candidates = tagged = None
+        if plan:
+            with PROFILE.stage("index:query"):
+                plan.prepare(index, scanned)
+        elif index and (filters.textual_filters or filters.tag_filters):
+            with PROFILE.stage("index:query"):
+                if filters.textual_filters:
+                    candidates = index.text_candidates(
+                        filters.textual_filters, filters.case_sensitive)
+                if filters.tag_filters:
+                    tagged = index.tagged(filters.tag_filters)
+
+        def make_entry(fname, subdir, rec, packed):
+            if packed:
+                return pack.entry(fname)
+            return rec.entry(self._entry_path(fname, subdir))
+
+        def examine(item):
+            """
+            Load and filter a single entry. Returns `(entry, passed, st)`,
+            where `entry` and `st` are as for `_load_entry()`.
+
+            Entries with an up to date index record, and packed entries, are
+            filtered on their record and only made into an `Entry` if they
+            pass, so `entry` is None for those that don't.
+            """
+
+            key, fname, subdir = item
+
+            # Only add if the id matches one of the id filters
+            if filters.id_filters:
+                with PROFILE.stage("filter:id"):
+                    if fname not in filters.id_filters:
+                        return None, False, None
+
+            in_time = not filters.time_filter or start <= key <= stop
+            rec = st = None
+            packed = subdir == PACK_FILENAME
+            if packed:
+                rec = pack.records[fname]
+            elif index:
+                with PROFILE.stage("index:lookup"):
+                    st = self._stat(fname, subdir)
+                    rec = index.record(fname, st)
+            # Is the entry covered by the index's tag and text queries?
+            indexed = rec is not None and not packed
+            if rec is not None:
+                meta, entry, st = rec, None, None
+            else:
+                # Only the header is needed if the entry is out of time, or
+                # may not pass the plan
+                entry = Entry(self._entry_path(fname, subdir),
+                              meta_only=plan is not None or
+                              not (in_time and bodies))
+                meta = entry
+
+            if plan:
+                def load():
+                    nonlocal entry
+                    if entry is None:
+                        entry = make_entry(fname, subdir, rec, packed)
+                    return entry
+                with PROFILE.stage("filter:query"):
+                    if not plan.matches(key, fname, meta, indexed, load):
+                        return None if rec else entry, False, st
+                entry = load()
+                if bodies:
+                    entry.load_body()
+                return entry, True, st
+
+            # Only add if the time filter matches, unless the entry is
+            # immortal
+            if filters.time_filter:
+                with PROFILE.stage("filter:time"):
+                    if not in_time and not meta.immortal:
+                        return entry, False, st
+
+            # Only add if *all* tag filters match
+            if filters.tag_filters:
+                with PROFILE.stage("filter:tag"):
+                    if indexed and tagged is not None:
+                        if fname not in tagged:
+                            return entry, False, st
+                    elif not all(t in meta.tags for t in filters.tag_filters):
+                        return entry, False, st
+
+            # Only add if *all* textual filters match
+            if filters.textual_filters:
+                with PROFILE.stage("filter:text"):
+                    if indexed and candidates is not None and \
+                            fname not in candidates:
+                        return entry, False, st
+                    if entry is None:
+                        entry = make_entry(fname, subdir, rec, packed)
+                    if not entry.matches_all_text(filters.textual_filters,
+                                                  filters.case_sensitive):
+                        return None if rec else entry, False, st
+
+            if entry is None:
+                entry = make_entry(fname, subdir, rec, packed)
+            if bodies:
+                entry.load_body()  # while we are still in a worker
+
+            # Passed all filters
+            return entry, True, st
+
+        try:
+            count = 0
+            page = []  # when paging forwards, yielded newest first below
+            # Will every entry have been looked at, and so be in the index?
+            covered = not (filters.id_filters or filters.before or
+                           filters.after or plan_ids is not None)
+            for entry, passed, st in ordered_map(examine, scanned, self.jobs):
+                if st:
+                    index.store(entry, st)
+                if not passed:
+                    continue
+                if filters.pages_forwards():
+                    page.append(entry)
+                else:
+                    yield entry
+                count += 1
+                if count == filters.limit:
+                    covered = False
+                    break
+            if filters.pages_forwards():
+                yield from reversed(page)
+            if index and not skipped:
+                index.prune(names, complete=covered)
+                if covered:
+                    self._record_pass(index, files, dirs, since,
+                                      full=not skip_range)
+        finally:
+            if index:
+                self._close_index(index)
+
+    def _collect_entries(self, filters=None, bodies=True):
+        return list(self._iter_entries(filters, bodies))
+
+    def explain(self, filters):
+        """
+        Run the `QueryPlan` for `filters` without showing the entries, and
+        return a report on it: the order in which its steps are tried, how
+        many entries the index estimated each would pass, how many it did
+        pass, and where the time went.
+        """
+
+        global PROFILE
+        plan = QueryPlan.from_filters(filters, timed=True)
+        outer_profile, jobs = PROFILE, self.jobs
+        PROFILE = Profile()
+        # One thread at a time, so that each step's time is its own
+        self.jobs = 1
+        try:
+            matched = sum(1 for _ in self._iter_entries(filters, False, plan))
+        finally:
+            profile, PROFILE, self.jobs = PROFILE, outer_profile, jobs
+
+        lines = ["query: %s" % plan.query, ""] + plan.explain() + [""]
+        lines.append("%d entries scanned, %d ruled out by the index, "
+                     "%d matched" % (plan.scanned, plan.pruned, matched))
+        lines += ["", profile.table()]
+        return "\n".join(lines)
+
+    def show_entries(self, filters=None, bodies=True, output_json=False,
+                     output_jsonl=False):
+        if not filters:
+            filters = FilterSettings()
+
+        # Entries are collected, rendered and written out one at a time, so
+        # that output starts as soon as the first entry is ready, and so that
+        # no more work is done if the reader goes away early.
+        itr = self._iter_entries(filters, bodies)
+        cache = None
+        try:
+            # Peek, so as not to start the pager (or open the render cache)
+            # if nothing matched
+            first = next(itr, None)
+            if first and bodies and not (output_json or output_jsonl):
+                cache = self._open_render_cache()
+            entries = itertools.chain([first] if first else [], itr)
+            trailer = "\n"
+            if output_json:
+                chunks = self._render_json(entries, bodies, filters)
+            elif output_jsonl:
+                chunks = self._render_jsonl(entries, bodies)
+                trailer = ""
+            else:
+                chunks = self._render(entries, bodies, cache)
+
+            if first and self.pager and sys.stdout.isatty():
+                self._page(chunks)
+            else:
+                self._write(chunks, trailer)
+        finally:
+            itr.close()
+            if cache:
+                cache.close()
+
+    def _open_render_cache(self):
+        """Returns an open `RenderCache`, or None if the cache is disabled or
+        unusable."""
+
+        if self.render_cache_size <= 0:
+            return None
+        cache = RenderCache(
+            os.path.join(self.directory, RENDER_CACHE_FILENAME),
+            self.render_cache_size)
+        if not cache.open():
+            return None
+        # As for the index
+        cache.keep_journal_file()
+        return cache
+
+    def _render(self, entries, bodies, cache=None):
+        """Yields the formatted text of each entry."""
+
+        for e in entries:
+            with PROFILE.stage("format"):
+                text = e.format(self.wrap_col, self.colours, bodies, cache)
+            yield text + "\n"
+
+    def _render_json(self, entries, bodies, filters):
+        """
+        Yields a JSON document of the entries in pieces. The document is the
+        same as `json.dumps({"entries": [...]}, indent=2)` would make. If
+        `filters` has a limit, a "next" field holds the cursor of the next
+        page.
+        """
+
+        import json
+        import textwrap
+        yield '{\n  "entries": ['
+        sep = "\n"
+        idents = []
+        for e in entries:
+            with PROFILE.stage("json"):
+                dct = json.dumps(e.as_dict(bodies), indent=2)
+                dct = textwrap.indent(dct, "    ")
+            yield sep + dct
+            sep = ",\n"
+            idents.append(e.ident())
+        if sep == "\n":
+            yield "]"  # no entries
+        else:
+            yield "\n  ]"
+        if filters.limit:
+            yield ',\n  "next": %s' % json.dumps(filters.next_cursor(idents))
+        yield "\n}"
+
+    def export(self, fh, fmt, filters=None):
+        """
+        Write the entries matching `filters` to the binary file `fh`, in the
+        archive format `fmt`, one of `EXPORT_FORMATS`, and return how many
+        there were. The archive is written as entries are found, so `fh`
+        needn't be seekable. Tar and zip archives hold each entry's file,
+        named by its id, and the "jsonl" format holds an object like that of
+        `j show --jsonl` for each, with its id, as `j import` reads. Each
+        entry is read once.
+        """
+
+        import gzip
+        if filters is None:
+            filters = FilterSettings()
+
+        count = 0
+        gz = None
+        if fmt.endswith("gz"):
+            gz = fh = gzip.GzipFile(fileobj=fh, mode="wb", mtime=0,
+                                    compresslevel=EXPORT_COMPRESS_LEVEL)
+        if fmt == "jsonl" or fmt == "jsonl.gz":
+            add, close = self._export_jsonl(fh)
+        elif fmt == "zip":
+            add, close = self._export_zip(fh)
+        else:
+            add, close = self._export_tar(fh)
+        # Only JSON needs the entries parsed, which workers can do
+        itr = self._iter_entries(filters, bodies=fmt.startswith("jsonl"))
+        try:
+            for entry in itr:
+                add(entry)
+                count += 1
+        finally:
+            itr.close()
+        close()
+        if gz:
+            gz.close()
+        return count
+
+    def _export_tar(self, fh):
+        """Returns functions to add an entry to a tar archive written to
+        `fh`, and to finish it, for `export()`."""
+
+        def add(entry):
+            with entry.open(binary=True) as efh:
+                data = efh.read()
+            mtime = int(max(entry.time, datetime(1970, 1, 2)).timestamp())
+            fh.write(_tar_header(entry.ident(), len(data), mtime))
+            fh.write(data)
+            fh.write(bytes(-len(data) % 512))
+
+        def close():
+            fh.write(bytes(2 * 512))  # the end of the archive
+
+        return add, close
+
+    def _export_zip(self, fh):
+        """As `_export_tar()`, but for a zip archive."""
+
+        import zipfile
+        zf = zipfile.ZipFile(fh, "w", zipfile.ZIP_DEFLATED,
+                             compresslevel=EXPORT_COMPRESS_LEVEL)
+
+        def add(entry):
+            with entry.open(binary=True) as efh:
+                data = efh.read()
+            # Zip can't record times before 1980
+            when = max(entry.time, datetime(1980, 1, 1))
+            info = zipfile.ZipInfo(entry.ident(), when.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, data)
+
+        return add, zf.close
+
+    def _export_jsonl(self, fh):
+        """As `_export_tar()`, but for newline-delimited JSON."""
+
+        import json
+
+        def add(entry):
+            obj = entry.as_dict()
+            del obj["path"]
+            obj.update(id=entry.ident(), immortal=entry.immortal,
+                       wrap=entry.wrap)
+            fh.write(json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+            fh.write(b"\n")
+
+        return add, lambda: None
+
+    def _render_jsonl(self, entries, bodies):
+        """Yields newline-delimited JSON: one compact object per entry."""
+
+        import json
+        for e in entries:
+            with PROFILE.stage("json"):
+                line = json.dumps(e.as_dict(bodies), separators=(",", ":"))
+            yield line + "\n"
+
+    def _page(self, chunks):
+        """Write the text pieces in `chunks` into the pager."""
+
+        import subprocess
+        p = subprocess.Popen(self.pager, shell=True, stdin=subprocess.PIPE)
+        try:
+            for chunk in chunks:
+                with PROFILE.stage("pager"):
+                    p.stdin.write(chunk.encode(sys.getdefaultencoding()))
+                    p.stdin.flush()
+            p.stdin.close()
+        except BrokenPipeError:
+            # The user quit the pager early. Close the pipe now, dropping
+            # what is left in its buffer, so that the interpreter doesn't
+            # complain when it tries to flush it at exit.
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+        p.wait()
+        if p.returncode != 0:
+            print("failed to run '%s'" % self.pager)
+            sys.exit(1)
+
+    def _write(self, chunks, trailer="\n"):
+        """Write the text pieces in `chunks`, then `trailer`, to stdout."""
+
+        try:
+            for chunk in chunks:
+                with PROFILE.stage("write"):
+                    sys.stdout.write(chunk)
+            sys.stdout.write(trailer)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The reader went away (e.g. `j | head`). Point stdout at
+            # /dev/null so that the interpreter doesn't complain at exit.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+
+    def _edit_existing_entries(self, entries):
+        """
+        Edit a list of existing entries using an intermediate location in
+        the temporary directory.
+
+        Args:
+          entries (list of str): list of existing entries to edit
+        """
+
+        if len(entries) == 0:
             return
 
+        import shutil
+        import tempfile
+        tmp_dir = tempfile.gettempdir()
         tmp_paths = []
+        originals = {}
         for ent in entries:
             path = ent.path
             basename = os.path.basename(path)
-            tmp_path = os.path.join(TMP, basename)
-            shutil.copyfile(path, tmp_path)
+            tmp_path = os.path.join(tmp_dir, basename)
+            if ent.pack is not None:
+                with open(tmp_path, "wb") as fh:
+                    fh.write(ent.pack.read(basename))
+            else:
+                shutil.copyfile(path, tmp_path)
             tmp_paths.append(tmp_path)
-        self._invoke_editor(tmp_paths, existing=True)
+            originals[tmp_path] = path, _file_digest(tmp_path)
+        self._invoke_editor(tmp_paths, existing=True, originals=originals)
+
+    def _edit_bundle(self, entries):
+        """
+        Edit existing entries in a single `Bundle` file, then split it and
+        move back the entries that were changed, as `_invoke_editor()` does
+        for separate files.
+        """
+
+        if len(entries) == 0:
+            return
+        import subprocess
+        import tempfile
+        tmp_dir = tempfile.gettempdir()
+        fd, bundle_path = tempfile.mkstemp(prefix="j-bundle-", suffix=".txt")
+        os.close(fd)
+        bundle = Bundle(bundle_path)
+        paths = {}
+        items = []
+        for ent in entries:
+            paths[ent.ident()] = ent.path
+            with ent.open(binary=True) as fh:
+                items.append((ent.ident(), fh.read()))
+        originals = bundle.write(items)
+
+        while True:
+            subprocess.check_call([self.editor, bundle.path])
+
+            edited, problems = bundle.read()
+            # Sections for names that aren't being edited are ignored, and
+            # aren't carried over into a retry
+            unknown = [n for n in edited if n not in originals]
+            for name in unknown:
+                edited.pop(name)
+                problems.pop(name, None)
+            if unknown:
+                print("Ignoring %d sections not naming an entry being "
+                      "edited:" % len(unknown))
+                for name in unknown:
+                    print("  %s" % name)
+            # Without its delimiter line, an entry's text is run into the
+            # section before it, which mustn't be written over with both
+            missing = [n for n in originals if n not in edited]
+            changed = [n for n in edited if edited[n] != originals[n]]
+            if missing and changed:
+                for name in missing:
+                    problems[name] = "its delimiter line is missing"
+                for name in changed:
+                    problems.setdefault(name, "may hold the text of an entry "
+                                              "whose delimiter line is "
+                                              "missing")
+            moved_paths = []
+            for name, orig in originals.items():
+                if name in problems:
+                    print("[!] %s" % paths[name])
+                    continue
+                # An entry taken out of the bundle is left as it was
+                data = edited.get(name, orig)
+                if data == orig:
+                    print("[-] %s" % paths[name])
+                    continue
+                tmp_path = os.path.join(tmp_dir, name)
+                with open(tmp_path, "wb") as fh:
+                    fh.write(data)
+                try:
+                    Entry(tmp_path)  # just check it parses
+                except ParseError as e:
+                    os.unlink(tmp_path)
+                    problems[name] = str(e)
+                    print("[!] %s" % paths[name])
+                else:
+                    new_path = self._move_entry_in(tmp_path, True)
+                    moved_paths.append(new_path)
+                    print("[E] %s" % new_path)
+            self._update_index(moved_paths)
+            self._unpack(moved_paths)
+            if not problems:
+                os.unlink(bundle.path)
+                break  # all is well
+            print("\nError! %d entries failed to parse:" % len(problems))
+            for name, reason in problems.items():
+                print("  %s: %s" % (name, reason))
+
+            # Only the entries with problems are edited again
+            print("\nPress enter to try again")
+            bundle.write((n, edited.get(n, originals[n])) for n in originals
+                         if n in problems)
+            originals = dict((n, originals[n]) for n in problems)
+            try:
+                input()
+            except KeyboardInterrupt:
+                print("\nTemporary bundle retained:")
+                print(" + %s" % bundle.path)
+                return
 
-    def edit_entry(self, ident):
+    def edit_entry(self, ident, bundle=False):
+        pack = self._open_pack()
         if ident is None:
-            # Edit the last entry.
-            entries = self._collect_entries(FilterSettings(), bodies=False)
-            path = entries[0].path
+            # Edit the last entry, which we can find from the file names.
+            scanned = list(self._scan())
+            if pack:
+                names = set(fname for _, fname, _ in scanned)
+                scanned.extend(self._scan_packed(pack, names))
+            newest = max(scanned, default=None)
+            if newest is None:
+                print("The journal is empty")
+                sys.exit(1)
+            ident = newest[1]
+        path = self._find_entry(ident)
+        if path is None and pack and ident in pack.records:
+            entry = pack.entry(ident)
+        else:
+            entry = Entry(path or self._entry_path(ident, ""))
+        if bundle:
+            self._edit_bundle([entry])
+        else:
+            self._edit_existing_entries([entry])
+
+    def edit_tag(self, tag, bundle=False):
+        entries = None
+        index = self._open_index()
+        if index:
+            # Resolve the tag from the index, and the pack, without opening
+            # any entries
+            paths = self._refresh_index(index)
+            names = index.tagged([tag])
+            if names is not None:
+                entries = [index.lookup(paths[n]) for n in names]
+                pack = self._open_pack()
+                if pack:
+                    entries.extend(pack.entry(n)
+                                   for n, rec in pack.records.items()
+                                   if tag in rec.tags and n not in paths)
+                entries.sort(key=lambda e: (ident_time_key(e.ident()),
+                                            e.ident()), reverse=True)
+            self._close_index(index)
+        if entries is None:
+            filters = FilterSettings(tag_filters=[tag])
+            entries = self._collect_entries(filters, bodies=False)
+        if bundle:
+            self._edit_bundle(entries)
         else:
-            path = os.path.join(self.directory, ident)
-        entry = Entry(path)
-        self._edit_existing_entries([entry])
+            self._edit_existing_entries(entries)
+
+    def migrate(self, sharded=True):
+        """
+        Convert the journal, in place, to the year/month sharded layout, or
+        back to the flat layout if `sharded` is false. Entries keep their
+        ids, and are moved with `os.rename()`, so the index stays valid. If
+        interrupted, it is safe to run again.
+        """
+
+        marker = os.path.join(self.directory, SHARDED_MARKER)
+        # Set the layout first, so that new entries go in the right place
+        # even if the migration doesn't finish
+        if sharded:
+            open(marker, "a").close()
+        elif os.path.exists(marker):
+            os.unlink(marker)
+        self.sharded = sharded
+
+        moved = 0
+        for _, name, subdir in self._scan():
+            new_subdir = self._new_entry_subdir(name)
+            if subdir == new_subdir:
+                continue
+            new_path = self._entry_path(name, new_subdir)
+            if os.path.exists(new_path):
+                print_err("not moving '%s': '%s' exists" % (name, new_path))
+                continue
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(self._entry_path(name, subdir), new_path)
+            moved += 1
+            self._remove_empty_shard(subdir)
+        print("Moved %d entries to the %s layout" % (
+            moved, "sharded" if sharded else "flat"))
+
+    def _remove_empty_shard(self, subdir):
+        """Remove the shard directory `subdir`, and its year directory, if
+        they are empty."""
+
+        if subdir:
+            for d in subdir, os.path.dirname(subdir):
+                try:
+                    os.rmdir(os.path.join(self.directory, d))
+                except OSError:
+                    break  # not empty
+
+    def pack(self, before):
+        """
+        Move the entries made before the datetime `before` out of their files
+        and into the journal's pack. They are still shown, filtered and
+        edited as usual, and editing one moves it back out into a file.
+
+        Each entry's file is only removed once the pack has been synced to
+        disk, and if it hasn't changed in the meantime. If interrupted, it is
+        safe to run again.
+        """
 
-    def edit_tag(self, tag):
-        filters = FilterSettings(tag_filters=[tag])
-        entries = self._collect_entries(filters, bodies=False)
-        self._edit_existing_entries(entries)
+        stop = time_key(before)
+        pack = self._open_pack()
+        pack_path = os.path.join(self.directory, PACK_FILENAME)
+        if pack is None and os.path.exists(pack_path):
+            print_err("'%s' isn't a pack. Not packing." % pack_path)
+            sys.exit(1)
+        if pack is None:
+            pack = Pack(pack_path, os.path.join(self.directory,
+                                                PACK_INDEX_FILENAME))
+
+        packing = []  # (path, subdir, st) of the entries to remove
+
+        def contents():
+            for key, name, subdir in sorted(self._scan()):
+                if key >= stop:
+                    break
+                path = self._entry_path(name, subdir)
+                if not name.isprintable():
+                    print_err("not packing '%s': bad file name" % path)
+                    continue
+                st = os.stat(path)
+                with open(path, "rb") as fh:
+                    data = fh.read()
+                try:
+                    Entry(path, meta_only=True)  # just check it parses
+                except ParseError as e:
+                    print_err("not packing '%s': %s" % (path, e))
+                    continue
+                packing.append((path, subdir, st))
+                if name in pack.records and pack.read(name) == data:
+                    continue  # packed by an earlier, interrupted, run
+                yield name, data
+
+        items = contents()
+        first = next(items, None)
+        if first:
+            pack.append(itertools.chain([first], items))
+        removed = 0
+        for path, subdir, st in packing:
+            now = os.stat(path)
+            if (now.st_mtime_ns, now.st_size) != (st.st_mtime_ns, st.st_size):
+                print_err("not removing '%s': it changed while packing" %
+                          path)
+                continue
+            os.unlink(path)
+            removed += 1
+            self._remove_empty_shard(subdir)
+        if pack.dead > pack.size // 2:
+            pack.compact()
+        print("Packed %d entries" % removed)
+
+    def show_tags(self):
+        """Print each tag in use, with the number of entries that have it."""
+
+        counts = None
+        index = self._open_index()
+        if index:
+            paths = self._refresh_index(index)
+            counts = index.tag_counts()
+            self._close_index(index)
+            pack = self._open_pack()
+            if counts is not None and pack:
+                tally = dict(counts)
+                for name, rec in pack.records.items():
+                    if name not in paths:
+                        for tag in rec.tags:
+                            tally[tag] = tally.get(tag, 0) + 1
+                counts = sorted(tally.items())
+        if counts is None:
+            tally = {}
+            for entry in self._collect_entries(bodies=False):
+                for tag in entry.tags:
+                    tally[tag] = tally.get(tag, 0) + 1
+            counts = sorted(tally.items())
+
+        for tag, count in counts:
+            print("%6d @%s" % (count, tag))
+
+    def _invoke_editor(self, paths, existing=False, originals=None):
+        """
+        Run the editor on the entries at `paths`, then move them into the
+        journal. `originals` maps the path of a copy of an existing entry to
+        a `(path, digest)` pair, giving where the entry came from and the
+        `_file_digest()` of the copy before editing. Copies that are
+        unchanged are skipped, so the entry is left as it was.
+        """
 
-    def _invoke_editor(self, paths, existing=False):
+        import subprocess
+        if originals is None:
+            originals = {}
         while True:
             args = [self.editor] + paths
             subprocess.check_call(args)
 
             problem_paths = {}
+            moved_paths = []
             for path in paths:
+                orig = originals.get(path)
+                if orig and _file_digest(path) == orig[1]:
+                    os.unlink(path)
+                    print("[-] %s" % orig[0])
+                    continue
                 try:
                     Entry(path)  # just check it parses
                 except ParseError as e:
@@ -598,10 +4082,14 @@ class Journal:
                     print("[!] %s" % path)
                 else:
                     new_path = self._move_entry_in(path, existing)
+                    moved_paths.append(new_path)
                     if existing:
                         print("[E] %s" % new_path)
                     else:
                         print("[N] %s" % new_path)
+            self._update_index(moved_paths)
+            if existing:
+                self._unpack(moved_paths)
             if not problem_paths:
                 break  # all is well
             print("\nError! %d files failed to parse:" % len(problem_paths))
@@ -619,6 +4107,375 @@ class Journal:
                 return
 
 
+class Snapshot:
+    """
+    The entries found by a scan of the journal directory, and the
+    `os.stat_result` of each, kept by the daemon between queries.
+
+    The journal is only scanned again when one of its directories has
+    changed, as adding, removing or renaming an entry (which is how j puts
+    edited entries back) changes the directory. Entries edited in place don't
+    change it, so the daemon also forces a `refresh()` every so often.
+    """
+
+    def __init__(self, jrnl):
+        self.jrnl = jrnl
+        self.scanned = []
+        self.stats = {}
+        self._dirs = []
+        self._stamps = None
+
+    def refresh(self, force=False):
+        """Scan the journal again if it has changed, or if `force` is true.
+        Returns the `_scan()` triples of the entries."""
+
+        if not force and self._stamps is not None and \
+                self._stamps == [_file_stamp(d) for d in self._dirs]:
+            return self.scanned
+        dirs = []
+        scanned = []
+        stats = {}
+        for item in self.jrnl._scan(dirs=dirs):
+            _, name, subdir = item
+            try:
+                stats[name] = os.stat(self.jrnl._entry_path(name, subdir))
+            except FileNotFoundError:
+                continue  # gone already
+            scanned.append(item)
+        scanned.sort(reverse=True)  # as it will be wanted
+        self.scanned = scanned
+        self.stats = stats
+        self._dirs = dirs
+        self._stamps = [_file_stamp(d) for d in dirs]
+        return scanned
+
+
+class Daemon:
+    """
+    Serves `show` and `tags` commands for `j` over a Unix domain socket in
+    the journal directory, keeping the index and a `Snapshot` of the journal
+    warm in between, so that each command is quick.
+
+    A request is the client's settings, as `NAME=value` strings, an empty
+    string, and then the command line arguments, each NUL terminated. The
+    client then shuts down its side of the connection. The reply is a series
+    of frames, each a kind (b"o" for stdout, b"e" for stderr or b"x" for the
+    exit status, which comes last), a 4 byte big-endian length and the data.
+
+    Commands are run one at a time, but a client that is slow to send its
+    request, or to read the reply, doesn't hold up the next (see `_Reply`).
+    """
+
+    # The commands a daemon runs. Others change the journal, so are run by
+    # the client.
+    COMMANDS = ("show", "tags")
+
+    # The environment variables that clients send, as they affect output
+    CLIENT_ENV = ("J_JOURNAL_COLOURS", "J_JOURNAL_TIME", "J_JOURNAL_WRAP_COL")
+
+    # Seconds between forced refreshes of the snapshot
+    REFRESH_INTERVAL = 5
+
+    # Seconds to wait for a client to send its request
+    REQUEST_TIMEOUT = 2
+
+    def __init__(self, jrnl):
+        self.jrnl = jrnl
+        self.path = os.path.join(jrnl.directory, DAEMON_SOCKET)
+
+    def run(self):
+        """Serve clients until killed."""
+
+        import signal
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            pass
+        else:
+            print_err("a daemon is already serving '%s'" % self.path)
+            sys.exit(1)
+        sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left by a daemon that died
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)  # only the user may connect
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen()
+        stamp = _file_stamp(self.path)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        jrnl = self.jrnl
+        jrnl.keep_warm = True
+        jrnl._snapshot = Snapshot(jrnl)
+        jrnl._snapshot.refresh()
+        index = jrnl._open_index()
+        if index:
+            jrnl._close_index(index)
+        print("serving '%s'" % self.path)
+        sys.stdout.flush()
+
+        sock.settimeout(Daemon.REFRESH_INTERVAL)
+        refreshed = time.monotonic()
+        try:
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    pass
+                else:
+                    start = time.perf_counter()
+                    reply = self._serve(conn)
+                    if reply is None:
+                        conn.close()
+                    else:
+                        reply.finish()
+                    logging.debug("served a request in %.1f ms" % (
+                        (time.perf_counter() - start) * 1000))
+                if time.monotonic() - refreshed >= Daemon.REFRESH_INTERVAL:
+                    jrnl._snapshot.refresh(force=True)
+                    refreshed = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            if _file_stamp(self.path) == stamp:
+                os.unlink(self.path)
+            jrnl.close()
+
+    def _serve(self, conn):
+        """Run the command sent by a client on the connection `conn`. Returns
+        the `_Reply`, or None if the client didn't send a request."""
+
+        import contextlib
+        import socket
+        conn.settimeout(Daemon.REQUEST_TIMEOUT)
+        request = bytearray()
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                request += data
+        except socket.timeout:
+            logging.debug("gave up waiting for a request")
+            return None
+        except OSError:
+            return None  # the client went away
+        fields = request.decode("utf-8", "surrogateescape").split("\0")[:-1]
+        if "" not in fields:
+            return None  # not a request
+        sep = fields.index("")
+        env = dict(f.split("=", 1) for f in fields[:sep])
+        argv = fields[sep + 1:]
+
+        reply = _Reply(conn)
+        out = _FrameWriter(reply, b"o")
+        err = _FrameWriter(reply, b"e")
+        status = 0
+        try:
+            with contextlib.redirect_stdout(out), \
+                    contextlib.redirect_stderr(err):
+                self._run(env, argv)
+        except SystemExit as e:
+            status = e.code
+            if isinstance(status, str):
+                err.write(status + "\n")
+                status = 1
+        except ConnectionError:
+            return reply  # the client went away
+        except Exception:
+            import traceback
+            err.write(traceback.format_exc())
+            status = 1
+        try:
+            reply.send(b"x", str(status or 0).encode("ascii"))
+        except OSError:
+            pass  # the client went away
+        return reply
+
+    def _run(self, env, argv):
+        """Run the command line `argv` in the client's settings `env`."""
+
+        args = make_arg_parser(argv[0]).parse_args(argv)
+        if getattr(args, "mode", None) not in Daemon.COMMANDS:
+            print_err("the daemon doesn't run '%s'" % argv[0])
+            sys.exit(1)
+        colours = env.get("J_JOURNAL_COLOURS")
+        self.jrnl.colours = Colours.from_str(colours) if colours else \
+            Colours()
+        self.jrnl.wrap_col = int(env.get("J_JOURNAL_WRAP_COL",
+                                         DEFAULT_WRAP_COL))
+        dispatch(self.jrnl, args.mode, args, env.get("J_JOURNAL_TIME"))
+
+
+class _Reply:
+    """
+    A daemon's reply to a client on the connection `conn`, as frames. They
+    are sent as fast as the client takes them, but without waiting for it.
+    What the client hasn't taken once the reply is finished is sent by a
+    thread of its own, so a client that stops reading (e.g. one paging its
+    output) doesn't hold up the others.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._pending = bytearray()
+        conn.setblocking(False)
+
+    def send(self, kind, data):
+        """Send, or queue, a frame of kind `kind` holding `data`."""
+
+        self._pending += _frame(kind, data)
+        while self._pending:
+            try:
+                sent = self.conn.send(self._pending)
+            except BlockingIOError:
+                return
+            del self._pending[:sent]
+
+    def finish(self):
+        """Send what is left, then close the connection."""
+
+        if not self._pending:
+            self.conn.close()
+            return
+        import threading
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    def _drain(self):
+        try:
+            self.conn.setblocking(True)
+            self.conn.sendall(self._pending)
+        except OSError:
+            pass  # the client went away
+        finally:
+            self.conn.close()
+
+
+class _FrameWriter:
+    """A file-like object that sends what is written to it to a daemon's
+    client, in frames of kind `kind` of the `_Reply` `reply`."""
+
+    def __init__(self, reply, kind):
+        self.reply = reply
+        self.kind = kind
+
+    def write(self, s):
+        data = s.encode("utf-8", "surrogateescape")
+        if data:
+            self.reply.send(self.kind, data)
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        # If the client goes away, `Journal._write()` points this at
+        # /dev/null, so that anything more written is dropped
+        return self.reply.conn.fileno()
+
+
+def _frame(kind, data):
+    return kind + len(data).to_bytes(4, "big") + data
+
+
+def forward_to_daemon(jrnl, argv, page=False):
+    """
+    Run the command line `argv` in the daemon serving `jrnl`, if there is
+    one, writing its output as if it had been run here. If `page` is true,
+    the output goes to the pager if stdout is a terminal. Returns the exit
+    status, or None if there is no daemon.
+    """
+
+    path = os.path.join(jrnl.directory, DAEMON_SOCKET)
+    if not os.path.exists(path):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        logging.debug("can't connect to the daemon: %s" % e)
+        sock.close()
+        return None
+
+    fields = ["%s=%s" % (k, os.environ[k]) for k in Daemon.CLIENT_ENV
+              if k in os.environ]
+    fields += [""] + argv
+    request = "".join(f + "\0" for f in fields)
+    status = [1]  # if the daemon goes away part way through
+    with sock:
+        sock.sendall(request.encode("utf-8", "surrogateescape"))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = _read_frames(sock.makefile("rb"), status)
+        first = next(chunks, None)
+        if first is not None:
+            chunks = itertools.chain([first], chunks)
+            # An empty show is just the trailing newline
+            if page and first != "\n" and jrnl.pager and \
+                    sys.stdout.isatty():
+                jrnl._page(chunks)
+            else:
+                jrnl._write(chunks, trailer="")
+    return status[0]
+
+
+def _read_frames(fh, status):
+    """Yields the stdout text sent by a daemon, writing anything it sends
+    for stderr there. The exit status is put in `status[0]`."""
+
+    while True:
+        head = fh.read(5)
+        if len(head) < 5:
+            print_err("the daemon went away")
+            return
+        data = fh.read(int.from_bytes(head[1:], "big"))
+        text = data.decode("utf-8", "surrogateescape")
+        if head[:1] == b"o":
+            yield text
+        elif head[:1] == b"e":
+            print_err(text, newline=False)
+        else:
+            status[0] = int(text)
+            return
+
+
+def ordered_map(fn, items, jobs):
+    """
+    Like `map()`, but with `fn` called from a pool of `jobs` threads. Results
+    are yielded in the order of `items`, and calls run no more than a few
+    items ahead of the consumer. If `fn` raises, the exception is re-raised
+    when the corresponding result is reached.
+    """
+
+    if jobs <= 1:
+        yield from map(fn, items)
+        return
+
+    import concurrent.futures
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        try:
+            for item in items:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= jobs * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+
 def is_a_header_rule(s):
     """
     Decides if a (stripped, non-empty) line is a - or = header.
@@ -636,6 +4493,112 @@ def is_a_header_rule(s):
     return True
 
 
+def wrap_words(words, width):
+    """
+    Greedily wrap a paragraph, given as a list of words (which must not
+    contain whitespace), into lines of at most `width` columns.
+
+    The result is the same as `textwrap.wrap(" ".join(words), width)`, but is
+    computed in a single pass over the words, without `textwrap`'s regular
+    expression splitting for all but hyphenated words.
+    """
+
+    if width <= 0:
+        raise ValueError("invalid width %r (must be > 0)" % width)
+
+    lines = []
+    line = []  # pieces of the current line, including separating spaces
+    line_len = 0
+
+    for word in words:
+        word_len = len(word)
+        if "-" not in word:
+            # The common cases: the word fits on the current line, or starts
+            # the next one.
+            if line_len + 1 + word_len <= width and line:
+                line.append(" ")
+                line.append(word)
+                line_len += 1 + word_len
+                continue
+            if word_len <= width:
+                if line:
+                    lines.append("".join(line))
+                line = [word]
+                line_len = word_len
+                continue
+            atoms = (word,)
+        else:
+            # textwrap may break after hyphens, so split like it does
+            atoms = _split_hyphens(word)
+
+        space = 1  # the first atom of a word needs a space before it
+        for atom in atoms:
+            if not line:
+                space = 0  # spaces at the start of a line are dropped
+            atom_len = len(atom)
+            if line_len + space + atom_len <= width:
+                if space:
+                    line.append(" ")
+                line.append(atom)
+                line_len += space + atom_len
+                space = 0
+                continue
+
+            if atom_len <= width:
+                # Start a new line with this atom
+                if line:
+                    lines.append("".join(line))
+                line = [atom]
+                line_len = atom_len
+                space = 0
+                continue
+
+            # The atom is too long for any line, so break it, starting by
+            # filling what is left of the current line.
+            while atom_len > width:
+                if line and line_len + space <= width:
+                    if space:
+                        line.append(" ")
+                        line_len += 1
+                    end = width - line_len
+                elif line:
+                    # Not even the space fits
+                    lines.append("".join(line))
+                    line = []
+                    line_len = 0
+                    end = width
+                else:
+                    end = width
+                hyphen = atom.rfind("-", 0, end)
+                if hyphen > 0 and atom[:hyphen].strip("-"):
+                    end = hyphen + 1
+                if end:
+                    line.append(atom[:end])
+                lines.append("".join(line))
+                line = []
+                line_len = 0
+                space = 0
+                atom = atom[end:]
+                atom_len = len(atom)
+            if atom:
+                line = [atom]
+                line_len = atom_len
+            space = 0
+
+    if line:
+        lines.append("".join(line))
+    return lines
+
+
+@functools.lru_cache(maxsize=1024)
+def _split_hyphens(word):
+    """Split a word into chunks at the points `textwrap` may break it."""
+
+    import textwrap
+    chunks = textwrap.TextWrapper.wordsep_re.split(word)
+    return tuple(c for c in chunks if c)
+
+
 def format_body(input, col):
     """
     Wrap paragraphs up to column number `col`. A markdown-like syntax is
@@ -649,7 +4612,7 @@ def format_body(input, col):
     if col < 0:
         return input.splitlines()
 
-    para_lines = []  # Buffer up lines to be wrapped here
+    para_words = []  # Buffer up words to be wrapped here
     out_lines = []   # Completed wrapped lines eventually go here
     in_triples = False
     in_list = False
@@ -657,9 +4620,9 @@ def format_body(input, col):
 
     def flush_para(last_para=False):
         nonlocal in_list, newline_on_next
-        if para_lines:
-            out_lines.extend(textwrap.wrap("\n".join(para_lines), col))
-            del para_lines[:]
+        if para_words:
+            out_lines.extend(wrap_words(para_words, col))
+            del para_words[:]
             if not last_para:
                 out_lines.append("")
         in_list = False
@@ -693,7 +4656,7 @@ def format_body(input, col):
         elif line.startswith(("http://", "https://")):
             # Lines starting with URLs are preserved
             out_lines.append(line)
-        elif all([ch == "#" for ch in words[0]]):
+        elif not words[0].strip("#"):
             # A h1/h2/...
             flush_para()
             out_lines.append(line)
@@ -707,17 +4670,160 @@ def format_body(input, col):
             # If we are still in a list then pass the line right through
             out_lines.append(line)
         else:
-            # Otherwise buffer the line for wrapping
-            para_lines.append(" ".join(words))
+            # Otherwise buffer the words for wrapping
+            para_words.extend(words)
     flush_para(True)
     return out_lines
 
 
-if __name__ == "__main__":
+def _add_new_args(parser):
+    parser.add_argument("--stdin", action="store_true",
+                        help="read the entry, in the format described under "
+                        "ENTRY FORMAT, from stdin rather than using the "
+                        "editor")
+
+
+def _add_import_args(parser):
+    parser.add_argument("file", nargs="*", default=["-"],
+                        help="files of newline-delimited JSON entries to "
+                        "add, or '-' for stdin, which is the default")
+    parser.add_argument("--archive", action="store_true",
+                        help="restore entries, with their ids, from "
+                        "archives made by 'j export'. Entries whose id is "
+                        "already taken are left out.")
+
+
+def _add_export_args(parser):
+    parser.add_argument("arg", nargs="*",
+                        help="an id to export or a @tag to filter by. "
+                        "If omitted, exports all entries matching filters.")
+    parser.add_argument("--output", "-o", required=True, metavar="FILE",
+                        help="the archive to write, or '-' for stdout")
+    parser.add_argument("--format", "-F", choices=EXPORT_FORMATS,
+                        help="the archive format. Defaults to the one "
+                        "named by the suffix of the output file.")
+    _add_filter_args(parser)
+
+
+def _add_edit_args(parser):
+    parser.add_argument("arg", nargs="*",
+                        help="entry id or @tag to edit, "
+                             "or omit to edit the last entry")
+    parser.add_argument("--bundle", "-B", action="store_true",
+                        help="edit the entries together, in a single file "
+                             "with a line marking the start of each")
+
+
+def _add_show_args(parser):
+    parser.add_argument("arg", nargs="*",
+                        help="an id to show or a @tag to filter by. "
+                        "If omitted, shows all entries matching filters.")
+    parser.add_argument("--short", "-s", action="store_true",
+                        help="omit entry bodies.")
+    json_group = parser.add_mutually_exclusive_group()
+    json_group.add_argument("--json", "-j", action="store_true",
+                            help="Output in JSON format")
+    json_group.add_argument("--explain", action="store_true",
+                            help="Rather than showing the entries, show how "
+                            "they are found: the query plan, with the "
+                            "estimated and actual number of entries passing "
+                            "each step, and the time taken.")
+    json_group.add_argument("--jsonl", action="store_true",
+                            help="Output newline-delimited JSON, one compact "
+                            "object per entry, as entries are found. Use "
+                            "with --short to omit bodies.")
+    _add_filter_args(parser)
+
+
+def _add_filter_args(parser):
+    """Add the arguments that make `FilterSettings`, for `_make_filters()`."""
+
+    parser.add_argument("--term", "-t", action="append", default=None,
+                        help="Filter by textual search terms.")
+    parser.add_argument("--query", "-q", default=None, metavar="EXPR",
+                        help="Filter by a query expression. See QUERIES in "
+                        "the top-level help string for the syntax.")
+    parser.add_argument("--when", "-w", default=None,
+                        help="Filter by time. See TIME FORMATS in the "
+                        "top-level help string for the syntax. Defaults to "
+                        "J_JOURNAL_TIME.")
+    parser.add_argument("--case-sensitive", "-c", action="store_true",
+                        help="Make textual filters case sensitive")
+    parser.add_argument("--limit", "-n", type=int, default=None,
+                        help="Show at most this many entries. With "
+                        "--json, the 'next' field holds the id to pass "
+                        "to --before (or --after) for the next page.")
+    parser.add_argument("--before", "-b", default=None, metavar="ID",
+                        help="Only show entries older than the entry "
+                        "with this id. With --limit, pages backwards.")
+    parser.add_argument("--after", "-a", default=None, metavar="ID",
+                        help="Only show entries newer than the entry "
+                        "with this id. With --limit (and no --before), "
+                        "pages forwards.")
+
+
+def _add_migrate_args(parser):
+    parser.add_argument("--flat", action="store_true",
+                        help="convert back to the flat layout")
+
+
+def _add_pack_args(parser):
+    parser.add_argument("--older-than", "-o", default="1y", metavar="TIME",
+                        help="pack the entries made before this time, "
+                        "absolute or relative. See TIME FORMATS in the "
+                        "top-level help string for the syntax. Defaults to "
+                        "%(default)s.")
+
+
+# The subcommands: (name, aliases, function adding the arguments, or None)
+SUBCOMMANDS = [
+    ("new", ["n"], _add_new_args),
+    ("edit", ["e"], _add_edit_args),
+    ("tags", ["t"], None),
+    ("show", ["s"], _add_show_args),
+    ("migrate", [], _add_migrate_args),
+    ("pack", [], _add_pack_args),
+    ("import", [], _add_import_args),
+    ("export", [], _add_export_args),
+    ("daemon", [], None),
+]
+
+
+def make_arg_parser(command=None):
+    """
+    Build the command line parser. If `command` is the name or alias of a
+    subcommand, only that subcommand's arguments are set up, as only it can be
+    parsed. Otherwise (e.g. for `--help`) all of them are.
+    """
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        epilog=HELP_EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    known = any(command == name or command in aliases
+                for name, aliases, _ in SUBCOMMANDS)
+    for name, aliases, add_args in SUBCOMMANDS:
+        sub = subparsers.add_parser(name, aliases=aliases)
+        sub.set_defaults(mode=name)
+        if add_args and (not known or command == name or command in aliases):
+            add_args(sub)
+    return parser
+
+
+def main(argv):
+    """Run `j` with the command line arguments `argv` (without argv[0])."""
+
     # Handle all environment variables here
     if os.environ.get("J_JOURNAL_DEBUG"):
         logging.root.setLevel(logging.DEBUG)
 
+    global PROFILE
+    profile_dest = os.environ.get("J_JOURNAL_PROFILE")
+    if profile_dest:
+        PROFILE = Profile(trace=profile_dest != "1")
+
     colour_env = os.environ.get("J_JOURNAL_COLOURS", None)
     if colour_env:
         colours = Colours.from_str(colour_env)
@@ -739,95 +4845,282 @@ if __name__ == "__main__":
     time_filter = os.environ.get("J_JOURNAL_TIME")
     editor = os.environ.get("EDITOR", DEFAULT_EDITOR)
     pager = os.environ.get("J_JOURNAL_PAGER", DEFAULT_PAGER)
-
-    jrnl = Journal(jrnl_dir, colours=colours, editor=editor, pager=pager,
-                   wrap_col=wrap_col)
+    use_index = not os.environ.get("J_JOURNAL_NO_INDEX")
+    jobs = os.environ.get("J_JOURNAL_JOBS", 1)
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        print_err("Invalid J_JOURNAL_JOBS environment")
+        sys.exit(1)
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    render_cache_size = os.environ.get("J_JOURNAL_RENDER_CACHE_SIZE",
+                                       DEFAULT_RENDER_CACHE_SIZE)
+    try:
+        render_cache_size = int(render_cache_size)
+    except ValueError:
+        print_err("Invalid J_JOURNAL_RENDER_CACHE_SIZE environment")
+        sys.exit(1)
 
     # Command line interface
-    parser = argparse.ArgumentParser(
-        epilog=HELP_EPILOG,
-        formatter_class=argparse.RawDescriptionHelpFormatter)
-    subparsers = parser.add_subparsers()
-
-    new_parser = subparsers.add_parser('new', aliases=['n'])
-    new_parser.set_defaults(mode='new')
-
-    edit_parser = subparsers.add_parser('edit', aliases=['e'])
-    edit_parser.set_defaults(mode='edit')
-    edit_parser.add_argument("arg", nargs="*",
-                             help="entry id or @tag to edit, "
-                                  "or omit to edit the last entry")
-
-    show_parser = subparsers.add_parser('show', aliases=['s'])
-    show_parser.set_defaults(mode='show')
-    show_parser.add_argument("arg", nargs="*",
-                             help="an id to show or a @tag to filter by. "
-                             "If omitted, shows all entries matching filters.")
-    show_parser.add_argument("--short", "-s", action="store_true",
-                             help="omit entry bodies.")
-    show_parser.add_argument("--term", "-t", action="append", default=None,
-                             help="Filter by textual search terms.")
-    show_parser.add_argument("--when", "-w", default=time_filter,
-                             help="Filter by time. See TIME FORMATS in the "
-                             "top-level help string for the syntax.")
-    show_parser.add_argument("--json", "-j", action="store_true",
-                             help="Output in JSON format")
-    show_parser.add_argument("--case-sensitive", "-c", action="store_true",
-                             help="Make textual filters case sensitive")
-
     # Running with no args displays the journal, same as 'j s'
-    if len(sys.argv[1:]) == 0:
-        sys.argv.append("show")
+    if len(argv) == 0:
+        argv = ["show"]
 
-    args = parser.parse_args()
+    parser = make_arg_parser(argv[0])
+    args = parser.parse_args(argv)
     try:
         mode = args.mode
     except AttributeError:
         parser.print_help()
         sys.exit(1)
 
-    if mode == "new":
-        jrnl.new_entry()
-    elif mode == "show":
-        if all([not a.startswith("@") for a in args.arg]):
-            # User is passing a list of entry IDs.
-            tag_filters = []
-            id_filters = args.arg
-        elif all([a.startswith("@") for a in args.arg]):
-            # user is passing a list of tags.
-            tag_filters = [x[1:] for x in args.arg]
-            id_filters = []
-        else:
-            print("Positional arguments must all be @tags or all be entry IDs")
+    # The journal is only set up once the arguments are known to be good
+    jrnl = Journal(jrnl_dir, colours=colours, editor=editor, pager=pager,
+                   wrap_col=wrap_col, use_index=use_index, jobs=jobs,
+                   render_cache_size=render_cache_size)
+    try:
+        status = None
+        # An explanation is of how this process would run the query
+        if mode in Daemon.COMMANDS and not profile_dest and \
+                not getattr(args, "explain", False) and \
+                not os.environ.get("J_JOURNAL_NO_DAEMON"):
+            status = forward_to_daemon(jrnl, argv, page=mode == "show")
+        if status is None:
+            dispatch(jrnl, mode, args, time_filter)
+        elif status:
+            sys.exit(status)
+    finally:
+        if profile_dest:
+            report_profile(PROFILE, profile_dest)
+
+
+def report_profile(profile, dest):
+    """
+    Report on a run profiled with `profile`, as asked for by
+    J_JOURNAL_PROFILE=`dest`: either a table on stderr, or a trace file.
+    """
+
+    if dest == "1":
+        print_err(profile.table())
+        return
+    import json
+    try:
+        with open(dest, "w") as fh:
+            json.dump(profile.trace(), fh)
+    except OSError as e:
+        print_err("can't write profile to '%s': %s" % (dest, e))
+
+
+def _read_import_file(path):
+    """Yields the entries in the file `path`, as for `import_entries()`,
+    where "-" is stdin."""
+
+    if path == "-":
+        yield from read_ndjson_entries(sys.stdin, "<stdin>")
+        return
+    try:
+        fh = open(path)
+    except OSError as e:
+        print_err("can't open '%s': %s" % (path, e.strerror))
+        sys.exit(1)
+    with fh:
+        yield from read_ndjson_entries(fh, path)
+
+
+def import_entries(jrnl, items):
+    """Add the entries `items` to `jrnl`, as for `Journal.add_entries()`,
+    reporting any that are invalid."""
+
+    try:
+        paths = jrnl.add_entries(items)
+    except ParseError as e:
+        print_err("invalid entry: %s" % e)
+        print_err("no entries were added")
+        sys.exit(1)
+    for path in paths:
+        print("[N] %s" % path)
+
+
+def restore_archives(jrnl, paths):
+    """Restore the entries in the archives at `paths` to `jrnl`, as for
+    `Journal.restore_entries()`, where "-" is stdin."""
+
+    import shutil
+    import tempfile
+
+    def read_all():
+        for path in paths:
+            if path == "-":
+                # Archives are read by seeking about, so spool stdin
+                fh = tempfile.TemporaryFile()
+                shutil.copyfileobj(sys.stdin.buffer, fh)
+                name = "<stdin>"
+            else:
+                try:
+                    fh = open(path, "rb")
+                except OSError as e:
+                    print_err("can't open '%s': %s" % (path, e.strerror))
+                    sys.exit(1)
+                name = path
+            with fh:
+                yield from read_archive(fh, name)
+
+    try:
+        paths, skipped = jrnl.restore_entries(read_all())
+    except (ParseError, OSError, EOFError) as e:
+        print_err("invalid archive: %s" % e)
+        print_err("no entries were added")
+        sys.exit(1)
+    for path in paths:
+        print("[N] %s" % path)
+    for name in skipped:
+        print("[-] %s exists" % name)
+
+
+def export_archive(jrnl, output, fmt, filters):
+    """Export the entries of `jrnl` matching `filters` to the file `output`,
+    or stdout if it is "-", as for `Journal.export()`."""
+
+    if fmt is None:
+        fmt = next((f for f in EXPORT_FORMATS if output.endswith("." + f)),
+                   None)
+        if fmt is None:
+            print_err("can't tell the format of '%s'. Use --format." %
+                      output)
+            sys.exit(1)
+    if fmt == "tgz":
+        fmt = "tar.gz"
+
+    if output == "-":
+        count = jrnl.export(sys.stdout.buffer, fmt, filters)
+        sys.stdout.flush()
+        print_err("Exported %d entries" % count)
+        return
+    # Written alongside, then renamed, so there's never half an archive
+    part = output + ".part"
+    try:
+        with open(part, "wb") as fh:
+            count = jrnl.export(fh, fmt, filters)
+        os.replace(part, output)
+    except OSError as e:
+        print_err("can't write '%s': %s" % (output, e.strerror))
+        sys.exit(1)
+    finally:
+        if os.path.exists(part):
+            os.unlink(part)
+    print("Exported %d entries" % count)
+
+
+def _make_filters(args, time_filter):
+    """Make the `FilterSettings` for the arguments added by
+    `_add_filter_args()`, and the J_JOURNAL_TIME filter `time_filter`."""
+
+    if all([not a.startswith("@") for a in args.arg]):
+        # User is passing a list of entry IDs.
+        tag_filters = []
+        id_filters = args.arg
+    elif all([a.startswith("@") for a in args.arg]):
+        # user is passing a list of tags.
+        tag_filters = [x[1:] for x in args.arg]
+        id_filters = []
+    else:
+        print("Positional arguments must all be @tags or all be entry IDs. "
+              "Use --query to combine them.")
+        sys.exit(1)
+
+    query = None
+    if args.query is not None:
+        try:
+            query = Query.parse(args.query)
+        except QueryException as e:
+            print("invalid query: %s" % e)
             sys.exit(1)
 
-        # Setup filters
-        if args.when:
-            try:
-                time_filter = TimeFilter.from_arg(args.when)
-            except TimeFilterException as e:
-                print("invalid time filter: %s" % e)
-                sys.exit(1)
+    # Setup filters
+    # An empty --when still overrides J_JOURNAL_TIME, to mean no time filter
+    when = time_filter if args.when is None else args.when
+    if when:
+        try:
+            time_filter = TimeFilter.from_arg(when)
+        except TimeFilterException as e:
+            print("invalid time filter: %s" % e)
+            sys.exit(1)
+    else:
+        time_filter = TimeFilter()
+
+    if args.limit is not None and args.limit < 1:
+        print("--limit must be at least 1")
+        sys.exit(1)
+    for cursor in args.before, args.after:
+        try:
+            if cursor:
+                ident_time(cursor)
+        except ValueError:
+            print("invalid entry id: %s" % cursor)
+            sys.exit(1)
+
+    return FilterSettings(
+        tag_filters=tag_filters,
+        textual_filters=args.term,
+        time_filter=time_filter,
+        id_filters=id_filters,
+        case_sensitive=args.case_sensitive,
+        limit=args.limit,
+        before=args.before,
+        after=args.after,
+        query=query,
+    )
+
+
+def dispatch(jrnl, mode, args, time_filter):
+    """Run the subcommand `mode` with the parsed arguments `args`."""
+
+    if mode == "new":
+        if args.stdin:
+            import_entries(jrnl, [(sys.stdin.read(), None)])
+        else:
+            jrnl.new_entry()
+    elif mode == "import":
+        if args.archive:
+            restore_archives(jrnl, args.file)
         else:
-            time_filter = TimeFilter()
-
-        textual_filters = args.term
-        filters = FilterSettings(
-            tag_filters=tag_filters,
-            textual_filters=textual_filters,
-            time_filter=time_filter,
-            id_filters=id_filters,
-            case_sensitive=args.case_sensitive,
-        )
+            import_entries(jrnl, itertools.chain.from_iterable(
+                _read_import_file(path) for path in args.file))
+    elif mode == "export":
+        export_archive(jrnl, args.output, args.format,
+                       _make_filters(args, time_filter))
+    elif mode == "tags":
+        jrnl.show_tags()
+    elif mode == "migrate":
+        jrnl.migrate(sharded=not args.flat)
+    elif mode == "daemon":
+        Daemon(jrnl).run()
+    elif mode == "pack":
+        try:
+            before = TimeFilter.from_arg(":" + args.older_than).stop
+        except TimeFilterException as e:
+            print("invalid time: %s" % e)
+            sys.exit(1)
+        jrnl.pack(before)
+    elif mode == "show":
+        filters = _make_filters(args, time_filter)
+        if args.explain:
+            print(jrnl.explain(filters))
+            return
         jrnl.show_entries(bodies=not args.short, filters=filters,
-                          output_json=args.json)
+                          output_json=args.json, output_jsonl=args.jsonl)
     elif mode == "edit":
         if len(args.arg) == 0:
-            jrnl.edit_entry(None)
+            jrnl.edit_entry(None, args.bundle)
         elif args.arg[0].startswith("@"):
-            jrnl.edit_tag(args.arg[0][1:])
+            jrnl.edit_tag(args.arg[0][1:], args.bundle)
         else:
-            jrnl.edit_entry(args.arg[0])
+            jrnl.edit_entry(args.arg[0], args.bundle)
 
     else:
         assert(False)  # unreachable
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
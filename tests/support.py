@@ -83,3 +83,16 @@ def run_j(jrnl, args):
     )
     sout, serr = p.communicate()
     return sout, serr, p.returncode
+
+
+def make_editor(directory, script):
+    """
+    Makes an executable in `directory` to use as an editor, which runs the
+    shell `script` on each file it is given, as "$f".
+    """
+
+    path = os.path.join(directory, "editor")
+    with open(path, "w") as fh:
+        fh.write('#!/bin/sh\nfor f in "$@"; do\n%s\ndone\n' % script)
+    os.chmod(path, 0o755)
+    return path
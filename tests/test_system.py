@@ -1,7 +1,8 @@
 from support import jrnl  # noqa: F401
-from support import insert_entry, run_j
+from support import insert_entry, run_j, J_SCRIPT
 import datetime
 import json
+import subprocess
 
 
 def test_no_journal_path_env0001():
@@ -63,3 +64,173 @@ def test_show_entries0002(jrnl):  # noqa: F811
     assert ent["title"] == "My Title"
     assert ent["time"] == "2017-01-01 12:00:00"
     assert set(ent["tags"]) == set(["tag1", "tag2"])
+
+
+def test_show_entries0003(jrnl):  # noqa: F811
+    """Check JSON output matches a one-shot JSON encoding"""
+
+    for n in 0, 1, 3:
+        for i in range(n):
+            insert_entry(jrnl, "Title%s" % i, "@tag", "Body\n\"quoted\"\n")
+        ents = jrnl._collect_entries()
+        expect = json.dumps({"entries": [e.as_dict() for e in ents]},
+                            indent=2)
+        out, err, rv = run_j(jrnl, ["s", "-j"])
+        assert rv == 0
+        assert out.decode() == expect + "\n"
+
+
+def test_show_entries0004(jrnl):  # noqa: F811
+    """Check output stops quietly if the reader goes away"""
+
+    for i in range(200):
+        insert_entry(jrnl, "Title%s" % i, body="Body " * 1000)
+    p = subprocess.Popen([J_SCRIPT], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         env={"J_JOURNAL_DIR": jrnl.directory})
+    assert p.stdout.readline().startswith(b"=====")
+    p.stdout.close()
+    err = p.stderr.read()
+    assert p.wait() == 0
+    assert err == b""
+
+
+def test_show_entries0005(jrnl):  # noqa: F811
+    """Check newline-delimited JSON output"""
+
+    out, err, rv = run_j(jrnl, ["s", "--jsonl"])
+    assert rv == 0
+    assert out == b""
+
+    dt = datetime.datetime(2017, 1, 1, 12, 00, 00)
+    insert_entry(jrnl, "Old", "@tag1", "Body1", time=dt, fn_suffix="xxxxxxxx")
+    dt = datetime.datetime(2017, 1, 2, 12, 00, 00)
+    insert_entry(jrnl, "New", "@tag2", "Body2", time=dt, fn_suffix="yyyyyyyy")
+    out, err, rv = run_j(jrnl, ["s", "--jsonl"])
+    assert rv == 0
+    assert err == b""
+    lines = out.splitlines()
+    assert len(lines) == 2
+    assert out.endswith(b"}\n")
+    ents = [json.loads(line) for line in lines]
+    assert [e["title"] for e in ents] == ["New", "Old"]
+    assert [e["body"] for e in ents] == ["Body2", "Body1"]
+    assert ents[0]["tags"] == ["tag2"]
+
+    out, err, rv = run_j(jrnl, ["s", "--jsonl", "--short"])
+    assert rv == 0
+    ents = [json.loads(line) for line in out.splitlines()]
+    assert [e["body"] for e in ents] == [None, None]
+
+
+def test_show_entries0006(jrnl):  # noqa: F811
+    """Check JSON output has a cursor when limited"""
+
+    for i in range(5):
+        dt = datetime.datetime(2017, 1, 1 + i, 12, 00, 00)
+        insert_entry(jrnl, "T%s" % i, time=dt, fn_suffix="xxxxxxxx")
+    out, err, rv = run_j(jrnl, ["s", "-j", "-n", "2"])
+    assert rv == 0
+    jsn = json.loads(out)
+    assert [e["title"] for e in jsn["entries"]] == ["T4", "T3"]
+    assert jsn["next"] == "20170104_120000-xxxxxxxx"
+
+    out, err, rv = run_j(jrnl, ["s", "-j", "-n", "2", "-b", jsn["next"]])
+    assert rv == 0
+    jsn = json.loads(out)
+    assert [e["title"] for e in jsn["entries"]] == ["T2", "T1"]
+
+    out, err, rv = run_j(jrnl, ["s", "-j", "-n", "2", "-b", jsn["next"]])
+    jsn = json.loads(out)
+    assert [e["title"] for e in jsn["entries"]] == ["T0"]
+    assert jsn["next"] is None
+
+    out, err, rv = run_j(jrnl, ["s", "-j", "-b", "bogus"])
+    assert rv != 0
+
+
+def test_import_entries0001(jrnl):  # noqa: F811
+    """Check entries can be added from stdin without an editor"""
+
+    def run(args, data):
+        p = subprocess.run([J_SCRIPT] + args, input=data,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           env={"J_JOURNAL_DIR": jrnl.directory})
+        return p.stdout, p.stderr, p.returncode
+
+    inserted = [
+        {"title": "Old", "tags": ["tag1"], "body": "Body1\n",
+         "time": "2017-01-01 12:00:00"},
+        {"title": "New", "tags": ["tag2"], "body": "Body2\n",
+         "time": "2017-01-02 12:00:00"},
+    ]
+    out, err, rv = run(["import"], "".join(json.dumps(e) + "\n"
+                                           for e in inserted).encode())
+    assert rv == 0
+    assert err == b""
+    assert len(out.splitlines()) == 2
+    assert all(line.startswith(b"[N] ") for line in out.splitlines())
+
+    # What `j s --jsonl` outputs can be imported again
+    out, err, rv = run(["s", "--jsonl"], b"")
+    out, err, rv = run(["import"], out)
+    assert rv == 0
+    out, err, rv = run(["s", "--jsonl"], b"")
+    ents = [json.loads(line) for line in out.splitlines()]
+    assert [e["title"] for e in ents] == ["New", "New", "Old", "Old"]
+    assert len(set(e["path"] for e in ents)) == 4
+
+    out, err, rv = run(["new", "--stdin"], b"Newest\n@tag3\n\nBody3\n")
+    assert rv == 0
+    out, err, rv = run(["s", "--jsonl", "-n", "1"], b"")
+    ent = json.loads(out)
+    assert (ent["title"], ent["tags"], ent["body"]) == \
+        ("Newest", ["tag3"], "Body3\n")
+
+    # Nothing is added if any entry is invalid
+    out, err, rv = run(["import"], b'{"title": "Fine"}\n{"body": "x"}\n')
+    assert rv != 0
+    assert b"line 2" in err
+    out, err, rv = run(["new", "--stdin"], b" \n")
+    assert rv != 0
+    out, err, rv = run(["s", "--jsonl"], b"")
+    assert len(out.splitlines()) == 5
+
+
+def test_show_query0001(jrnl):  # noqa: F811
+    """Check entries can be shown by a query, and its plan explained"""
+
+    for i, attrs in enumerate(["@a", "@b", "@a @b"]):
+        dt = datetime.datetime(2017, 1, 1 + i, 12, 00, 00)
+        insert_entry(jrnl, "T%s" % i, attrs, "Body%s" % i, time=dt)
+    out, err, rv = run_j(jrnl, ["s", "-j", "-q", "@a and not body2 or @b",
+                                "-w", "2017-01-02"])
+    assert rv == 0
+    jsn = json.loads(out)
+    assert [e["title"] for e in jsn["entries"]] == ["T2", "T1"]
+
+    out, err, rv = run_j(jrnl, ["s", "-q", "(@a"])
+    assert rv != 0
+    assert b"invalid query" in out
+
+    out, err, rv = run_j(jrnl, ["s", "--explain", "-q", "body0 or @b"])
+    assert rv == 0
+    assert out.splitlines()[0] == b"query: body0 or @b"
+    assert out.splitlines()[4].split()[0] == b"@b"  # tags first
+    assert b"3 entries scanned" in out
+    assert b"T0" not in out
+
+
+def test_show_entries0007(jrnl, monkeypatch):  # noqa: F811
+    """Check the pipe to a pager that quits early is closed"""
+
+    pagers = []
+    orig_popen = subprocess.Popen
+
+    def popen(*args, **kwargs):
+        pagers.append(orig_popen(*args, **kwargs))
+        return pagers[-1]
+    monkeypatch.setattr(subprocess, "Popen", popen)
+    jrnl.pager = "exit 0"
+    jrnl._page("line %d\n" % i for i in range(500000))
+    assert pagers[0].stdin.closed
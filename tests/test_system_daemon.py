@@ -0,0 +1,119 @@
+from support import jrnl  # noqa: F401
+from support import J_SCRIPT
+from support import insert_entry
+import datetime
+import os
+import pytest
+import subprocess
+import sys
+import j
+
+
+@pytest.fixture
+def daemon(jrnl, tmp_path):  # noqa: F811
+    """Runs `j daemon` on `jrnl`, yielding the file that it logs to"""
+
+    log = os.path.join(str(tmp_path), "daemon.log")
+    env = {"J_JOURNAL_DIR": jrnl.directory, "J_JOURNAL_DEBUG": "1"}
+    with open(log, "w") as fh:
+        p = subprocess.Popen([sys.executable, J_SCRIPT, "daemon"], env=env,
+                             stdout=subprocess.PIPE, stderr=fh)
+    assert p.stdout.readline().startswith(b"serving")
+    yield log
+    p.terminate()
+    p.wait()
+    p.stdout.close()
+    assert not os.path.exists(os.path.join(jrnl.directory, j.DAEMON_SOCKET))
+
+
+def run(jrnl, args, **env):  # noqa: F811
+    env["J_JOURNAL_DIR"] = jrnl.directory
+    p = subprocess.run([sys.executable, J_SCRIPT] + args, env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return p.stdout, p.stderr, p.returncode
+
+
+def served(log):
+    with open(log) as fh:
+        return fh.read().count("served a request")
+
+
+def make_entries(jrnl):  # noqa: F811
+    insert_entry(jrnl, title="one", attrs="@a", body="the body\n",
+                 time=datetime.datetime(2017, 1, 1, 12))
+    insert_entry(jrnl, title="two", attrs="@b",
+                 time=datetime.datetime(2018, 1, 1, 12))
+
+
+def test_daemon0001(jrnl, daemon):  # noqa: F811
+    """Check the daemon's answers are the same as j's own"""
+
+    make_entries(jrnl)
+    for args in [["s"], ["s", "--json"], ["s", "-n", "1"], ["s", "-t", "b"],
+                 ["s", "body"], ["t"], ["s", "-w", "2018"]]:
+        before = served(daemon)
+        assert run(jrnl, args) == run(jrnl, args, J_JOURNAL_NO_DAEMON="1")
+        assert served(daemon) == before + 1
+
+    # Settings from the client's environment are used
+    out, _, _ = run(jrnl, ["s"], J_JOURNAL_WRAP_COL="20")
+    assert b"=" * 20 + b"\n" in out
+    assert b"=" * 21 not in out
+
+
+def test_daemon0002(jrnl, daemon):  # noqa: F811
+    """Check the daemon sees new entries, and errors are passed on"""
+
+    make_entries(jrnl)
+    assert run(jrnl, ["s", "-n", "1"])[0].count(b"two") == 1
+    insert_entry(jrnl, title="three",
+                 time=datetime.datetime(2019, 1, 1, 12))
+    assert run(jrnl, ["s", "-n", "1"])[0].count(b"three") == 1
+
+    got = run(jrnl, ["s", "-w", "bogus"])
+    assert got[2] != 0
+    assert got == run(jrnl, ["s", "-w", "bogus"], J_JOURNAL_NO_DAEMON="1")
+
+
+def test_daemon0003(jrnl):  # noqa: F811
+    """Check j works as usual when the daemon has left its socket behind"""
+
+    make_entries(jrnl)
+    want = run(jrnl, ["s"], J_JOURNAL_NO_DAEMON="1")
+    open(os.path.join(jrnl.directory, j.DAEMON_SOCKET), "w").close()
+    assert run(jrnl, ["s"]) == want
+
+
+def test_daemon0004(jrnl, daemon):  # noqa: F811
+    """Check clients that stop reading, or never send a request, don't hold
+    up the others"""
+
+    import socket
+    for i in range(300):
+        insert_entry(jrnl, title="entry%d" % i, body="word " * 500,
+                     time=datetime.datetime(2017, 1, 1, 12, i // 60, i % 60))
+    want = run(jrnl, ["s"], J_JOURNAL_NO_DAEMON="1")[0]
+    assert len(want) > 512 * 1024  # more than the socket will buffer
+
+    before = served(daemon)
+    path = os.path.join(jrnl.directory, j.DAEMON_SOCKET)
+    silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    silent.connect(path)
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stalled.connect(path)
+    stalled.sendall(b"\0s\0")
+    stalled.shutdown(socket.SHUT_WR)
+
+    p = subprocess.run([sys.executable, J_SCRIPT, "s", "-n", "1"],
+                       env={"J_JOURNAL_DIR": jrnl.directory},
+                       stdout=subprocess.PIPE, timeout=20)
+    assert p.stdout.count(b"entry299") == 1
+    assert served(daemon) == before + 3
+
+    # The stalled client still gets all of its reply
+    status = [None]
+    with stalled:
+        got = "".join(j._read_frames(stalled.makefile("rb"), status))
+    assert status[0] == 0
+    assert got.encode() == want
+    silent.close()
@@ -0,0 +1,49 @@
+from support import jrnl  # noqa: F401
+from support import J_SCRIPT
+import subprocess
+import sys
+import time
+
+# Modules that a quick command shouldn't pay to import
+LAZY_MODULES = {"json", "subprocess", "tempfile", "hashlib", "sqlite3",
+                "concurrent.futures", "tarfile", "zipfile", "gzip"}
+
+# The most that starting `j` and dispatching a command may take, over and
+# above starting the interpreter. Generous, so that slow machines pass.
+STARTUP_BUDGET = 0.25
+
+
+def run_timed(args, env):
+    """Returns the shortest wall clock time of a few runs of `args`"""
+
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        subprocess.run(args, env=env, check=True, stdout=subprocess.DEVNULL)
+        took = time.perf_counter() - start
+        if best is None or took < best:
+            best = took
+    return best
+
+
+def test_startup0001(jrnl):  # noqa: F811
+    """Check a quick command doesn't import modules it doesn't use"""
+
+    env = {"J_JOURNAL_DIR": jrnl.directory, "J_JOURNAL_NO_INDEX": "1"}
+    p = subprocess.run([sys.executable, "-X", "importtime", J_SCRIPT, "s"],
+                       env=env, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True)
+    imported = set(line.split("|")[-1].strip() for line in
+                   p.stderr.decode().splitlines()
+                   if line.startswith("import time:"))
+    assert "argparse" in imported  # i.e. the output was understood
+    assert imported & LAZY_MODULES == set()
+
+
+def test_startup0002(jrnl):  # noqa: F811
+    """Check import and dispatch of a quick command is within budget"""
+
+    env = {"J_JOURNAL_DIR": jrnl.directory, "J_JOURNAL_NO_INDEX": "1"}
+    bare = run_timed([sys.executable, "-c", "pass"], env)
+    took = run_timed([sys.executable, J_SCRIPT, "s"], env)
+    assert took - bare < STARTUP_BUDGET
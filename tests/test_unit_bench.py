@@ -0,0 +1,60 @@
+import os
+import sys
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+
+sys.path.insert(0, os.path.join(support.PARENT_DIR, "bench"))
+import j_bench  # noqa: E402
+
+
+def read_journal(directory):
+    """Returns a dict of the names and contents of the files in a directory"""
+
+    contents = {}
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name)) as fh:
+            contents[name] = fh.read()
+    return contents
+
+
+def test_bench_generate0001(jrnl, tmp_path):  # noqa: F811
+    """Check the generator is deterministic and makes valid entries"""
+
+    names = j_bench.generate(jrnl.directory, 200, seed=3)
+    j_bench.generate(str(tmp_path), 200, seed=3)
+    assert read_journal(jrnl.directory) == read_journal(str(tmp_path))
+
+    ents = jrnl._collect_entries()
+    assert len(ents) == len(set(names)) == 200
+    assert any(e.tags for e in ents)
+    assert any(e.immortal for e in ents) or any(not e.wrap for e in ents)
+    assert any(e.body is None for e in ents)
+
+
+def test_bench_run0001(tmp_path):
+    """Check the benchmarks run and report every path"""
+
+    results = j_bench.run_benchmarks([20], repeat=1, memory=False,
+                                     cache_dir=str(tmp_path))
+    assert set(results) == set("20:%s" % n for n, _ in j_bench.BENCHMARKS)
+    for res in results.values():
+        assert res["seconds"] >= 0
+        assert "peak_bytes" not in res
+
+
+def test_bench_regressions0001():
+    """Check regressions are found using the configured thresholds"""
+
+    baseline = {"10:scan": {"seconds": 1.0, "peak_bytes": 100},
+                "10:parse": {"seconds": 1.0}}
+    results = {"10:scan": {"seconds": 1.2, "peak_bytes": 200},
+               "10:parse": {"seconds": 1.5},
+               "10:json": {"seconds": 9.0}}  # not in the baseline
+    problems = j_bench.regressions(results, baseline, 0.25)
+    assert len(problems) == 2
+    assert problems[0].startswith("10:parse: seconds")
+    assert problems[1].startswith("10:scan: peak_bytes")
+
+    problems = j_bench.regressions(results, baseline, 0.25,
+                                   {"parse": 1.0, "scan": 1.0})
+    assert problems == []
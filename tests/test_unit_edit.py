@@ -0,0 +1,161 @@
+import datetime
+import os
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry, make_editor
+
+
+def make_entries(jrnl):  # noqa: F811
+    return [insert_entry(jrnl, title="entry%d" % i, attrs="@a",
+                         body="body %d\n" % i,
+                         time=datetime.datetime(2017, 1, 1 + i, 12))
+            for i in range(3)]
+
+
+def stamps(paths):
+    return [(st.st_ino, st.st_mtime_ns)
+            for st in (os.stat(p) for p in paths)]
+
+
+def test_edit0001(jrnl, tmp_path, capsys):  # noqa: F811
+    """Check only the entries changed in a bulk edit are moved back"""
+
+    paths = make_entries(jrnl)
+    before = stamps(paths)
+    jrnl.editor = make_editor(str(tmp_path), 'case "$f" in %s) '
+                              'echo more >> "$f";; esac' %
+                              ("*" + os.path.basename(paths[1])))
+    jrnl.edit_tag("a")
+
+    after = stamps(paths)
+    assert after[0] == before[0]
+    assert after[1] != before[1]
+    assert after[2] == before[2]
+    out = capsys.readouterr().out.splitlines()
+    assert sorted(out) == sorted(["[-] %s" % paths[0], "[E] %s" % paths[1],
+                                  "[-] %s" % paths[2]])
+    bodies = [e.body for e in jrnl._collect_entries()]
+    assert bodies == ["body 2\n", "body 1\nmore\n", "body 0\n"]
+
+
+def test_edit0002(jrnl, tmp_path, capsys):  # noqa: F811
+    """Check an entry rewritten with the same contents is skipped, and its
+    temporary copy removed"""
+
+    paths = make_entries(jrnl)
+    before = stamps(paths)
+    jrnl.editor = make_editor(str(tmp_path), 'cp "$f" "$f.new"; '
+                              'mv "$f.new" "$f"; echo "$f" >> %s' %
+                              os.path.join(str(tmp_path), "edited"))
+    jrnl.edit_entry(os.path.basename(paths[0]))
+
+    assert stamps(paths) == before
+    assert capsys.readouterr().out == "[-] %s\n" % paths[0]
+    with open(os.path.join(str(tmp_path), "edited")) as fh:
+        assert not os.path.exists(fh.read().strip())
+
+
+def test_edit0003(jrnl, tmp_path, capsys):  # noqa: F811
+    """Check a bundle edit opens one file and writes back only the changed
+    entries"""
+
+    paths = make_entries(jrnl)
+    before = stamps(paths)
+    args = os.path.join(str(tmp_path), "args")
+    jrnl.editor = make_editor(str(tmp_path), 'echo "$f" >> %s; '
+                              'sed -i "s/^body 1$/body one/" "$f"' % args)
+    jrnl.edit_tag("a", bundle=True)
+
+    with open(args) as fh:
+        bundle = fh.read().splitlines()
+    assert len(bundle) == 1
+    assert not os.path.exists(bundle[0])
+    after = stamps(paths)
+    assert after[0] == before[0]
+    assert after[1] != before[1]
+    assert after[2] == before[2]
+    assert capsys.readouterr().out.splitlines() == \
+        ["[-] %s" % paths[2], "[E] %s" % paths[1], "[-] %s" % paths[0]]
+    bodies = [e.body for e in jrnl._collect_entries()]
+    assert bodies == ["body 2\n", "body one\n", "body 0\n"]
+
+
+def test_edit0004(jrnl, tmp_path, capsys, monkeypatch):  # noqa: F811
+    """Check an entry that fails to parse in a bundle is reported, and is all
+    that is kept for the next try"""
+
+    def interrupt():
+        raise KeyboardInterrupt()
+    monkeypatch.setattr("builtins.input", interrupt)
+
+    paths = make_entries(jrnl)
+    jrnl.editor = make_editor(str(tmp_path), 'sed -i -e "s/^entry0$/ /" '
+                              '-e "s/^body 1$/body one/" "$f"')
+    jrnl.edit_tag("a", bundle=True)
+
+    out = capsys.readouterr().out
+    assert "[!] %s" % paths[0] in out
+    assert "%s: whitespace title" % os.path.basename(paths[0]) in out
+    assert [e.body for e in jrnl._collect_entries()] == \
+        ["body 2\n", "body one\n", "body 0\n"]
+
+    # Only the broken entry is left in the bundle
+    bundle = out.splitlines()[-1].split(" + ")[1]
+    with open(bundle, "rb") as fh:
+        text = fh.read()
+    os.unlink(bundle)
+    assert text.endswith(b" " + os.path.basename(paths[0]).encode() +
+                         b" ===\n \n@a\n\nbody 0\n")
+    assert b"entry1" not in text and b"entry2" not in text
+
+
+def test_edit0005(jrnl, tmp_path, capsys, monkeypatch):  # noqa: F811
+    """Check a bundle section for an entry not being edited is reported
+    once, and isn't kept for another try"""
+
+    def no_retry():
+        raise AssertionError("asked to try again")
+    monkeypatch.setattr("builtins.input", no_retry)
+
+    paths = make_entries(jrnl)
+    jrnl.editor = make_editor(str(tmp_path), 'delim=$(grep -m1 -o '
+                              '"^=== j-[0-9a-f]* " "$f"); printf '
+                              '"%sbogus ===\\nnew\\n" "$delim" >> "$f"')
+    jrnl.edit_tag("a", bundle=True)
+
+    out = capsys.readouterr().out.splitlines()
+    assert out[:2] == ["Ignoring 1 sections not naming an entry being "
+                       "edited:", "  bogus"]
+    assert sorted(out[2:]) == sorted("[-] %s" % p for p in paths)
+    assert not [n for n in os.listdir(jrnl.directory) if "bogus" in n]
+
+
+def test_edit0006(jrnl, tmp_path, capsys, monkeypatch):  # noqa: F811
+    """Check an entry whose delimiter line is deleted from a bundle isn't
+    written into the entry before it"""
+
+    def interrupt():
+        raise KeyboardInterrupt()
+    monkeypatch.setattr("builtins.input", interrupt)
+
+    paths = make_entries(jrnl)
+    names = [os.path.basename(p) for p in paths]
+    jrnl.editor = make_editor(str(tmp_path), 'sed -i -e "/ %s ===$/d" "$f"'
+                              % names[1])
+    jrnl.edit_tag("a", bundle=True)
+
+    out = capsys.readouterr().out
+    assert "[-] %s" % paths[0] in out
+    assert "[!] %s" % paths[1] in out and "[!] %s" % paths[2] in out
+    assert "%s: its delimiter line is missing" % names[1] in out
+    assert "%s: may hold the text" % names[2] in out
+    assert [e.body for e in jrnl._collect_entries()] == \
+        ["body 2\n", "body 1\n", "body 0\n"]
+
+    # Both are offered again, each with a delimiter line
+    bundle = out.splitlines()[-1].split(" + ")[1]
+    with open(bundle, "rb") as fh:
+        text = fh.read()
+    os.unlink(bundle)
+    assert text.count(b" ===\n") == 2
+    assert names[1].encode() in text and names[2].encode() in text
@@ -128,3 +128,99 @@ def test_parse_entry_0010(jrnl):  # noqa: F811
     assert ent.title == "title"
     assert ent.tags == {"t1", "t2", "t3"}
     assert ent.body is None
+
+
+def test_collect_parallel0001(jrnl):  # noqa: F811
+    """Check parallel collection gives the same entries in the same order"""
+
+    for i in range(64):
+        attrs = "@even" if i % 2 == 0 else "@odd"
+        insert_entry(jrnl, title="hello%s" % i, attrs=attrs, body="body%s" % i)
+
+    filters = j.FilterSettings(tag_filters=["even"], textual_filters=["1"])
+    for use_index in False, True:
+        jrnl.use_index = use_index
+        jrnl.jobs = 1
+        serial = [(e.path, e.body) for e in jrnl._collect_entries(filters)]
+        jrnl.jobs = 8
+        parallel = [(e.path, e.body) for e in jrnl._collect_entries(filters)]
+        assert len(serial) == 5
+        assert serial == parallel
+
+
+def test_collect_parallel0002(jrnl):  # noqa: F811
+    """Check parse errors are still raised when collecting in parallel"""
+
+    for i in range(64):
+        insert_entry(jrnl, title="hello%s" % i)
+    insert_entry(jrnl, title="bad", attrs="zzz")
+
+    jrnl.jobs = 8
+    with pytest.raises(j.ParseError) as e:
+        jrnl._collect_entries()
+    assert "unknown attribute" in str(e)
+
+
+def test_parse_entry_0011(jrnl):  # noqa: F811
+    """Check a meta-only entry reads its body on demand"""
+
+    path = insert_entry(jrnl, title="title", attrs="@tag",
+                        body="body\n" * 100000)
+    ent = Entry(path, meta_only=True)
+    assert ent.title == "title"
+    assert ent.tags == {"tag"}
+    assert not ent._body_loaded
+
+    with open(path, "a") as fh:
+        fh.write("more")
+    assert ent.body == "body\n" * 100000 + "more"
+
+
+def test_parse_entry_0012(jrnl):  # noqa: F811
+    """Check a meta-only entry with no body"""
+
+    path = insert_entry(jrnl, title="title", attrs="@tag")
+    ent = Entry(path, meta_only=True)
+    assert ent.body is None
+
+
+def test_format_entry_0001(jrnl):  # noqa: F811
+    """Check formatting without the body doesn't read the body"""
+
+    path = insert_entry(jrnl, title="title", body="body")
+    ent = Entry(path, meta_only=True)
+    assert "body" not in ent.format(78, with_body=False)
+    assert ent.as_dict(with_body=False)["body"] is None
+    assert not ent._body_loaded
+    assert "body" in ent.format(78)
+
+
+def test_compact_entry_0001(jrnl):  # noqa: F811
+    """Check entries have no per-instance dict and share their tags"""
+
+    path1 = insert_entry(jrnl, title="one", attrs="@" + "tag" * 10)
+    path2 = insert_entry(jrnl, title="two", attrs="@" + "tag" * 10)
+    ent1, ent2 = Entry(path1), Entry(path2)
+    assert not hasattr(ent1, "__dict__")
+    tag1, = ent1.tags
+    tag2, = ent2.tags
+    assert tag1 is tag2
+
+
+def test_compact_entry_0002(jrnl, monkeypatch):  # noqa: F811
+    """Check indexed entries that are filtered out are never made"""
+
+    insert_entry(jrnl, title="one", attrs="@a")
+    insert_entry(jrnl, title="two", attrs="@b immortal")
+    jrnl._collect_entries()
+
+    made = []
+    orig_from_meta = Entry.from_meta.__func__
+
+    def fake_from_meta(cls, path, *args):
+        made.append(path)
+        return orig_from_meta(cls, path, *args)
+    monkeypatch.setattr(Entry, "from_meta", classmethod(fake_from_meta))
+    ents = jrnl._collect_entries(j.FilterSettings(tag_filters=["b"]))
+    assert [e.title for e in ents] == ["two"]
+    assert made == [ents[0].path]
@@ -0,0 +1,106 @@
+import datetime
+import io
+import os
+import pytest
+import tarfile
+import zipfile
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+import j
+
+FORMATS = ["tar", "tar.gz", "zip", "jsonl", "jsonl.gz"]
+
+
+def make_entries(jrnl):  # noqa: F811
+    insert_entry(jrnl, title="one", attrs="@a", body="body one\n",
+                 time=datetime.datetime(1960, 1, 1, 12), fn_suffix="xxxxxxxx")
+    insert_entry(jrnl, title="two", attrs="@b immortal nowrap",
+                 time=datetime.datetime(2017, 1, 1, 12), fn_suffix="xxxxxxxx")
+    insert_entry(jrnl, title="three", attrs="@a", body="body three\n",
+                 time=datetime.datetime(2018, 1, 1, 12), fn_suffix="xxxxxxxx")
+
+
+def contents(jrnl):  # noqa: F811
+    return [(e.ident(), e.title, e.body, sorted(e.tags), e.immortal, e.wrap)
+            for e in jrnl._collect_entries()]
+
+
+def export(jrnl, fmt, filters=None):  # noqa: F811
+    fh = io.BytesIO()
+    assert jrnl.export(fh, fmt, filters) >= 0
+    fh.seek(0)
+    return fh
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_export0001(jrnl, tmp_path, fmt):  # noqa: F811
+    """Check entries are restored from each kind of archive as they were"""
+
+    make_entries(jrnl)
+    fh = export(jrnl, fmt)
+    restored = j.Journal(str(tmp_path))
+    paths, skipped = restored.restore_entries(j.read_archive(fh, "f"))
+    assert len(paths) == 3 and skipped == []
+    assert contents(restored) == contents(jrnl)
+
+    # Restoring again leaves them be
+    fh.seek(0)
+    paths, skipped = restored.restore_entries(j.read_archive(fh, "f"))
+    assert paths == [] and len(skipped) == 3
+    assert contents(restored) == contents(jrnl)
+
+
+def test_export0002(jrnl):  # noqa: F811
+    """Check archives hold each entry's file, and the filters are used"""
+
+    make_entries(jrnl)
+    filters = j.FilterSettings(tag_filters=["a"])
+    with tarfile.open(fileobj=export(jrnl, "tar.gz", filters)) as tf:
+        assert tf.getnames() == ["20180101_120000-xxxxxxxx",
+                                 "19600101_120000-xxxxxxxx"]
+        data = tf.extractfile("20180101_120000-xxxxxxxx").read()
+        assert data == b"three\n@a\n\nbody three\n"
+        assert tf.getmember("20180101_120000-xxxxxxxx").mtime == \
+            datetime.datetime(2018, 1, 1, 12).timestamp()
+
+    filters = j.FilterSettings(time_filter=j.TimeFilter.from_arg("2018:"))
+    with zipfile.ZipFile(export(jrnl, "zip", filters)) as zf:
+        # Immortal entries always pass the time filter
+        assert zf.namelist() == ["20180101_120000-xxxxxxxx",
+                                 "20170101_120000-xxxxxxxx"]
+
+
+def test_export0003(jrnl, tmp_path):  # noqa: F811
+    """Check nothing is restored from an archive with a bad entry"""
+
+    fh = io.BytesIO()
+    with zipfile.ZipFile(fh, "w") as zf:
+        zf.writestr("20170101_120000-xxxxxxxx", b"fine\n")
+        zf.writestr(".j-index.sqlite3", b"skipped")
+        zf.writestr("20170102_120000-xxxxxxxx", b"\n")
+    fh.seek(0)
+    with pytest.raises(j.ParseError, match="20170102_120000-xxxxxxxx"):
+        jrnl.restore_entries(j.read_archive(fh, "f"))
+    assert os.listdir(jrnl.directory) == []
+
+    fh = io.BytesIO(b'{"id": "../escape", "title": "x"}\n')
+    with pytest.raises(j.ParseError, match="invalid entry id"):
+        jrnl.restore_entries(j.read_archive(fh, "f"))
+    fh = io.BytesIO(b'{"title": "x"}\n')
+    with pytest.raises(j.ParseError, match="no entry id"):
+        jrnl.restore_entries(j.read_archive(fh, "f"))
+    assert os.listdir(jrnl.directory) == []
+
+
+def test_export0004():
+    """Check tar headers are the same as tarfile's"""
+
+    for name in ["20170101_120000-xxxxxxxx", "x" * 100, "y" * 150]:
+        info = tarfile.TarInfo(name)
+        info.size = 1234
+        info.mtime = 1483272000
+        info.mode = 0o600
+        want = info.tobuf(tarfile.USTAR_FORMAT if len(name) <= 100 else
+                          tarfile.GNU_FORMAT)
+        assert j._tar_header(name, 1234, 1483272000) == want
@@ -0,0 +1,73 @@
+import datetime
+import io
+import os
+import pytest
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+import j
+
+TIME = datetime.datetime(2017, 1, 1, 12, 0, 0)
+
+
+def test_import0001(jrnl):  # noqa: F811
+    """Check many entries made in the same second get their own ids"""
+
+    items = [(j.entry_text("t%d" % i, tags=["a"]), TIME) for i in range(100)]
+    paths = jrnl.add_entries(items)
+    assert len(set(paths)) == 100
+    assert all(os.path.basename(p).startswith("20170101_120000-")
+               for p in paths)
+    ents = jrnl._collect_entries()
+    assert sorted(e.title for e in ents) == sorted("t%d" % i
+                                                   for i in range(100))
+    assert not [n for n in os.listdir(jrnl.directory)
+                if n.startswith(j.STAGING_PREFIX)]
+
+
+def test_import0002(jrnl):  # noqa: F811
+    """Check nothing is added if an entry doesn't parse"""
+
+    items = [(j.entry_text("fine"), TIME), ("\n", TIME)]
+    with pytest.raises(j.ParseError, match="entry 2"):
+        jrnl.add_entries(items)
+    assert os.listdir(jrnl.directory) == []
+
+
+def test_import0003(jrnl):  # noqa: F811
+    """Check a new entry never replaces one with the same id"""
+
+    name = "20170101_120000-xxxxxxxx"
+    insert_entry(jrnl, title="old", time=TIME, fn_suffix="xxxxxxxx")
+    staged = os.path.join(jrnl.directory, ".staged")
+    os.mkdir(staged)
+    with open(os.path.join(staged, name), "w") as fh:
+        fh.write("new\n")
+    path = jrnl._link_new_entry(os.path.join(staged, name), None)
+    assert os.path.basename(path) != name
+    assert os.path.basename(path).startswith("20170101_120000-")
+    assert sorted(e.title for e in jrnl._collect_entries()) == ["new", "old"]
+
+
+def test_import0004():
+    """Check reading entries from newline-delimited JSON"""
+
+    fh = io.StringIO('{"title": "one", "tags": ["@a", "b"], "body": "x\\n"}\n'
+                     '\n'
+                     '{"title": "two", "time": "2017-01-01 12:00:00", '
+                     '"immortal": true, "wrap": false}\n')
+    assert list(j.read_ndjson_entries(fh, "f")) == [
+        ("one\n@a @b\n\nx\n", None),
+        ("two\nimmortal nowrap\n", TIME),
+    ]
+
+    for line, reason in [('{"title": "a\\nb"}', "title"),
+                         ('{"title": "a", "tags": ["x y"]}', "tag"),
+                         ('{"title": "a", "tags": "abc"}', "tags"),
+                         ('{"title": "a", "tags": [1]}', "tags"),
+                         ('{"title": "a", "body": 5}', "body"),
+                         ('{"title": "a", "time": "soon"}', "time"),
+                         ('[]', "object"),
+                         ('{', "line 1")]:
+        with pytest.raises(j.ParseError, match=reason):
+            list(j.read_ndjson_entries(io.StringIO(line), "f"))
@@ -0,0 +1,115 @@
+import os
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+import j
+
+
+def count_parses(monkeypatch):
+    """Count the number of times an entry file is parsed"""
+
+    parsed = []
+    orig_parse = j.Entry.parse
+
+    def fake_parse(self, meta_only=False):
+        parsed.append(self.path)
+        return orig_parse(self, meta_only)
+    monkeypatch.setattr(j.Entry, "parse", fake_parse)
+    return parsed
+
+
+def test_index0001(jrnl):  # noqa: F811
+    """Check the index is created by a scan"""
+
+    insert_entry(jrnl, title="hello", attrs="@tag")
+    jrnl._collect_entries()
+    assert os.path.exists(os.path.join(jrnl.directory, j.INDEX_FILENAME))
+
+
+def test_index0002(jrnl, monkeypatch):  # noqa: F811
+    """Check unchanged entries are not re-parsed for meta-data"""
+
+    for i in range(10):
+        insert_entry(jrnl, title="hello%s" % i, attrs="@tag immortal nowrap")
+    jrnl._collect_entries(bodies=False)
+
+    parsed = count_parses(monkeypatch)
+    ents = jrnl._collect_entries(bodies=False)
+    assert len(ents) == 10
+    assert parsed == []
+    for ent in ents:
+        assert ent.tags == {"tag"}
+        assert ent.immortal
+        assert not ent.wrap
+
+
+def test_index0003(jrnl, monkeypatch):  # noqa: F811
+    """Check only matching entries are read when bodies are wanted"""
+
+    insert_entry(jrnl, title="one", attrs="@a", body="body1")
+    path2 = insert_entry(jrnl, title="two", attrs="@b", body="body2")
+    jrnl._collect_entries()
+
+    parsed = count_parses(monkeypatch)
+    filters = j.FilterSettings(tag_filters=["b"])
+    ents = jrnl._collect_entries(filters)
+    assert len(ents) == 1
+    assert ents[0].body == "body2"
+    assert parsed == [path2]
+
+
+def test_index0004(jrnl):  # noqa: F811
+    """Check the index notices entries edited behind j's back"""
+
+    path = insert_entry(jrnl, title="before", attrs="@a")
+    jrnl._collect_entries()
+
+    with open(path, "w") as fh:
+        fh.write("after, longer\n@b\n")
+    ents = jrnl._collect_entries()
+    assert len(ents) == 1
+    assert ents[0].title == "after, longer"
+    assert ents[0].tags == {"b"}
+
+
+def test_index0005(jrnl):  # noqa: F811
+    """Check the index notices entries deleted behind j's back"""
+
+    path = insert_entry(jrnl, title="one")
+    insert_entry(jrnl, title="two")
+    assert len(jrnl._collect_entries()) == 2
+
+    os.unlink(path)
+    ents = jrnl._collect_entries()
+    assert len(ents) == 1
+    assert ents[0].title == "two"
+
+    index = jrnl._open_index()
+    assert set(index.records) == {ents[0].ident()}
+    index.close()
+
+
+def test_index0006(jrnl):  # noqa: F811
+    """Check a corrupt index is rebuilt"""
+
+    insert_entry(jrnl, title="one", attrs="@a")
+    jrnl._collect_entries()
+
+    with open(os.path.join(jrnl.directory, j.INDEX_FILENAME), "wb") as fh:
+        fh.write(b"this is not a database" * 100)
+    ents = jrnl._collect_entries()
+    assert len(ents) == 1
+    assert ents[0].tags == {"a"}
+
+    index = jrnl._open_index()
+    assert len(index.records) == 1
+    index.close()
+
+
+def test_index0007(jrnl):  # noqa: F811
+    """Check the index can be disabled"""
+
+    jrnl.use_index = False
+    insert_entry(jrnl, title="one")
+    assert len(jrnl._collect_entries()) == 1
+    assert not os.path.exists(os.path.join(jrnl.directory, j.INDEX_FILENAME))
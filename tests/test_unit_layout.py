@@ -0,0 +1,157 @@
+import datetime
+import os
+import time
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+import j
+
+
+def make_entry(jrnl, title, year, attrs=None, sharded=False):
+    """Make an entry in `year`, in its shard directory if `sharded`"""
+
+    path = insert_entry(jrnl, title=title, attrs=attrs,
+                        time=datetime.datetime(year, 3, 1, 12, 0, 0))
+    if sharded:
+        new_path = jrnl._entry_path(os.path.basename(path),
+                                    j.shard_of(os.path.basename(path)))
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.rename(path, new_path)
+        path = new_path
+    return path
+
+
+def titles(ents):
+    return [e.title for e in ents]
+
+
+def test_layout0001(jrnl, tmp_path):  # noqa: F811
+    """Check new entries go in shards once a journal is sharded"""
+
+    jrnl.migrate()
+    path = os.path.join(str(tmp_path), "20170301_120000-xxxxxxxx")
+    with open(path, "w") as fh:
+        fh.write("title\n")
+    new_path = jrnl._move_entry_in(path, existing=False)
+    assert new_path == os.path.join(jrnl.directory, "2017", "03",
+                                    "20170301_120000-xxxxxxxx")
+    assert os.path.exists(new_path)
+    assert jrnl.sharded
+    assert j.Journal(jrnl.directory).sharded
+
+
+def test_layout0002(jrnl, monkeypatch):  # noqa: F811
+    """Check flat, sharded and mixed journals are read, and migrated"""
+
+    make_entry(jrnl, "flat", 2017)
+    make_entry(jrnl, "sharded", 2018, sharded=True)
+    assert titles(jrnl._collect_entries()) == ["sharded", "flat"]
+
+    parsed = []
+    orig_parse = j.Entry.parse
+
+    def fake_parse(self, meta_only=False):
+        parsed.append(self.path)
+        return orig_parse(self, meta_only)
+    monkeypatch.setattr(j.Entry, "parse", fake_parse)
+
+    jrnl.migrate()
+    assert sorted(os.listdir(jrnl.directory)) == \
+        [j.INDEX_FILENAME, j.INDEX_FILENAME + "-journal", j.SHARDED_MARKER,
+         "2017", "2018"]
+    assert titles(jrnl._collect_entries(bodies=False)) == ["sharded", "flat"]
+
+    jrnl.migrate(sharded=False)
+    # two entries, and the index and its rollback journal
+    assert len(os.listdir(jrnl.directory)) == 4
+    assert titles(jrnl._collect_entries(bodies=False)) == ["sharded", "flat"]
+    assert parsed == []  # the index is still good
+
+
+def test_layout0003(jrnl, monkeypatch):  # noqa: F811
+    """Check time filters skip shards, but not immortal entries"""
+
+    old = make_entry(jrnl, "old", 2015, sharded=True)
+    make_entry(jrnl, "immortal", 2016, attrs="immortal", sharded=True)
+    make_entry(jrnl, "new", 2020, sharded=True)
+    make_entry(jrnl, "flat", 2014)
+    filters = j.FilterSettings(time_filter=j.TimeFilter.from_arg("2019"))
+
+    # A pass over every entry records the shards' stamps, which are only
+    # kept once they are a little old
+    then = time.time() - 60
+    for path, _, _ in os.walk(jrnl.directory):
+        os.utime(path, (then, then))
+    assert titles(jrnl._collect_entries()) == ["new", "immortal", "old",
+                                               "flat"]
+    # A new entry means the directories are scanned, not the timeline
+    make_entry(jrnl, "newer", 2021, sharded=True)
+
+    listed = []
+    orig_scandir = os.scandir
+
+    def scandir(path):
+        listed.append(os.path.relpath(path, jrnl.directory))
+        return orig_scandir(path)
+    monkeypatch.setattr(os, "scandir", scandir)
+
+    def months_listed(filters):
+        del listed[:]
+        got = titles(jrnl._collect_entries(filters))
+        return got, sorted(p for p in listed if len(p) > 4)
+
+    old_months = [os.path.join("2015", "03"), os.path.join("2016", "03")]
+    new_months = [os.path.join("2020", "03"), os.path.join("2021", "03")]
+    assert months_listed(filters) == (["newer", "new", "immortal"],
+                                      new_months)
+
+    # Entries edited in place are found by the next pass over every entry
+    with open(old, "w") as fh:
+        fh.write("old\nimmortal\n")
+    monkeypatch.setattr(j, "FULL_PASS_INTERVAL", 0)
+    assert months_listed(filters) == (["newer", "new", "immortal", "old"],
+                                      old_months + new_months)
+    monkeypatch.setattr(j, "FULL_PASS_INTERVAL", 60)
+    assert months_listed(filters) == (["newer", "new", "immortal", "old"],
+                                      new_months)
+
+    # A shard that has changed since is scanned
+    make_entry(jrnl, "late", 2015, attrs="immortal", sharded=True)
+    got, months = months_listed(filters)
+    assert sorted(got) == ["immortal", "late", "new", "newer", "old"]
+    assert months == [os.path.join("2015", "03")] + new_months
+
+
+def test_layout0004(jrnl):  # noqa: F811
+    """Check shards aren't skipped unless the index knows every entry"""
+
+    make_entry(jrnl, "immortal", 2016, attrs="immortal", sharded=True)
+    make_entry(jrnl, "new", 2020, sharded=True)
+    filters = j.FilterSettings(time_filter=j.TimeFilter.from_arg("2019"))
+
+    jrnl.use_index = False
+    assert titles(jrnl._collect_entries(filters)) == ["new", "immortal"]
+    jrnl.use_index = True
+    # A limited run doesn't see every entry, so must not make the index
+    # complete
+    filters.limit = 1
+    assert titles(jrnl._collect_entries(filters)) == ["new"]
+    index = jrnl._open_index()
+    assert not index.complete
+    index.close()
+    filters.limit = None
+    assert titles(jrnl._collect_entries(filters)) == ["new", "immortal"]
+
+
+def test_layout0005(jrnl, tmp_path):  # noqa: F811
+    """Check edited entries go back where they came from"""
+
+    flat = make_entry(jrnl, "flat", 2017)
+    jrnl.migrate(sharded=False)  # nothing to do
+    jrnl.sharded = True  # but new entries are sharded
+
+    tmp = os.path.join(str(tmp_path), os.path.basename(flat))
+    with open(tmp, "w") as fh:
+        fh.write("edited\n")
+    assert jrnl._move_entry_in(tmp, existing=True) == flat
+    assert titles(jrnl._collect_entries()) == ["edited"]
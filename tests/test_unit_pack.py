@@ -0,0 +1,125 @@
+import datetime
+import os
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry, make_editor
+import j
+
+CUTOFF = datetime.datetime(2018, 1, 1)
+
+
+def make_entries(jrnl):
+    """Make some entries either side of `CUTOFF`"""
+
+    insert_entry(jrnl, title="old", attrs="@a", body="old body\n",
+                 time=datetime.datetime(2016, 1, 1, 12, 0, 0),
+                 fn_suffix="xxxxxxxx")
+    insert_entry(jrnl, title="older", attrs="@a @b immortal",
+                 time=datetime.datetime(2015, 1, 1, 12, 0, 0),
+                 fn_suffix="xxxxxxxx")
+    insert_entry(jrnl, title="new", attrs="@b", body="new body\n",
+                 time=datetime.datetime(2019, 1, 1, 12, 0, 0),
+                 fn_suffix="xxxxxxxx")
+
+
+def show(jrnl, filters=None):
+    return [(e.title, e.body, sorted(e.tags), e.immortal)
+            for e in jrnl._collect_entries(filters)]
+
+
+def test_pack0001(jrnl):  # noqa: F811
+    """Check packed entries are shown and filtered as before"""
+
+    make_entries(jrnl)
+    filter_sets = [
+        None,
+        j.FilterSettings(tag_filters=["a"]),
+        j.FilterSettings(textual_filters=["BODY"]),
+        j.FilterSettings(time_filter=j.TimeFilter.from_arg("2016")),
+        j.FilterSettings(time_filter=j.TimeFilter.from_arg("2017")),
+    ]
+    before = [show(jrnl, f) for f in filter_sets]
+
+    jrnl.pack(CUTOFF)
+    assert sorted(os.listdir(jrnl.directory)) == \
+        [j.INDEX_FILENAME, j.INDEX_FILENAME + "-journal", j.PACK_FILENAME,
+         j.PACK_INDEX_FILENAME, "20190101_120000-xxxxxxxx"]
+    assert [show(jrnl, f) for f in filter_sets] == before
+    jrnl.use_index = False
+    assert [show(jrnl, f) for f in filter_sets] == before
+
+    # And from a fresh start, with and without the pack's index
+    jrnl = j.Journal(jrnl.directory)
+    assert [show(jrnl, f) for f in filter_sets] == before
+    os.unlink(os.path.join(jrnl.directory, j.PACK_INDEX_FILENAME))
+    jrnl = j.Journal(jrnl.directory)
+    assert [show(jrnl, f) for f in filter_sets] == before
+
+
+def test_pack0002(jrnl):  # noqa: F811
+    """Check a file wins over a packed copy of the same entry"""
+
+    make_entries(jrnl)
+    jrnl.pack(CUTOFF)
+    insert_entry(jrnl, title="edited", time=datetime.datetime(2016, 1, 1, 12),
+                 fn_suffix="xxxxxxxx")
+    assert [e.title for e in jrnl._collect_entries()] == \
+        ["new", "edited", "older"]
+
+
+def test_pack0003(jrnl, tmp_path):  # noqa: F811
+    """Check editing a packed entry moves it out of the pack"""
+
+    make_entries(jrnl)
+    jrnl.pack(CUTOFF)
+    name = "20160101_120000-xxxxxxxx"
+    jrnl.editor = "true"
+    jrnl.edit_entry(name)
+    assert name in jrnl._open_pack().records  # unchanged, so left be
+
+    jrnl.editor = make_editor(str(tmp_path), 'echo more >> "$f"')
+    jrnl.edit_entry(name)
+    path = os.path.join(jrnl.directory, name)
+    with open(path) as fh:
+        assert fh.read() == "old\n@a\n\nold body\nmore\n"
+    assert name not in jrnl._open_pack().records
+    os.unlink(path)
+    assert [e.title for e in jrnl._collect_entries()] == ["new", "older"]
+
+
+def test_pack0004(jrnl):  # noqa: F811
+    """Check a partly written record is ignored, then overwritten"""
+
+    make_entries(jrnl)
+    jrnl.pack(CUTOFF)
+    path = os.path.join(jrnl.directory, j.PACK_FILENAME)
+    with open(path, "ab") as fh:
+        fh.write(b"+ 20170101_120000-xxxxxxxx 100\ntorn")
+    jrnl = j.Journal(jrnl.directory)
+    assert [e.title for e in jrnl._collect_entries()] == \
+        ["new", "old", "older"]
+
+    insert_entry(jrnl, title="2017", time=datetime.datetime(2017, 1, 1, 12),
+                 fn_suffix="xxxxxxxx")
+    jrnl.pack(CUTOFF)
+    with open(path, "rb") as fh:
+        assert b"torn" not in fh.read()
+    assert [e.title for e in jrnl._collect_entries()] == \
+        ["new", "2017", "old", "older"]
+
+
+def test_pack0005(jrnl):  # noqa: F811
+    """Check the pack is compacted once it is mostly dead records"""
+
+    make_entries(jrnl)
+    jrnl.pack(CUTOFF)
+    pack = jrnl._open_pack()
+    for _ in range(3):
+        pack.append([("20160101_120000-xxxxxxxx", pack.read(
+            "20160101_120000-xxxxxxxx"))])
+    assert pack.dead > pack.size // 2
+    jrnl.pack(CUTOFF)
+    pack = jrnl._open_pack()
+    assert pack.dead == 0
+    assert [e.title for e in jrnl._collect_entries()] == \
+        ["new", "old", "older"]
@@ -0,0 +1,87 @@
+import datetime
+from datetime import timedelta
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+from j import FilterSettings, Entry
+
+
+def insert_entries(jrnl, n):  # noqa: F811
+    """Insert `n` entries, one a day, returning their ids newest first"""
+
+    base = datetime.datetime(2017, 1, 1, 12, 0, 0)
+    paths = [insert_entry(jrnl, title="t%s" % i, attrs="@t%s" % (i % 2),
+                          time=base + timedelta(days=i),
+                          fn_suffix="xxxxxxxx")
+             for i in range(n)]
+    return [Entry(p, meta_only=True).ident() for p in reversed(paths)]
+
+
+def idents(jrnl, **kwargs):  # noqa: F811
+    ents = jrnl._collect_entries(FilterSettings(**kwargs), bodies=False)
+    return [e.ident() for e in ents]
+
+
+def test_limit0001(jrnl):  # noqa: F811
+    """Check the limit selects the newest entries"""
+
+    ids = insert_entries(jrnl, 10)
+    assert idents(jrnl, limit=3) == ids[:3]
+    assert idents(jrnl, limit=30) == ids
+    assert idents(jrnl, limit=3, tag_filters=["t0"]) == ids[1:7:2]
+
+
+def test_limit0002(jrnl, monkeypatch):  # noqa: F811
+    """Check entries beyond the limit are not loaded"""
+
+    insert_entries(jrnl, 10)
+    jrnl.use_index = False
+    parsed = []
+    orig_parse = Entry.parse
+
+    def fake_parse(self, meta_only=False):
+        parsed.append(self.path)
+        return orig_parse(self, meta_only)
+    monkeypatch.setattr(Entry, "parse", fake_parse)
+    assert len(idents(jrnl, limit=3)) == 3
+    assert len(parsed) == 3
+
+
+def test_cursor0001(jrnl):  # noqa: F811
+    """Check paging backwards through the journal"""
+
+    ids = insert_entries(jrnl, 10)
+    assert idents(jrnl, before=ids[2]) == ids[3:]
+    assert idents(jrnl, before=ids[2], limit=3) == ids[3:6]
+
+    pages = []
+    filters = FilterSettings(limit=4)
+    while True:
+        ents = jrnl._collect_entries(filters)
+        page = [e.ident() for e in ents]
+        pages.append(page)
+        cursor = filters.next_cursor(page)
+        if cursor is None:
+            break
+        filters = FilterSettings(limit=4, before=cursor)
+    assert pages == [ids[0:4], ids[4:8], ids[8:]]
+
+
+def test_cursor0002(jrnl):  # noqa: F811
+    """Check paging forwards through the journal"""
+
+    ids = insert_entries(jrnl, 10)
+    assert idents(jrnl, after=ids[7]) == ids[:7]
+    assert idents(jrnl, after=ids[7], limit=3) == ids[4:7]
+    assert idents(jrnl, after=ids[7], before=ids[2]) == ids[3:7]
+
+    filters = FilterSettings(limit=3, after=ids[7])
+    assert filters.next_cursor(ids[4:7]) == ids[4]
+
+
+def test_cursor0003(jrnl):  # noqa: F811
+    """Check cursors needn't be existing entries"""
+
+    ids = insert_entries(jrnl, 10)
+    assert idents(jrnl, before="20170105_000000-zzz") == ids[6:]
+    assert idents(jrnl, after="20170105_000000-zzz") == ids[:6]
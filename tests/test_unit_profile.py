@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry, J_SCRIPT
+import j
+
+
+def test_profile0001(jrnl, monkeypatch):  # noqa: F811
+    """Check the stages of a run are counted"""
+
+    profile = j.Profile()
+    monkeypatch.setattr(j, "PROFILE", profile)
+    jrnl.use_index = False
+    for i in range(3):
+        insert_entry(jrnl, title="title%d" % i, attrs="@tag", body="body")
+    filters = j.FilterSettings(tag_filters=["tag"], textual_filters=["body"])
+    assert len(jrnl._collect_entries(filters)) == 3
+
+    counts = {name: stat[0] for name, stat in profile.stats.items()}
+    assert counts == {"scan": 1, "open": 3, "parse": 3, "read": 3,
+                      "filter:tag": 3, "filter:text": 3}
+    assert "filter:text" in profile.table()
+    assert profile.events is None
+
+
+def test_profile0002(jrnl, monkeypatch):  # noqa: F811
+    """Check a trace holds an event for each time through each stage"""
+
+    profile = j.Profile(trace=True)
+    monkeypatch.setattr(j, "PROFILE", profile)
+    insert_entry(jrnl, title="title", body="body")
+    jrnl._collect_entries()
+
+    events = profile.trace()["traceEvents"]
+    assert len(events) == sum(count for count, _ in profile.stats.values())
+    for ev in events:
+        assert ev["ph"] == "X"
+        assert ev["ts"] >= 0 and ev["dur"] >= 0
+
+
+def test_profile0003(jrnl, tmp_path):  # noqa: F811
+    """Check J_JOURNAL_PROFILE reports to stderr or writes a trace file"""
+
+    insert_entry(jrnl, title="title", body="body")
+    env = {"J_JOURNAL_DIR": jrnl.directory, "J_JOURNAL_PROFILE": "1"}
+    p = subprocess.run([J_SCRIPT, "s"], env=env, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True)
+    assert b"title" in p.stdout
+    assert b"format" in p.stderr and b"(wall)" in p.stderr
+
+    env["J_JOURNAL_PROFILE"] = trace = os.path.join(str(tmp_path), "t.json")
+    p = subprocess.run([J_SCRIPT, "s", "-j"], env=env, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True)
+    assert p.stderr == b""
+    with open(trace) as fh:
+        names = set(ev["name"] for ev in json.load(fh)["traceEvents"])
+    assert {"scan", "json", "write"} <= names
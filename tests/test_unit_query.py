@@ -0,0 +1,135 @@
+import datetime
+import os
+import pytest
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+import j
+
+
+def make_entries(jrnl):
+    """Make entries with a mix of years, tags, bodies and immortality"""
+
+    specs = [
+        ("one", 2015, "@work", "meeting notes"),
+        ("two", 2016, "@work @home", "shopping list"),
+        ("three", 2017, "@home", "meeting the neighbours"),
+        ("four", 2018, "@home immortal", "birthday"),
+        ("five", 2019, None, "meeting again"),
+    ]
+    names = {}
+    for title, year, attrs, body in specs:
+        path = insert_entry(jrnl, title=title, attrs=attrs, body=body,
+                            time=datetime.datetime(year, 6, 1, 12, 0, 0))
+        names[title] = os.path.basename(path)
+    return names
+
+
+def query(jrnl, text, **kwargs):
+    filters = j.FilterSettings(query=j.Query.parse(text), **kwargs)
+    return [e.title for e in jrnl._collect_entries(filters)]
+
+
+def test_query0001():
+    """Check query expressions parse, with `and` binding tighter than `or`"""
+
+    cases = [
+        ("@a @b", "@a and @b"),
+        ("@a or @b and c", "@a or (@b and c)"),
+        ("(@a or @b) and not c", "(@a or @b) and not c"),
+        ('NOT "two words" or "and"', 'not "two words" or "and"'),
+        ('tag:"a b" id:x "id:x" term:y',
+         'tag:"a b" and id:x and "id:x" and y'),
+        ("when:2017:2018", "when:2017:2018"),
+    ]
+    for text, expect in cases:
+        assert str(j.Query.parse(text)) == expect
+        assert str(j.Query.parse(expect)) == expect
+
+    for bad in ["", "(@a", "@a)", "@a and", "or @a", "not", '"a', "@",
+                "when:bogus"]:
+        with pytest.raises(j.QueryException):
+            j.Query.parse(bad)
+
+
+def test_query0002(jrnl):  # noqa: F811
+    """Check queries select the same entries with or without an index"""
+
+    names = make_entries(jrnl)
+    cases = [
+        ("@work or @home", ["four", "three", "two", "one"]),
+        ("@home and not @work", ["four", "three"]),
+        ("meeting and not @work", ["five", "three"]),
+        ("(@work or meeting) when:2017", ["five", "three"]),
+        # Immortal entries are in every time range
+        ("when:2019", ["five", "four"]),
+        ("not when:2019", ["three", "two", "one"]),
+        ("id:%s or @work" % names["five"], ["five", "two", "one"]),
+        ('"meeting NOTES"', ["one"]),
+    ]
+    for use_index in False, True, True:
+        jrnl.use_index = use_index
+        for text, expect in cases:
+            assert query(jrnl, text) == expect, text
+    assert query(jrnl, '"meeting NOTES"', case_sensitive=True) == []
+    # The query must match as well as the other filters
+    assert query(jrnl, "@home", tag_filters=["work"]) == ["two"]
+    assert query(jrnl, "@home", time_filter=j.TimeFilter(
+        datetime.datetime(2016, 1, 1), datetime.datetime(2016, 12, 31))) == \
+        ["four", "two"]
+
+
+def test_query0003(jrnl):  # noqa: F811
+    """Check cheap steps are tried first, and the index rules entries out"""
+
+    make_entries(jrnl)
+    jrnl._collect_entries()  # populate the index
+
+    plan = j.QueryPlan(j.Query.parse("meeting and (home or @home) and "
+                                     "@work when:2017"))
+    assert [s.label for s in plan.root.children] == [
+        "when:2017", "@work", "meeting", "or"]
+    assert [s.label for s in plan.root.children[3].children] == ["@home",
+                                                                 "home"]
+    assert plan.key_range() == ("20170101_000000", "99991231_235959")
+    assert j.QueryPlan(j.Query.parse("id:a or @x")).ids() is None
+    assert j.QueryPlan(j.Query.parse("id:a or id:b @x")).ids() == {"a", "b"}
+    assert j.QueryPlan(j.Query.parse("(id:a or id:b) @x")).ids() == \
+        {"a", "b"}
+
+    opened = []
+    orig_parse = j.Entry.parse
+
+    def fake_parse(self, meta_only=False):
+        opened.append(self.title)
+        return orig_parse(self, meta_only)
+    j.Entry.parse = fake_parse
+    try:
+        assert query(jrnl, "@home meeting") == ["three"]
+        # Only the entry with both the tag and the word is read
+        assert opened == ["three"]
+    finally:
+        j.Entry.parse = orig_parse
+
+
+def test_query0004(jrnl):  # noqa: F811
+    """Check the explanation of a query's plan"""
+
+    make_entries(jrnl)
+    jrnl._collect_entries()  # populate the index
+    filters = j.FilterSettings(query=j.Query.parse("meeting or @work"),
+                               tag_filters=["home"])
+    report = jrnl.explain(filters).splitlines()
+    assert report[0] == "query: @home and (meeting or @work)"
+    steps = [line.split() for line in report[3:8]]
+    # label, estimate, tried, passed
+    # Only "two" and "three" have @home and either "meeting" or @work
+    assert [s[:4] for s in steps] == [
+        ["and", "2", "2", "2"],
+        ["@home", "3", "2", "2"],
+        ["or", "4", "2", "2"],
+        ["@work", "2", "2", "1"],
+        ["meeting", "3", "1", "1"],
+    ]
+    assert "5 entries scanned, 3 ruled out by the index, 2 matched" in report
+    assert j.PROFILE.stage("x") is j.NullProfile._STAGE
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import pytest
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+import j
+
+BODY = "This is a test. " * 50
+
+
+@pytest.fixture
+def count_wraps(monkeypatch):
+    """Count calls to format_body()"""
+
+    calls = []
+    orig_format_body = j.format_body
+
+    def fake_format_body(body, col):
+        calls.append((body, col))
+        return orig_format_body(body, col)
+    monkeypatch.setattr(j, "format_body", fake_format_body)
+    return calls
+
+
+def open_cache(jrnl, max_size=1024 * 1024):  # noqa: F811
+    cache = j.RenderCache(
+        os.path.join(jrnl.directory, j.RENDER_CACHE_FILENAME), max_size)
+    assert cache.open()
+    return cache
+
+
+def test_render_cache0001(jrnl, count_wraps):  # noqa: F811
+    """Check bodies are only wrapped once per column"""
+
+    expect = j.format_body(BODY, 40)
+    del count_wraps[:]
+    for i in range(2):
+        cache = open_cache(jrnl)
+        assert cache.format_body(BODY, 40) == expect
+        assert cache.format_body(BODY, 50) == j.format_body(BODY, 50)
+        cache.close()
+    assert [c for _, c in count_wraps] == [40, 50, 50, 50]
+
+
+def test_render_cache0002(jrnl, count_wraps):  # noqa: F811
+    """Check unwrapped bodies are not cached"""
+
+    cache = open_cache(jrnl)
+    cache.format_body(BODY, -1)
+    cache.close()
+    cache = open_cache(jrnl)
+    cache.format_body(BODY, -1)
+    cache.close()
+    assert len(count_wraps) == 2
+
+
+def cached_keys(jrnl):  # noqa: F811
+    cache = open_cache(jrnl)
+    keys = set(k for (k,) in cache.conn.execute("SELECT key FROM bodies"))
+    cache.close()
+    return keys
+
+
+def test_render_cache0003(jrnl):  # noqa: F811
+    """Check the least recently used bodies are evicted"""
+
+    bodies = ["%s %s" % (i, BODY) for i in range(6)]
+    keys = ["%s:40" % hashlib.sha1(b.encode()).hexdigest() for b in bodies]
+    cache = open_cache(jrnl)
+    for body in bodies[:5]:
+        cache.format_body(body, 40)
+    cache.close()
+    assert cached_keys(jrnl) == set(keys[:5])
+    one_size = len(keys[0]) + len(json.dumps(j.format_body(bodies[0], 40)))
+
+    # Use the oldest body again, then add one more to overflow the cache
+    cache = open_cache(jrnl, max_size=one_size * 5)
+    cache.format_body(bodies[0], 40)
+    cache.format_body(bodies[5], 40)
+    cache.close()
+    # Evicted down to 3/4 of the limit, keeping the most recently used
+    left = cached_keys(jrnl)
+    assert len(left) == 3
+    assert {keys[0], keys[5]} < left
+
+
+def test_render_cache0004(jrnl, count_wraps, capsys):  # noqa: F811
+    """Check showing entries uses the cache, whatever the colours"""
+
+    insert_entry(jrnl, title="title", body=BODY)
+    jrnl.show_entries()
+    plain = capsys.readouterr().out
+    jrnl.colours = j.Colours.from_str("body=red")
+    jrnl.show_entries()
+    coloured = capsys.readouterr().out
+    assert len(count_wraps) == 1
+    assert coloured.replace("\033[0;31m", "").replace("\033[0;0m", "") == \
+        plain
+
+
+def test_render_cache0005(jrnl, count_wraps, capsys):  # noqa: F811
+    """Check the cache can be disabled"""
+
+    jrnl.render_cache_size = 0
+    insert_entry(jrnl, title="title", body=BODY)
+    jrnl.show_entries()
+    jrnl.show_entries()
+    assert len(count_wraps) == 2
+    assert not os.path.exists(
+        os.path.join(jrnl.directory, j.RENDER_CACHE_FILENAME))
@@ -0,0 +1,87 @@
+import os
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+import j
+
+
+def test_tag_filter0001(jrnl):  # noqa: F811
+    """Check multiple tag filters must all match"""
+
+    insert_entry(jrnl, title="one", attrs="@a")
+    insert_entry(jrnl, title="two", attrs="@a @b")
+    insert_entry(jrnl, title="three", attrs="@b @c")
+
+    for _ in range(2):  # once to build the index, once to use it
+        filters = j.FilterSettings(tag_filters=["a", "b"])
+        ents = jrnl._collect_entries(filters)
+        assert [e.title for e in ents] == ["two"]
+
+
+def test_tag_index0001(jrnl):  # noqa: F811
+    """Check the tag index intersects tags"""
+
+    p1 = os.path.basename(insert_entry(jrnl, title="one", attrs="@a"))
+    p2 = os.path.basename(insert_entry(jrnl, title="two", attrs="@a @b"))
+    insert_entry(jrnl, title="three", attrs="@b @c")
+    jrnl._collect_entries()
+
+    index = jrnl._open_index()
+    assert index.tagged(["a"]) == {p1, p2}
+    assert index.tagged(["a", "b"]) == {p2}
+    assert index.tagged(["a", "c"]) == set()
+    assert index.tagged(["zzz"]) == set()
+    assert index.tag_counts() == [("a", 2), ("b", 2), ("c", 1)]
+    index.close()
+
+
+def test_tag_index0002():
+    """Check bitmaps round trip"""
+
+    for ids in [], [0], [1, 7, 8, 9], [3, 100, 1000, 4096]:
+        bitmap = j.Index._bitmap(ids)
+        assert list(j.Index._bitmap_members(bitmap)) == ids
+
+
+def test_tag_index0003(jrnl, monkeypatch):  # noqa: F811
+    """Check editing a tag doesn't open entries when the index is current"""
+
+    p1 = insert_entry(jrnl, title="one", attrs="@a")
+    insert_entry(jrnl, title="two", attrs="@b")
+    jrnl._collect_entries()
+
+    edited = []
+    monkeypatch.setattr(jrnl, "_edit_existing_entries",
+                        lambda ents: edited.extend(e.path for e in ents))
+    monkeypatch.setattr(j.Entry, "parse", None)  # explodes if called
+    jrnl.edit_tag("a")
+    assert edited == [p1]
+
+
+def test_show_tags0001(jrnl, capsys):  # noqa: F811
+    """Check listing the tags"""
+
+    insert_entry(jrnl, title="one", attrs="@a")
+    insert_entry(jrnl, title="two", attrs="@a @b")
+    jrnl.show_tags()
+    assert capsys.readouterr().out == "     2 @a\n     1 @b\n"
+
+    jrnl.use_index = False
+    jrnl.show_tags()
+    assert capsys.readouterr().out == "     2 @a\n     1 @b\n"
+
+
+def test_tag_index0004(jrnl):  # noqa: F811
+    """Check entries indexed by another process since the index was opened
+    are left out, rather than breaking the tag query"""
+
+    p1 = os.path.basename(insert_entry(jrnl, title="one", attrs="@a"))
+    jrnl._collect_entries()
+    index = jrnl._open_index()
+
+    insert_entry(jrnl, title="two", attrs="@a")
+    j.Journal(jrnl.directory)._collect_entries()
+    assert index.tagged(["a"]) == {p1}
+    index.close()
+    assert len(jrnl._collect_entries(j.FilterSettings(tag_filters=["a"]))) \
+        == 2
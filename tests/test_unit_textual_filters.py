@@ -1,3 +1,4 @@
+import os
 import pytest
 import support  # noqa: F401
 from support import jrnl  # noqa: F401
@@ -64,3 +65,116 @@ def test_textual_filter_0005(jrnl, filters):  # noqa: F811
     filters.textual_filters = ["toxic"]
     ents = jrnl._collect_entries(filters)
     assert len(ents) == 0
+
+
+def text_candidates(jrnl, terms, case_sensitive=False):
+    """Query the text index of a journal"""
+
+    index = jrnl._open_index()
+    try:
+        return index.text_candidates(terms, case_sensitive)
+    finally:
+        index.close()
+
+
+def test_textual_filter_0006(jrnl, filters, monkeypatch):  # noqa: F811
+    """Check indexed entries that can't match are not read"""
+
+    for i in range(10):
+        insert_entry(jrnl, title="Crew%s" % i, body="Kryten, Lister, Cat")
+    path = insert_entry(jrnl, title="About the BBQ", body="Toxic BBQ")
+    jrnl._collect_entries()  # populate the index
+
+    opened = []
+    orig_open = open
+
+    def fake_open(path, *args, **kwargs):
+        opened.append(path)
+        return orig_open(path, *args, **kwargs)
+    monkeypatch.setattr("builtins.open", fake_open)
+    filters.textual_filters = ["toxic", "bbq"]
+    ents = jrnl._collect_entries(filters)
+    assert len(ents) == 1
+    assert set(opened) == {path}
+
+
+def test_textual_filter_0007(jrnl):  # noqa: F811
+    """Check the index finds partial words and phrases"""
+
+    p1 = os.path.basename(insert_entry(jrnl, title="t1", body="Toxic BBQ"))
+    p2 = os.path.basename(insert_entry(jrnl, title="t2", body="the BBQs!"))
+    jrnl._collect_entries()
+
+    assert text_candidates(jrnl, ["oxi"]) == {p1}
+    assert text_candidates(jrnl, ["bbq"]) == {p1, p2}
+    assert text_candidates(jrnl, ["xic bb"]) == {p1}
+    assert text_candidates(jrnl, ["the bbq"]) == {p2}
+    assert text_candidates(jrnl, ["oxic", "the"]) == set()
+    assert text_candidates(jrnl, ["!"]) is None
+
+
+def test_textual_filter_0008(jrnl):  # noqa: F811
+    """Check the index honours case sensitivity"""
+
+    p1 = os.path.basename(insert_entry(jrnl, title="t1", body="Toxic BBQ"))
+    jrnl._collect_entries()
+
+    assert text_candidates(jrnl, ["toxic"], True) == set()
+    assert text_candidates(jrnl, ["Toxic"], True) == {p1}
+    assert text_candidates(jrnl, ["toxic"], False) == {p1}
+    assert text_candidates(jrnl, ["TOXIC"], False) == {p1}
+
+
+def test_textual_filter_0009(jrnl, filters):  # noqa: F811
+    """Check the index notices changed entries"""
+
+    path = insert_entry(jrnl, title="t1", body="Toxic BBQ")
+    filters.textual_filters = ["crew"]
+    assert len(jrnl._collect_entries(filters)) == 0
+
+    with open(path, "w") as fh:
+        fh.write("t1\n\nThe crew of Red Dwarf\n")
+    assert len(jrnl._collect_entries(filters)) == 1
+    assert text_candidates(jrnl, ["crew"]) == {os.path.basename(path)}
+
+    with open(path, "w") as fh:
+        fh.write("t1\n\nSomething else\n")
+    jrnl._update_index([path])
+    assert text_candidates(jrnl, ["crew"]) == set()
+    assert len(jrnl._collect_entries(filters)) == 0
+
+
+def test_textual_filter_0010(jrnl, monkeypatch):  # noqa: F811
+    """Check multi-term searches across chunk and mmap boundaries"""
+
+    import j
+    monkeypatch.setattr(j, "_SEARCH_CHUNK", 8)
+    monkeypatch.setattr(j.Entry, "MMAP_SIZE", 16)
+    path = insert_entry(jrnl, title="t1", body="x" * 20 + "Red Dwarf crew")
+    ent = j.Entry(path)
+
+    assert ent.matches_all_text(["red dwarf", "CREW", "t1"])
+    assert ent.matches_all_text(["Red Dwarf", "crew"], case_sensitive=True)
+    assert not ent.matches_all_text(["red dwarf", "ship"])
+    assert not ent.matches_all_text(["red dwarf"], case_sensitive=True)
+    assert ent.matches_all_text(["dwarf", "red dwarf crew", "d"])
+
+
+def test_textual_filter_0011(jrnl):  # noqa: F811
+    """Check searches agree with lowercasing the text"""
+
+    from j import Entry
+    # The Kelvin sign and dotted capital I lowercase to ASCII
+    path = insert_entry(jrnl, title="t1",
+                        body="\u212aelv \u0130 Конференция")
+    ent = Entry(path)
+
+    assert ent.matches_text("kelv")
+    assert ent.matches_text("i")
+    assert not ent.matches_text("kelv", case_sensitive=True)
+
+    assert ent.matches_text("конф")
+    assert ent.matches_text("Конф", case_sensitive=True)
+    assert not ent.matches_text("конф", case_sensitive=True)
+    assert ent.matches_all_text(["elv\n", "t1"]) is False
+    assert ent.matches_all_text(["t1\n\n", "t1"])
@@ -5,6 +5,8 @@ from support import jrnl  # noqa: F401
 from support import now  # noqa: F401
 from support import insert_entry, freeze_time
 from j import TimeFilter, FilterSettings
+from j import make_arg_parser, _make_filters
+from j import ident_time, ident_time_key, time_key
 
 
 def test_time_filter0001(jrnl):  # noqa: F811
@@ -155,3 +157,70 @@ def test_parse_timespec0005(monkeypatch):
     tf = TimeFilter.from_arg("2M:1M")
     assert tf.start == TimeFilter.now() - timedelta(minutes=2)
     assert tf.stop == TimeFilter.now() - timedelta(minutes=1)
+
+
+def test_time_filter0010(jrnl, now, monkeypatch):  # noqa: F811
+    """Check indexed entries outside the time range are not opened"""
+
+    filters = FilterSettings(time_filter=TimeFilter.from_arg("1w"))
+    for i in range(10):
+        insert_entry(jrnl, title="old%s" % i, time=now - timedelta(days=30))
+    path = insert_entry(jrnl, title="new", body="body")
+    jrnl._collect_entries()  # populate the index
+
+    opened = []
+    orig_open = open
+
+    def fake_open(path, *args, **kwargs):
+        opened.append(path)
+        return orig_open(path, *args, **kwargs)
+    monkeypatch.setattr("builtins.open", fake_open)
+    ents = jrnl._collect_entries(filters)
+
+    assert len(ents) == 1
+    assert ents[0].body == "body"
+    assert opened == [path]
+
+
+def test_time_filter0011(jrnl, now):  # noqa: F811
+    """Check entries are ordered newest first"""
+
+    paths = [insert_entry(jrnl, title="t%s" % i, time=now - timedelta(days=i))
+             for i in range(10)]
+    ents = jrnl._collect_entries()
+    assert [e.path for e in ents] == paths
+
+
+def test_time_filter0012():
+    """Check the key range rounds to whole seconds"""
+
+    start = datetime.datetime(2017, 1, 1, 12, 0, 0, 500)
+    stop = datetime.datetime(2017, 1, 2, 12, 0, 0, 500)
+    tf = TimeFilter(start, stop)
+    assert tf.key_range() == ("20170101_120001", "20170102_120000")
+    assert TimeFilter().key_range() == ("00010101_000000", "99991231_235959")
+
+
+def test_time_filter0013(jrnl, now):  # noqa: F811
+    """Check J_JOURNAL_TIME applies unless --when is given, even empty"""
+
+    insert_entry(jrnl, title="old", time=now - timedelta(weeks=2))
+    insert_entry(jrnl, title="new", time=now)
+
+    def titles(argv):
+        args = make_arg_parser("show").parse_args(["show"] + argv)
+        filters = _make_filters(args, "1w")
+        return [e.title for e in jrnl._collect_entries(filters)]
+
+    assert titles([]) == ["new"]
+    assert titles(["-w", "3w"]) == ["new", "old"]
+    assert titles(["-w", ""]) == ["new", "old"]
+
+
+def test_ident_time0001():
+    """Check decoding the time from an entry identifier"""
+
+    dt = datetime.datetime(2017, 3, 4, 5, 6, 7)
+    assert ident_time("20170304_050607-abc") == dt
+    assert ident_time_key("20170304_050607-abc") == "20170304_050607"
+    assert ident_time_key("20170304_050607-abc") == time_key(dt)
@@ -0,0 +1,137 @@
+import datetime
+import os
+import time
+import support  # noqa: F401
+from support import jrnl  # noqa: F401
+from support import insert_entry
+import j
+
+
+def make_entry(jrnl, title, year, attrs=None):
+    return insert_entry(jrnl, title=title, attrs=attrs,
+                        time=datetime.datetime(year, 3, 1, 12, 0, 0))
+
+
+def years(start, stop):
+    return j.FilterSettings(time_filter=j.TimeFilter(
+        datetime.datetime(start, 1, 1), datetime.datetime(stop, 12, 31)))
+
+
+def titles(ents):
+    return [e.title for e in ents]
+
+
+def backdate(jrnl):
+    """Make the journal's directories look as if they last changed a while
+    ago, so that a timeline of them can be written"""
+
+    then = time.time() - 60
+    for path, subdirs, _ in os.walk(jrnl.directory):
+        if j.TIMELINE_DIRNAME in subdirs:
+            subdirs.remove(j.TIMELINE_DIRNAME)
+        os.utime(path, (then, then))
+
+
+def settle(jrnl):
+    """Run the journal until it has written a timeline"""
+
+    for _ in range(3):
+        backdate(jrnl)
+        jrnl._collect_entries(bodies=False)
+        if jrnl._open_timeline():
+            return
+    assert False, "no timeline written"
+
+
+def no_scan(*args, **kwargs):
+    raise AssertionError("scanned the journal")
+
+
+def test_timeline0001(jrnl, monkeypatch):  # noqa: F811
+    """Check time filters are answered from the timeline"""
+
+    for year in range(2010, 2020):
+        make_entry(jrnl, str(year), year)
+    settle(jrnl)
+
+    timeline = jrnl._open_timeline()
+    assert timeline.count == 10
+    assert [k for k, _, _ in timeline.between("20130000_000000",
+                                              "20141231_235959")] == \
+        ["20130301_120000", "20140301_120000"]
+    assert timeline.between("20200000_000000", "20201231_235959") == []
+    timeline.close()
+
+    monkeypatch.setattr(j.Journal, "_scan", no_scan)
+    statted = []
+    orig_stat = j.Journal._stat
+
+    def stat(self, fname, subdir):
+        statted.append(fname)
+        return orig_stat(self, fname, subdir)
+    monkeypatch.setattr(j.Journal, "_stat", stat)
+    assert titles(jrnl._collect_entries(years(2013, 2014))) == \
+        ["2014", "2013"]
+    # Only the entries in time are looked at
+    assert len(statted) == 2
+    assert len(jrnl._collect_entries()) == 10
+
+
+def test_timeline0002(jrnl, monkeypatch):  # noqa: F811
+    """Check immortal entries pass time filters answered from the timeline"""
+
+    make_entry(jrnl, "old", 2015)
+    make_entry(jrnl, "immortal", 2016, attrs="immortal")
+    make_entry(jrnl, "new", 2020)
+    settle(jrnl)
+
+    monkeypatch.setattr(j.Journal, "_scan", no_scan)
+    filters = j.FilterSettings(time_filter=j.TimeFilter.from_arg("2019"))
+    assert titles(jrnl._collect_entries(filters)) == ["new", "immortal"]
+    assert titles(jrnl._collect_entries(years(2014, 2015))) == \
+        ["immortal", "old"]
+
+
+def test_timeline0003(jrnl):  # noqa: F811
+    """Check a timeline isn't used once the journal has changed"""
+
+    make_entry(jrnl, "old", 2015)
+    settle(jrnl)
+
+    make_entry(jrnl, "new", 2019)
+    assert jrnl._open_timeline() is None
+    filters = j.FilterSettings(time_filter=j.TimeFilter.from_arg("2019"))
+    assert titles(jrnl._collect_entries(filters)) == ["new"]
+
+    # A bad timeline is ignored
+    settle(jrnl)
+    path = jrnl._open_timeline().path
+    with open(path, "r+b") as fh:
+        fh.truncate(os.path.getsize(path) - 1)
+    assert jrnl._open_timeline() is None
+    assert titles(jrnl._collect_entries()) == ["new", "old"]
+
+
+def test_timeline0004(jrnl, monkeypatch):  # noqa: F811
+    """Check entries edited in place to be immortal pass time filters
+    answered from the timeline"""
+
+    old = make_entry(jrnl, "old", 2015)
+    make_entry(jrnl, "new", 2019)
+    settle(jrnl)
+
+    with open(old, "w") as fh:
+        fh.write("old\nimmortal\n")
+    # The edit didn't change the journal directory, so the timeline holds
+    timeline = jrnl._open_timeline()
+    assert timeline
+    timeline.close()
+    monkeypatch.setattr(j.Journal, "_scan", no_scan)
+    filters = j.FilterSettings(time_filter=j.TimeFilter.from_arg("2019"))
+    # Once the last pass over every entry is old enough, a time filter makes
+    # one, which finds the edit...
+    monkeypatch.setattr(j, "FULL_PASS_INTERVAL", 0)
+    assert titles(jrnl._collect_entries(filters)) == ["new", "old"]
+    # ...and the index remembers it
+    monkeypatch.setattr(j, "FULL_PASS_INTERVAL", 60)
+    assert titles(jrnl._collect_entries(filters)) == ["new", "old"]
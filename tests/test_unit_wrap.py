@@ -1,6 +1,7 @@
 import pytest
 import support  # noqa: F401
-from j import format_body
+from j import format_body, wrap_words
+import random
 import textwrap
 
 LIST_INPUT1 = """this is a test
@@ -98,3 +99,32 @@ def test_no_trailing_newline0002():
     expect = "/\n| 123\n\\"
     for i in range(10, 100):
         assert "\n".join(format_body(input, i)) == expect
+
+
+def test_wrap_words0001():
+    """Check wrapping words matches textwrap for tricky words"""
+
+    inputs = [
+        "abcd efghijklmnop",
+        "a well-known thing, a well--known -thing and a--b",
+        "Hello there -- you goof-ball, use the -b option!",
+        "x" * 200 + " short " + "y-" * 100,
+        "--- -a- a---b ab-cd-ef-gh-ij-kl-mn-op-qr-st-uv-wx-yz",
+    ]
+    for input in inputs:
+        for i in range(1, 100):
+            assert wrap_words(input.split(), i) == textwrap.wrap(input, i)
+
+
+def test_wrap_words0002():
+    """Check wrapping random words matches textwrap"""
+
+    rnd = random.Random(0)
+    alphabet = ["a", "b", "é", "-", "--", "!", ",", "1", "'"]
+    for _ in range(2000):
+        words = ["".join(rnd.choice(alphabet)
+                         for _ in range(rnd.choice([1, 2, 3, 5, 8, 20])))
+                 for _ in range(rnd.randint(1, 12))]
+        width = rnd.randint(1, 25)
+        assert wrap_words(words, width) == textwrap.wrap(" ".join(words),
+                                                         width)